@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""End to end benchmark of the bridge on the simulated CEC bus
+
+Runs the bridge against an in-process MQTT broker, the simulated CEC bus
+and a fake lircd, no hardware or libcec needed. Reports:
+
+* command to transmit latency: MQTT publish until the frame is on the bus
+  or lircd received the command
+* RX to publish latency: frame on the bus or lircd line until the
+  subscriber received it
+* refresh cycle time
+* memory and thread count under load
+
+    PYTHONPATH=src python3 benchmarks/bench_bridge.py --latency 0.005 --nack 0.02
+"""
+import argparse
+import asyncio
+import copy
+import logging
+import resource
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import fakelircd
+import mqttbroker
+from cec_mqtt_bridge import aio
+from cec_mqtt_bridge import bridge
+from cec_mqtt_bridge import simcec
+
+# Threads of the benchmark harness, not counted as bridge threads
+HARNESS_THREADS = ('fakelircd', 'mqtt-broker', 'bench')
+
+
+class Subscriber:
+    """MQTT client recording the arrival time of every payload per topic"""
+    def __init__(self, port: int):
+        self.arrivals = {}  # (topic, payload) -> time.monotonic()
+        self.received = 0
+        self.client = mqtt.Client('bench')
+        self.client.on_message = self._on_message
+        self.client.connect('127.0.0.1', port)
+        self.client.subscribe('media/#')
+        self.client.loop_start()
+
+    def _on_message(self, _client, _userdata, message):
+        self.received += 1
+        self.arrivals.setdefault((message.topic, message.payload.decode()), time.monotonic())
+
+    def wait_for(self, topic: str, payload: str, timeout: float = 10.0) -> bool:
+        """Wait until a payload arrived on a topic"""
+        deadline = time.monotonic() + timeout
+        while (topic, payload) not in self.arrivals:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+def percentiles(samples: list) -> str:
+    """p50, p90, p99 and max of latencies in ms"""
+    if not samples:
+        return 'no samples'
+    samples = sorted(samples)
+
+    def pick(quantile):
+        return samples[min(int(quantile * len(samples)), len(samples) - 1)] * 1000
+
+    return (f'n={len(samples):<5} p50 {pick(0.5):7.2f} ms  p90 {pick(0.9):7.2f} ms  '
+            f'p99 {pick(0.99):7.2f} ms  max {samples[-1] * 1000:7.2f} ms')
+
+
+def rss_kib() -> int:
+    """Resident set size of this process in KiB"""
+    try:
+        with open('/proc/self/status', encoding='ascii') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bridge_threads(baseline: set) -> int:
+    """Number of threads started by the bridge"""
+    return sum(1 for thread in threading.enumerate()
+               if thread not in baseline and thread.name not in HARNESS_THREADS)
+
+
+def bench_commands(args, subscriber: Subscriber, lircd: fakelircd.FakeLircd):
+    """MQTT command until the frame is transmitted"""
+    cec_sent, ir_sent = {}, {}
+    for i in range(args.count):
+        frame = f'15:89:{i >> 8:02x}:{i & 0xFF:02x}'
+        cec_sent[frame] = time.monotonic()
+        subscriber.client.publish('media/cec/tx', frame)
+        key = f'KEY_{i}'
+        ir_sent[f'SEND_ONCE bench {key}'] = time.monotonic()
+        subscriber.client.publish('media/ir/bench/tx', key)
+        time.sleep(args.interval)
+    time.sleep(1)
+
+    transmitted = {}
+    for sent_at, frame in list(simcec.BUS.sent):
+        transmitted.setdefault(frame, sent_at)
+    print('command -> CEC transmit ',
+          percentiles([transmitted[frame] - sent for frame, sent in cec_sent.items()
+                       if frame in transmitted]))
+    received = dict((command, at) for at, command in reversed(list(lircd.commands)))
+    print('command -> lircd send   ',
+          percentiles([received[command] - sent for command, sent in ir_sent.items()
+                       if command in received]))
+
+
+def bench_rx(args, subscriber: Subscriber, lircd: fakelircd.FakeLircd):
+    """Frame on the bus until it is published"""
+    cec_received, ir_received = {}, {}
+    for i in range(args.count):
+        frame = f'4f:89:{i >> 8:02x}:{i & 0xFF:02x}'
+        cec_received[frame] = time.monotonic()
+        simcec.BUS.receive(frame)
+        key = f'KEY_{i}'
+        ir_received[key] = time.monotonic()
+        lircd.press('bench', key)
+        time.sleep(args.interval)
+    time.sleep(1)
+
+    arrivals = subscriber.arrivals
+    print('CEC frame -> publish    ',
+          percentiles([arrivals[('media/cec/rx', frame)] - sent
+                       for frame, sent in cec_received.items()
+                       if ('media/cec/rx', frame) in arrivals]))
+    print('IR key -> publish       ',
+          percentiles([arrivals[('media/ir/bench/rx', key)] - sent
+                       for key, sent in ir_received.items()
+                       if ('media/ir/bench/rx', key) in arrivals]))
+
+
+def bench_refresh(args, the_bridge: bridge.Bridge):
+    """Full refresh of all configured devices"""
+    times = []
+    for _ in range(args.refreshes):
+        start = time.monotonic()
+        the_bridge.cec_class.refresh()
+        times.append(time.monotonic() - start)
+    print('refresh cycle          ', percentiles(times))
+
+
+def bench_load(args, subscriber: Subscriber, lircd: fakelircd.FakeLircd, baseline: set):
+    """Memory and threads while commands and frames arrive at a fixed rate"""
+    rss_before = rss_kib()
+    threads, rss = [], []
+    received = subscriber.received
+    interval = 1 / args.rate
+    deadline = time.monotonic() + args.duration
+    i = 0
+    while time.monotonic() < deadline:
+        kind = i % 3
+        if kind == 0:
+            subscriber.client.publish('media/cec/tx', f'15:89:{i >> 8 & 0xFF:02x}:{i & 0xFF:02x}')
+        elif kind == 1:
+            simcec.BUS.receive(f'4f:89:{i >> 8 & 0xFF:02x}:{i & 0xFF:02x}')
+        else:
+            lircd.press('load', f'KEY_{i % 16}')
+        if i % max(int(args.rate / 10), 1) == 0:
+            threads.append(bridge_threads(baseline))
+            rss.append(rss_kib())
+        i += 1
+        time.sleep(interval)
+    time.sleep(0.5)
+    print(f'load {args.rate}/s for {args.duration} s: {i} events, '
+          f'{subscriber.received - received} messages received')
+    print(f'bridge threads          max {max(threads)}  avg {sum(threads) / len(threads):.1f}')
+    print(f'RSS                     before {rss_before} KiB  max {max(rss)} KiB  '
+          f'growth {max(rss) - rss_before} KiB')
+
+
+def run_benchmarks(args, the_bridge, subscriber, lircd, baseline, done):
+    """Wait for the bridge and run all benchmarks"""
+    try:
+        if not subscriber.wait_for('media/cec/device/0/power', 'on') or \
+                not subscriber.wait_for('media/bridge/status', 'online'):
+            print('bridge did not come up')
+            return
+        while the_bridge.cec_class is None or not lircd.rx_connected:
+            time.sleep(0.01)
+        time.sleep(0.5)  # let the subscriptions settle
+        print(f'simulated bus: latency {args.latency * 1000:.1f} ms, nack rate {args.nack}, '
+              f'{"asyncio" if args.asyncio else "threads"}')
+        bench_commands(args, subscriber, lircd)
+        bench_rx(args, subscriber, lircd)
+        bench_refresh(args, the_bridge)
+        bench_load(args, subscriber, lircd, baseline)
+    finally:
+        done()
+
+
+def main():
+    """Run the benchmarks"""
+    parser = argparse.ArgumentParser(description='Bridge end to end benchmark')
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help='commands and frames per latency benchmark')
+    parser.add_argument('--interval', type=float, default=0.05,
+                        help='seconds between commands in the latency benchmarks')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='simulated libcec call latency in seconds')
+    parser.add_argument('--nack', type=float, default=0.0, help='simulated NACK rate')
+    parser.add_argument('--events', type=float, default=0.0,
+                        help='average seconds between spontaneous bus events')
+    parser.add_argument('--refreshes', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=90, help='events per second under load')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of load')
+    parser.add_argument('--asyncio', action='store_true', help='benchmark the asyncio mode')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    broker = mqttbroker.Broker()
+    port = broker.start()
+    directory = tempfile.TemporaryDirectory()
+    lircd = fakelircd.FakeLircd(directory.name)
+    simcec.BUS = simcec.SimBus(latency=args.latency, nack_rate=args.nack,
+                               event_interval=args.events, seed=1)
+    subscriber = Subscriber(port)
+
+    config = copy.deepcopy(bridge.DEFAULT_CONFIGURATION)
+    config['mqtt']['port'] = port
+    config['cec'].update(enabled=1, backend='sim', cache_file='', refresh='0')
+    config['ir'].update(enabled=1, rx_sock_path=lircd.rx_path, tx_sock_path=lircd.tx_path)
+    config['metrics']['interval'] = '0'
+
+    baseline = set(threading.enumerate())
+    if args.asyncio:
+        the_bridge = aio.AsyncBridge(config)
+        threading.Thread(target=run_benchmarks, name='bench', daemon=True,
+                         args=(args, the_bridge, subscriber, lircd, baseline,
+                               the_bridge.stop)).start()
+        asyncio.run(the_bridge.run())
+    else:
+        the_bridge = bridge.Bridge(config)
+        the_bridge.start()
+        run_benchmarks(args, the_bridge, subscriber, lircd, baseline, lambda: None)
+        the_bridge.cleanup()
+
+    subscriber.client.loop_stop()
+    lircd.close()
+    broker.stop()
+    directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Poll lease of several bridge processes on one CEC bus
+
+Starts bridge processes with distinct [mqtt] instance ids against the
+in-process MQTT broker, checks that only the lease owner polls, kills the
+owner and measures how long the next instance takes to take over and
+whether bridge/status stays online and the killed instance is cleared.
+
+    PYTHONPATH=src python3 benchmarks/bench_lease.py --bridges 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import mqttbroker
+
+CONFIG = """
+[mqtt]
+port={port}
+name=bridge-{instance}
+instance={instance}
+lease_grace={grace}
+[cec]
+enabled=1
+backend=sim
+cache_file=
+refresh=10
+[ir]
+enabled=0
+[metrics]
+interval=1
+"""
+
+
+class Observer:
+    """Follows bridge/lease and the polls of every instance"""
+    def __init__(self, port: int):
+        self._lock = threading.Lock()
+        self.lease = []     # (time.monotonic(), owner)
+        self.polls = {}     # instance -> power status polls
+        self.status = {}    # bridge/status and bridge/instance/<id> -> last payload
+        self.client = mqtt.Client('bench-lease')
+        self.client.on_message = self._on_message
+        self.client.connect('127.0.0.1', port)
+        self.client.subscribe('media/bridge/#')
+        self.client.loop_start()
+
+    def _on_message(self, _client, _userdata, message):
+        with self._lock:
+            if message.topic == 'media/bridge/status' or \
+                    message.topic.startswith('media/bridge/instance/'):
+                self.status[message.topic[len('media/'):]] = message.payload.decode()
+            elif message.topic == 'media/bridge/lease':
+                self.lease.append((time.monotonic(), message.payload.decode()))
+            elif message.topic == 'media/bridge/stats':
+                stats = json.loads(message.payload)
+                calls = stats.get('cec_call_seconds', {}).get('GetDevicePowerStatus', {})
+                self.polls[stats['lease']['instance']] = calls.get('count', 0)
+
+    def owner(self) -> str:
+        """Current lease owner"""
+        with self._lock:
+            return self.lease[-1][1] if self.lease else None
+
+    def wait_owner(self, exclude: str = None, timeout: float = 30) -> float:
+        """Wait for a lease owner other than exclude, returns the time it took over"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if self.lease and self.lease[-1][1] != exclude:
+                    return self.lease[-1][0]
+            time.sleep(0.01)
+        return None
+
+    def poll_counts(self) -> dict:
+        """Snapshot of the poll counters"""
+        with self._lock:
+            return dict(self.polls)
+
+
+def print_polls(processes: dict, before: dict, after: dict, seconds: float):
+    """Print the power status polls of every instance"""
+    for instance in sorted(processes):
+        print(f'  {instance}: {after.get(instance, 0) - before.get(instance, 0):4} polls '
+              f'in {seconds:.0f} s')
+
+
+def main():
+    """Run the lease benchmark"""
+    parser = argparse.ArgumentParser(description='Bridge poll lease benchmark')
+    parser.add_argument('-b', '--bridges', type=int, default=3)
+    parser.add_argument('--grace', type=float, default=1.0, help='lease grace period')
+    parser.add_argument('--settle', type=float, default=12.0,
+                        help='seconds to count polls before killing the owner')
+    args = parser.parse_args()
+
+    broker = mqttbroker.Broker()
+    port = broker.start()
+    observer = Observer(port)
+    directory = tempfile.TemporaryDirectory()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    processes = {}
+    for i in range(args.bridges):
+        instance = f'bridge{i}'
+        path = os.path.join(directory.name, f'{instance}.ini')
+        with open(path, 'w', encoding='utf-8') as config:
+            config.write(CONFIG.format(port=port, instance=instance, grace=args.grace))
+        processes[instance] = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, '-m', 'cec_mqtt_bridge.bridge', '-f', path], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        if observer.wait_owner() is None:
+            print('no bridge took the lease')
+            return
+        time.sleep(1)
+        before = observer.poll_counts()
+        time.sleep(args.settle)
+        after = observer.poll_counts()
+        owner = observer.owner()
+        print(f'{args.bridges} bridges, lease owner {owner}')
+        print_polls(processes, before, after, args.settle)
+
+        processes.pop(owner).kill()
+        killed = time.monotonic()
+        taken = observer.wait_owner(exclude=owner)
+        if taken is None:
+            print('no bridge took over')
+            return
+        print(f'killed {owner}, {observer.owner()} took over after '
+              f'{(taken - killed) * 1000:.0f} ms')
+        before = observer.poll_counts()
+        time.sleep(args.settle)
+        print_polls(processes, before, observer.poll_counts(), args.settle)
+        status = dict(observer.status)
+        print(f'bridge/status {status.get("bridge/status")}, {owner} instance '
+              f'{status.get(f"bridge/instance/{owner}") or "cleared"}')
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+        observer.client.loop_stop()
+        broker.stop()
+        directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
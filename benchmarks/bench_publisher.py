@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Outbound publish queue across a broker outage
+
+Stops the in-process MQTT broker, publishes state updates and events from
+the bridge while it is down, starts the broker again and reports what
+reached a subscriber and how long the flush took after reconnecting.
+
+    PYTHONPATH=src python3 benchmarks/bench_publisher.py --topics 50 --updates 100
+"""
+import argparse
+import asyncio
+import copy
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import mqttbroker
+from cec_mqtt_bridge import aio
+from cec_mqtt_bridge import bridge
+from cec_mqtt_bridge import simcec
+
+
+class Subscriber:
+    """Counts the messages below the bridge prefix"""
+    def __init__(self, port: int):
+        self._lock = threading.Lock()
+        self.received = {}  # topic -> [payloads]
+        self.last = None    # time.monotonic() of the last message
+        self.client = mqtt.Client('bench-publisher')
+        self.client.on_message = self._on_message
+        self.client.on_connect = lambda client, *_: client.subscribe('media/#')
+        self.client.reconnect_delay_set(min_delay=1, max_delay=1)
+        self.client.connect('127.0.0.1', port)
+        self.client.loop_start()
+
+    def _on_message(self, _client, _userdata, message):
+        with self._lock:
+            self.received.setdefault(message.topic, []).append(message.payload.decode())
+            self.last = time.monotonic()
+
+    def reset(self):
+        """Forget the received messages"""
+        with self._lock:
+            self.received = {}
+            self.last = None
+
+
+def run_outage(args, the_bridge, subscriber: Subscriber, brokers: list, done: callable):
+    """Publish during a broker outage and measure the flush after it
+
+    The broker in brokers is stopped and replaced by a new one on the same port.
+    """
+    while not the_bridge.mqtt_client.is_connected():
+        time.sleep(0.05)
+    time.sleep(0.5)
+    brokers[-1].stop()
+    while the_bridge.mqtt_client.is_connected():
+        time.sleep(0.05)
+
+    start = time.perf_counter()
+    for update in range(args.updates):
+        for topic in range(args.topics):
+            the_bridge.mqtt_publish(f'bench/state/{topic}', update, state=True)
+    for event in range(args.events):
+        the_bridge.mqtt_publish('cec/rx', f'0f:87:{event:06x}', retain=False)
+    queued = time.perf_counter() - start
+    stats = the_bridge.publisher.stats()
+    print(f'outage: {args.topics * args.updates} state updates and {args.events} events '
+          f'queued in {queued * 1000:.1f} ms')
+    print(f'queue:  {stats["state"]} state, {stats["events"]} events, '
+          f'{stats["coalesced"]} coalesced, {stats["dropped"]} dropped')
+
+    subscriber.reset()
+    brokers.append(mqttbroker.Broker(port=brokers[-1].port))
+    brokers[-1].start()
+    started = time.monotonic()
+    expected = {f'media/bench/state/{topic}': str(args.updates - 1)
+                for topic in range(args.topics)}
+    deadline = started + 10
+    while time.monotonic() < deadline:
+        received = dict(subscriber.received)
+        if all(received.get(topic, [None])[-1] == value for topic, value in expected.items()):
+            break
+        time.sleep(0.01)
+    time.sleep(0.5)
+    received = subscriber.received
+    state = sum(len(received.get(topic, ())) for topic in expected)
+    events = received.get('media/cec/rx', [])
+    print(f'flush:  {state} state and {len(events)} events received, last '
+          f'{(subscriber.last - started) * 1000:.0f} ms after the broker started '
+          f'(including the reconnect delay)')
+    print(f'events in order: {events == sorted(events)}, only the latest state: '
+          f'{all(received.get(topic) == [value] for topic, value in expected.items())}')
+    done()
+
+
+def main():
+    """Run the publisher benchmark"""
+    parser = argparse.ArgumentParser(description='Publish queue outage benchmark')
+    parser.add_argument('--asyncio', action='store_true', help='benchmark the asyncio mode')
+    parser.add_argument('--topics', type=int, default=50, help='retained state topics')
+    parser.add_argument('--updates', type=int, default=100, help='updates per state topic')
+    parser.add_argument('--events', type=int, default=500, help='events published')
+    parser.add_argument('--buffer', type=int, default=100, help='[mqtt] offline_buffer')
+    args = parser.parse_args()
+
+    brokers = [mqttbroker.Broker()]
+    port = brokers[0].start()
+    simcec.BUS = simcec.SimBus(seed=1)
+    subscriber = Subscriber(port)
+
+    config = copy.deepcopy(bridge.DEFAULT_CONFIGURATION)
+    config['mqtt'].update(port=port, retry_min='1', retry_max='1',
+                          offline_buffer=str(args.buffer))
+    config['cec'].update(enabled=1, backend='sim', cache_file='', refresh='0', devices='0')
+    config['metrics']['interval'] = '0'
+
+    if args.asyncio:
+        the_bridge = aio.AsyncBridge(config)
+        threading.Thread(target=run_outage, name='bench', daemon=True,
+                         args=(args, the_bridge, subscriber, brokers, the_bridge.stop)).start()
+        asyncio.run(the_bridge.run())
+    else:
+        the_bridge = bridge.Bridge(config)
+        the_bridge.start()
+        run_outage(args, the_bridge, subscriber, brokers, lambda: None)
+        the_bridge.cleanup()
+
+    subscriber.client.loop_stop()
+    brokers[-1].stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Microbenchmark of the CEC RX path
+
+Replays captured libcec frames through HdmiCec._on_command_callback on an
+adapter of the simulated CEC bus that is never opened, libcec is not needed.
+
+    PYTHONPATH=src python3 benchmarks/bench_rx_callback.py -n 300000
+"""
+import argparse
+import itertools
+import threading
+import time
+import types
+
+from cec_mqtt_bridge import hdmicec
+from cec_mqtt_bridge import rxstream
+from cec_mqtt_bridge import simcec
+
+# Frames captured from a TV, an AVR and a player, as passed by libcec
+CAPTURED_FRAMES = [
+    '>> 0f:87:00:00:f0',
+    '>> 5f:72:01',
+    '>> 51:7a:1e',
+    '>> 01:90:00',
+    '>> 51:90:00',
+    '>> 4f:82:10:00',
+    '>> 0f:80:00:00:10:00',
+    '>> 4f:84:10:00:04',
+    '>> 01:47:54:56',
+    '>> 0f:32:65:6e:67',
+    '>> 10:8f',
+    '>> 01:44:41',
+    '>> 01:45',
+    '>> 15:71',
+    '>> 05',
+]
+
+
+def rx_only_cec(published: list) -> hdmicec.HdmiCec:
+    """HdmiCec with just the state used by the RX path"""
+    cec = hdmicec.HdmiCec.__new__(hdmicec.HdmiCec)
+    cec.cec_client = simcec.ICECAdapter.Create(simcec.libcec_configuration())
+    cec.volume_correction = 1
+    cec._mqtt_send = lambda topic, message, **_kwargs: published.append(topic)  # pylint: disable=protected-access
+    cec._updated = {}  # pylint: disable=protected-access
+    cec._active_source = None  # pylint: disable=protected-access
+    cec._poll_wakeup = threading.Event()  # pylint: disable=protected-access
+    cec.volume_controller = types.SimpleNamespace(reported=lambda volume: None)
+    cec.recorder = None
+    cec.rx_stream = rxstream.RxStream(cec._mqtt_send)  # pylint: disable=protected-access
+    cec._state_fields, cec._state_json = True, False  # pylint: disable=protected-access
+    cec.poll_schedule = hdmicec.PollSchedule(list(range(15)) + [hdmicec.AUDIO], 10, 2, 60, 300)
+    return cec
+
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(description='CEC RX callback microbenchmark')
+    parser.add_argument('-n', '--frames', type=int, default=300000)
+    args = parser.parse_args()
+
+    published = []
+    cec = rx_only_cec(published)
+    frames = list(itertools.islice(itertools.cycle(CAPTURED_FRAMES), args.frames))
+    callback = cec._on_command_callback  # pylint: disable=protected-access
+
+    start = time.perf_counter()
+    for frame in frames:
+        callback(frame)
+    elapsed = time.perf_counter() - start
+
+    print(f'{len(frames)} frames in {elapsed:.3f} s: {len(frames) / elapsed:,.0f} frames/s, '
+          f'{elapsed / len(frames) * 1e6:.2f} us/frame, {len(published)} publishes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Fake lircd for the benchmarks
+
+Serves the lircd RX socket, broadcasting simulated key presses, and the
+command socket, answering SEND_ONCE / SEND_START / SEND_STOP like lircd.
+"""
+import collections
+import os
+import socket
+import threading
+import time
+
+
+class FakeLircd:
+    """lircd RX and command sockets in a directory"""
+    def __init__(self, directory: str, latency: float = 0.0):
+        """
+        Args:
+            directory (str): directory for the 'lircd' and 'lircd-tx' sockets
+            latency (float, optional): seconds before a command is answered,
+                e.g. the IR transmit time. Defaults to 0.
+        """
+        self.rx_path = os.path.join(directory, 'lircd')
+        self.tx_path = os.path.join(directory, 'lircd-tx')
+        self.latency = latency
+        # (time.monotonic(), command) of every received command
+        self.commands = collections.deque(maxlen=100000)
+        self._rx_clients = []
+        self._lock = threading.Lock()
+        self._servers = []
+        for path, handler in ((self.rx_path, self._rx_client), (self.tx_path, self._tx_client)):
+            if os.path.exists(path):
+                os.unlink(path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen()
+            self._servers.append(server)
+            threading.Thread(target=self._accept, args=(server, handler),
+                             name='fakelircd', daemon=True).start()
+
+    def _accept(self, server: socket.socket, handler: callable):
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=handler, args=(client,), name='fakelircd',
+                             daemon=True).start()
+
+    def _rx_client(self, client: socket.socket):
+        with self._lock:
+            self._rx_clients.append(client)
+
+    def _tx_client(self, client: socket.socket):
+        with client, client.makefile('rb') as lines:
+            for line in lines:
+                command = line.decode().strip()
+                self.commands.append((time.monotonic(), command))
+                if self.latency:
+                    time.sleep(self.latency)
+                client.sendall(f'BEGIN\n{command}\nSUCCESS\nEND\n'.encode())
+
+    @property
+    def rx_connected(self) -> int:
+        """Number of connected RX clients"""
+        with self._lock:
+            return len(self._rx_clients)
+
+    def press(self, remote: str, key: str, repeats: int = 0, interval: float = 0.11):
+        """Broadcast a key press with repeats on the RX socket
+
+        Args:
+            remote (str): remote name
+            key (str): key name
+            repeats (int, optional): repeat lines after the press. Defaults to 0.
+            interval (float, optional): seconds between repeats. Defaults to 0.11.
+        """
+        for repeat in range(repeats + 1):
+            if repeat:
+                time.sleep(interval)
+            self.broadcast(f'0000000000000001 {repeat:02x} {key} {remote}')
+
+    def broadcast(self, line: str):
+        """Send a raw line to all RX clients"""
+        data = (line + '\n').encode()
+        with self._lock:
+            for client in list(self._rx_clients):
+                try:
+                    client.sendall(data)
+                except OSError:
+                    self._rx_clients.remove(client)
+
+    def close(self):
+        """Close all sockets."""
+        with self._lock:
+            for client in self._rx_clients:
+                client.close()
+            self._rx_clients = []
+        for server in self._servers:
+            server.close()
+        for path in (self.rx_path, self.tx_path):
+            if os.path.exists(path):
+                os.unlink(path)
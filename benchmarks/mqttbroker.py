@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Minimal in-process MQTT 3.1.1 broker for the benchmarks
+
+Supports what the bridge and the benchmark clients use: QoS 0 and 1
+publish, retained messages, subscriptions with '+' and '#' wildcards,
+last will messages and keepalive pings. Not a general purpose broker.
+"""
+import asyncio
+import struct
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """Whether a topic matches a subscription pattern"""
+    pattern_levels = pattern.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or level not in ('+', topic_levels[index]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def _remaining_length(length: int) -> bytes:
+    data = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        data.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(data)
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + _remaining_length(len(body)) + body
+
+
+class Broker:
+    """MQTT broker running an asyncio loop on its own thread"""
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.retained = {}
+        self.published = 0
+        self._clients = {}  # writer -> [subscription patterns]
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = None
+
+    def start(self) -> int:
+        """Start serving
+
+        Returns:
+            int: port the broker listens on
+        """
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='mqtt-broker', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.port
+
+    def stop(self):
+        """Stop serving."""
+        def close():
+            self._server.close()
+            for writer in self._clients:
+                writer.close()
+            self._loop.stop()
+        self._loop.call_soon_threadsafe(close)
+        self._thread.join()
+
+    def _route(self, topic: str, payload: bytes, retain: bool):
+        self.published += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for writer, patterns in self._clients.items():
+            if any(topic_matches(pattern, topic) for pattern in patterns):
+                writer.write(self._publish_packet(topic, payload, False))
+
+    @staticmethod
+    def _publish_packet(topic: str, payload: bytes, retain: bool) -> bytes:
+        topic = topic.encode()
+        return _packet(PUBLISH, int(retain), struct.pack('!H', len(topic)) + topic + payload)
+
+    async def _read_packet(self, reader) -> tuple:
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0xF, await reader.readexactly(length)
+
+    @staticmethod
+    def _will(body: bytes):
+        """Last will (topic, payload, retain) of a CONNECT packet, or None"""
+        offset = 2 + struct.unpack('!H', body[:2])[0]  # protocol name
+        flags = body[offset + 1]
+        if not flags & 0x04:
+            return None
+        offset += 4  # level, flags, keepalive
+        fields = []
+        for _ in range(3):  # client id, will topic, will payload
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            fields.append(body[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        return fields[1].decode(), fields[2], bool(flags & 0x20)
+
+    async def _handle(self, reader, writer):
+        self._clients[writer] = []
+        will = None
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    will = self._will(body)
+                    writer.write(_packet(CONNACK, 0, b'\x00\x00'))
+                elif packet_type == PUBLISH:
+                    topic_length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if (flags >> 1) & 3:
+                        writer.write(_packet(PUBACK, 0, body[offset:offset + 2]))
+                        offset += 2
+                    self._route(topic, body[offset:], bool(flags & 1))
+                elif packet_type == SUBSCRIBE:
+                    offset, codes = 2, bytearray()
+                    while offset < len(body):
+                        length = struct.unpack('!H', body[offset:offset + 2])[0]
+                        pattern = body[offset + 2:offset + 2 + length].decode()
+                        self._clients[writer].append(pattern)
+                        codes.append(min(body[offset + 2 + length], 1))
+                        offset += 3 + length
+                        for topic, payload in self.retained.items():
+                            if topic_matches(pattern, topic):
+                                writer.write(self._publish_packet(topic, payload, True))
+                    writer.write(_packet(SUBACK, 0, body[:2] + bytes(codes)))
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    will = None
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+            if will:
+                self._route(*will)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""asyncio mode of the HDMI CEC MQTT bridge
+
+MQTT, the lircd receiver and all timers run on one event loop. Blocking
+libcec and lircd calls run on the single command executor thread, connecting
+to the broker (DNS and TCP) on the default executor of the loop. Messages
+published from libcec callbacks are queued and handed to paho on the loop.
+"""
+import asyncio
+import logging
+import math
+import random
+import signal
+import threading
+
+from cec_mqtt_bridge import bridge
+from cec_mqtt_bridge import lirc_if
+from cec_mqtt_bridge import lircd
+from cec_mqtt_bridge import publisher
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between paho housekeeping (keepalive) calls
+MQTT_MISC_INTERVAL = 1
+# Seconds to write the last messages and DISCONNECT when stopping
+MQTT_DRAIN_TIMEOUT = 5
+
+
+class _LoopEvent:
+    """threading.Event like setter of an asyncio.Event, callable from any thread"""
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, event: asyncio.Event = None):
+        self._loop = loop
+        self._event = event
+
+    def bind(self, loop: asyncio.AbstractEventLoop, event: asyncio.Event):
+        """Set event on loop from now on, before that set() does nothing."""
+        self._loop = loop
+        self._event = event
+
+    def set(self):
+        """Set the event on the loop thread."""
+        if self._loop is None:
+            return  # not running yet
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass  # loop closed on shutdown
+
+
+class AsyncBridge(bridge.Bridge):
+    """Bridge running on an asyncio event loop"""
+    def __init__(self, config: dict):
+        # Wakes _publish_task, used by create_publisher() during __init__
+        self._publish_wakeup = _LoopEvent()
+        super().__init__(self._one_worker(config))
+        self._loop = None
+        self._loop_thread = None
+        self._stopped = None
+        self._ir_receiver = None
+
+    @staticmethod
+    def _one_worker(config: dict) -> dict:
+        # One executor thread for all blocking libcec and lircd calls
+        return dict(config, mqtt=dict(config['mqtt'], workers=1))
+
+    def request_reload(self):
+        """Reload the configuration on the loop, called on SIGHUP"""
+        self._in_loop(self.reload)
+
+    def reload(self, config: dict = None):
+        """Apply a changed configuration, see Bridge.reload()"""
+        if config is None and self.config_loader is not None:
+            config = self.config_loader()
+        super().reload(None if config is None else self._one_worker(config))
+
+    def reconnect_ir(self):
+        """Restart the lircd receiver task on the changed RX socket"""
+        def restart():
+            if self._ir_receiver:
+                self._ir_receiver.cancel()
+                self._ir_receiver = asyncio.create_task(self._ir_task())
+        self._in_loop(restart)
+
+    def _in_loop(self, func: callable, *args):
+        """Call func on the loop thread, directly if already there"""
+        if self._loop is None or threading.get_ident() == self._loop_thread:
+            func(*args)
+            return
+        try:
+            self._loop.call_soon_threadsafe(func, *args)
+        except RuntimeError:
+            LOGGER.debug('Event loop closed, dropping %s', func)
+
+    def create_publisher(self) -> publisher.Publisher:
+        """Outbound queue flushed by _publish_task on the loop"""
+        return publisher.Publisher(
+            self._client_publish, self.mqtt_client.is_connected,
+            events=int(self.config['mqtt']['offline_buffer']),
+            window=int(self.config['mqtt']['publish_window']),
+            thread=False, wakeup=self._publish_wakeup)
+
+    def _device_call(self, target: str, func: callable, *args, **kwargs) -> asyncio.Future:
+        """Run a blocking call on the command executor thread
+
+        Args:
+            target (str): executor target, calls on the same target run in order
+            func (callable): blocking function
+
+        Returns:
+            asyncio.Future: result of func
+        """
+        future = self._loop.create_future()
+
+        def set_result(result):
+            if not future.done():
+                future.set_result(result)
+
+        def set_exception(err):
+            if not future.done():
+                future.set_exception(err)
+
+        def call():
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:  # pylint: disable=broad-except
+                self._in_loop(set_exception, err)
+                return
+            self._in_loop(set_result, result)
+
+        if not self.executor.submit(target, call):
+            future.set_exception(RuntimeError(f'Command queue {target} full'))
+        return future
+
+    def _setup_mqtt_sockets(self):
+        """Let the event loop drive the paho client instead of its own thread"""
+        client = self.mqtt_client
+        loop = self._loop
+        client.on_socket_open = \
+            lambda _c, _u, sock: self._in_loop(loop.add_reader, sock, client.loop_read)
+        client.on_socket_close = \
+            lambda _c, _u, sock: self._in_loop(loop.remove_reader, sock)
+        client.on_socket_register_write = \
+            lambda _c, _u, sock: self._in_loop(loop.add_writer, sock, client.loop_write)
+        client.on_socket_unregister_write = \
+            lambda _c, _u, sock: self._in_loop(loop.remove_writer, sock)
+
+    async def _mqtt_task(self):
+        """Keep the broker connection up, retrying with jittered exponential backoff"""
+        client = self.mqtt_client
+        retry_min = int(self.config['mqtt']['retry_min'])
+        retry_max = int(self.config['mqtt']['retry_max'])
+        delay = retry_min
+        while True:
+            if client.socket() is None:
+                try:
+                    # Connecting blocks on DNS and TCP, keep it off the loop and
+                    # the command thread. Only one connect runs at a time, the
+                    # default executor starts a single thread for it.
+                    await self._loop.run_in_executor(None, client.reconnect)
+                    delay = retry_min
+                except OSError as err:
+                    LOGGER.error("Connecting to MQTT broker %s failed: %s",
+                                 self.config['mqtt']['broker'], err)
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                    delay = min(delay * 2, retry_max)
+                    continue
+            client.loop_misc()
+            await asyncio.sleep(MQTT_MISC_INTERVAL)
+
+    async def _publish_task(self):
+        """Hand queued messages to paho, waiting for it to write a full window"""
+        wakeup = asyncio.Event()
+        self._publish_wakeup.bind(self._loop, wakeup)
+        while True:
+            # Messages may have been queued before the task started
+            while self.publisher.flush():
+                await asyncio.sleep(0.01)
+            await wakeup.wait()
+            wakeup.clear()
+
+    async def _republish_task(self, interval: float):
+        """Periodically republish all retained state"""
+        while True:
+            await asyncio.sleep(interval)
+            self.mqtt_republish()
+
+    async def _stats_task(self, interval: float):
+        """Periodically publish the metrics"""
+        while True:
+            await asyncio.sleep(interval)
+            self.mqtt_publish_stats()
+
+    async def _ir_task(self):
+        """Receive IR remote key presses from the lircd socket"""
+        path = self.config['ir']['rx_sock_path'] or lircd.DEFAULT_SOCKET
+        delay = 1
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except OSError as err:
+                LOGGER.warning("Can't connect to lircd %s: %s, retrying in %d seconds",
+                               path, err, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+            LOGGER.info("Connected to lircd %s", path)
+            delay = 1
+            try:
+                while True:
+                    try:
+                        line = await asyncio.wait_for(reader.readline(),
+                                                      self.ir_class.ir_release_timeout())
+                    except asyncio.TimeoutError:
+                        self.ir_class.ir_check_release()
+                        continue
+                    if not line:
+                        LOGGER.warning("lircd closed the RX connection")
+                        break
+                    self.ir_class.ir_receive(line.decode(errors='replace').strip())
+            except OSError as err:
+                LOGGER.warning("lircd RX connection failed: %s", err)
+            finally:
+                writer.close()
+                self.ir_class.ir_check_release(force=True)
+
+    async def _cec_task(self, namespace: str):
+        """Open a CEC adapter, then poll devices when their schedule is due"""
+        LOGGER.info("Initialising CEC %s...", namespace)
+        poll_wakeup = asyncio.Event()
+        try:
+            cec_class = await self._device_call(
+                f'{namespace}/bus', self.create_cec, namespace, threads=False,
+                poll_wakeup=_LoopEvent(self._loop, poll_wakeup))
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Initialising CEC %s failed", namespace)
+            self._stopped.set()
+            return
+        self.cec_adapters[namespace] = cec_class
+        cec_class.register_routes(self.router)
+        self.mqtt_subscribe()
+        self.apply_polling(cec_class, self.cec_polling())
+
+        # Refresh may be enabled later by reload(), the schedule is idle until then
+        schedule = cec_class.poll_schedule
+        while True:
+            timeout = schedule.next_due() if cec_class.polling else math.inf
+            try:
+                await asyncio.wait_for(poll_wakeup.wait(),
+                                       None if math.isinf(timeout) else timeout)
+            except asyncio.TimeoutError:
+                pass
+            poll_wakeup.clear()
+            try:
+                await self._device_call(cec_class.bus_target, cec_class.poll_due)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('CEC refresh failed')
+
+    async def _drain_mqtt(self):
+        """Write the messages queued by cleanup() and the DISCONNECT
+
+        paho only writes when the loop calls loop_write(), it closes the
+        socket after writing the DISCONNECT.
+        """
+        client = self.mqtt_client
+        deadline = self._loop.time() + MQTT_DRAIN_TIMEOUT
+        while client.socket() is not None and client.want_write():
+            if self._loop.time() > deadline:
+                LOGGER.warning("MQTT broker too slow, not all messages written")
+                break
+            client.loop_write()
+            await asyncio.sleep(0.01)
+
+    def stop(self):
+        """Stop run(), may be called from any thread"""
+        self._in_loop(self._stopped.set)
+
+    async def run(self):
+        """Run the bridge until SIGINT or SIGTERM"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self._loop.add_signal_handler(signum, self._stopped.set)
+        self._loop.add_signal_handler(signal.SIGHUP, self.request_reload)
+
+        self._setup_mqtt_sockets()
+        self.mqtt_client.connect_async(self.config['mqtt']['broker'],
+                                       int(self.config['mqtt']['port']), 60)
+        tasks = [asyncio.create_task(self._mqtt_task()),
+                 asyncio.create_task(self._publish_task())]
+
+        republish = int(self.config['mqtt']['republish'])
+        if republish > 0:
+            tasks.append(asyncio.create_task(self._republish_task(republish * 60)))
+
+        stats_interval = int(self.config['metrics']['interval'])
+        if stats_interval > 0:
+            tasks.append(asyncio.create_task(self._stats_task(stats_interval)))
+        self.start_metrics_server()
+
+        if int(self.config['cec']['enabled']) == 1:
+            for namespace in self.cec_configs:
+                tasks.append(asyncio.create_task(self._cec_task(namespace)))
+
+        if int(self.config['ir']['enabled']) == 1:
+            self.ir_class = lirc_if.Lirc(self.mqtt_publish, self.config['ir'], listen=False,
+                                         recorder=self.recorder, on_key=self.bindings.key)
+            self.ir_class.register_routes(self.router)
+            self.mqtt_subscribe()
+            self._ir_receiver = asyncio.create_task(self._ir_task())
+
+        try:
+            await self._stopped.wait()
+        finally:
+            if self._ir_receiver:
+                tasks.append(self._ir_receiver)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Queues the offline status and the DISCONNECT, the loop writes them
+            self.cleanup()
+            await self._drain_mqtt()
+
+
+def run(config: dict, config_loader: callable = None):
+    """Run the bridge on an asyncio event loop
+
+    Args:
+        config (dict): bridge configuration
+        config_loader (callable, optional): reads the configuration again on
+            SIGHUP. Defaults to None.
+    """
+    bridge = AsyncBridge(config)
+    bridge.config_loader = config_loader
+    asyncio.run(bridge.run())
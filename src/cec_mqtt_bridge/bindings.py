@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Local IR key bindings of the HDMI CEC MQTT bridge
+
+The [bindings] section maps IR remote keys to bridge commands, which run on
+the command executor like the same command received from MQTT, without the
+round trip through the broker and a home automation rule. The key events
+are still published on ir/<remote>/... as usual.
+
+    [bindings]
+    mceusb KEY_VOLUMEUP = cec/audio/volume/set up
+    mceusb KEY_VOLUMEUP hold = cec/audio/volume/set up
+    mceusb KEY_POWER = cec/tx 10:04
+
+An option is '<remote> <key> [press|hold|release]', press if omitted, the
+value is the command topic without prefix and an optional payload.
+"""
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONFIGURATION = {}
+
+PRESS = 'press'
+HOLD = 'hold'
+RELEASE = 'release'
+EVENTS = (PRESS, HOLD, RELEASE)
+
+
+def parse_bindings(config: dict) -> dict:
+    """Parse the [bindings] section
+
+    configparser lowercases the options, remotes and keys are matched
+    case-insensitively.
+
+    Args:
+        config (dict): option -> command
+
+    Returns:
+        dict: (remote, key, event) -> (topic, payload), all lowercase but the payload
+    """
+    bindings = {}
+    for option, command in config.items():
+        levels = option.lower().split()
+        if len(levels) == 2:
+            levels.append(PRESS)
+        topic, _, payload = str(command).strip().partition(' ')
+        if len(levels) != 3 or levels[2] not in EVENTS or not topic:
+            LOGGER.warning("Ignoring invalid binding %s = %s", option, command)
+            continue
+        bindings[tuple(levels)] = (topic, payload.strip())
+    return bindings
+
+
+class Bindings:
+    """Runs the bridge command bound to an IR key event"""
+    def __init__(self, config: dict, submit: callable):
+        """
+        Args:
+            config (dict): [bindings] section
+            submit (callable): called with the command topic (without prefix)
+                and payload, returns False for an unknown topic
+        """
+        self._submit = submit
+        self._lock = threading.Lock()
+        self._bindings = {}
+        self.configure(config)
+
+        self.fired = 0
+        self.failed = 0
+
+    def configure(self, config: dict):
+        """Replace the bindings, see __init__"""
+        bindings = parse_bindings(config)
+        with self._lock:
+            self._bindings = bindings
+        if bindings:
+            LOGGER.info("%d key bindings", len(bindings))
+
+    def key(self, remote: str, key: str, event: str) -> bool:
+        """Run the command bound to a key event
+
+        Args:
+            remote (str): lircd remote name
+            key (str): lircd key name
+            event (str): PRESS, HOLD or RELEASE
+
+        Returns:
+            bool: a command was submitted
+        """
+        with self._lock:
+            command = self._bindings.get((remote.lower(), key.lower(), event))
+        if command is None:
+            return False
+        if not self._submit(*command):
+            LOGGER.warning("Binding %s %s %s: unknown command topic %s",
+                           remote, key, event, command[0])
+            self.failed += 1
+            return False
+        self.fired += 1
+        return True
+
+    def stats(self) -> dict:
+        """Number of bindings and submitted commands"""
+        with self._lock:
+            return {'bindings': len(self._bindings), 'fired': self.fired,
+                    'failed': self.failed}
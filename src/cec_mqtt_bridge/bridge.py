@@ -4,21 +4,37 @@
 
 Raises:
     ValueError: Invalid config value
-    ConnectionError: Failed to connect to MQTT brocker
 """
 import configparser as ConfigParser
+import copy
+import json
 import logging
 import os
+import random
+import signal
 import threading
 import time
 import argparse
 import paho.mqtt.client as mqtt
 
+from cec_mqtt_bridge import bindings
+from cec_mqtt_bridge import executor
 from cec_mqtt_bridge import hdmicec
+from cec_mqtt_bridge import keystream
+from cec_mqtt_bridge import lease
 from cec_mqtt_bridge import lirc_if
+from cec_mqtt_bridge import metrics
+from cec_mqtt_bridge import publisher
+from cec_mqtt_bridge import recorder
+from cec_mqtt_bridge import router
+from cec_mqtt_bridge import rxstream
+from cec_mqtt_bridge import statecache
 
 LOGGER = logging.getLogger('bridge')
 
+PUBLISHED = metrics.REGISTRY.counter('mqtt_published', 'MQTT messages published')
+COMMANDS = metrics.REGISTRY.counter('mqtt_commands', 'MQTT commands received')
+
 # Default configuration
 DEFAULT_CONFIGURATION = {
     'mqtt': {
@@ -29,12 +45,73 @@ DEFAULT_CONFIGURATION = {
         'user': '',
         'password': '',
         'tls': 0,
+        'workers': 2,
+        'queue_depth': 64,
+        'queue_policy': executor.POLICY_MERGE,
+        'republish': 0,
+        'retry_min': 1,
+        'retry_max': 60,
+        'offline_buffer': 100,
+        'publish_window': 100,
+        'instance': '',
+        'lease_grace': 2,
     },
     'cec': hdmicec.DEFAULT_CONFIGURATION,
     'ir': lirc_if.DEFAULT_CONFIGURATION,
+    'metrics': metrics.DEFAULT_CONFIGURATION,
+    'record': recorder.DEFAULT_CONFIGURATION,
+    'bindings': bindings.DEFAULT_CONFIGURATION,
+}
+
+# Settings reload() applies while running, changing others needs a restart
+RELOADABLE = {
+    'mqtt': ('prefix', 'retry_min', 'retry_max', 'offline_buffer'),
+    'cec': ('devices', 'refresh', 'refresh_fast', 'refresh_max', 'refresh_absent',
+            'log_levels', 'tx_retries', 'tx_retry_budget', 'rx_retain', 'rx_opcodes',
+            'rx_initiators', 'rx_rate', 'rx_burst', 'rx_batch', 'rx_history', 'key_hold'),
+    'ir': ('rx_sock_path', 'tx_sock_path', 'hold_repeat', 'release_timeout'),
 }
 
 
+def diff_config(old: dict, new: dict) -> set:
+    """Settings that differ between two configurations
+
+    Args:
+        old (dict): configuration
+        new (dict): configuration
+
+    Returns:
+        set[tuple[str, str]]: section and key of every changed setting
+    """
+    changed = set()
+    for section in set(old) | set(new):
+        old_section, new_section = old.get(section, {}), new.get(section, {})
+        for key in set(old_section) | set(new_section):
+            if str(old_section.get(key)) != str(new_section.get(key)):
+                changed.add((section, key))
+    return changed
+
+
+def reloadable_config(old: dict, new: dict) -> dict:
+    """Running configuration with the reloadable settings of a new one
+
+    Args:
+        old (dict): running configuration
+        new (dict): configuration read again
+
+    Returns:
+        dict: old with the RELOADABLE keys and the [bindings] section of new,
+            settings that need a restart keep their running values
+    """
+    config = copy.deepcopy(old)
+    config['bindings'] = dict(new.get('bindings', {}))
+    for section, values in config.items():
+        for key in RELOADABLE.get(section.split('.')[0], ()):
+            if key in new.get(section, {}):
+                values[key] = new[section][key]
+    return config
+
+
 class Bridge:
     """Main bridge class"""
     def __init__(self, config: dict):
@@ -44,63 +121,372 @@ class Bridge:
         if (int(self.config['cec']['enabled']) != 1) and \
                 (int(self.config['ir']['enabled']) != 1):
             raise ValueError('IR and CEC are both disabled. Can\'t continue.')
-
-        def mqtt_on_message(client: mqtt, userdata, message):
-            """Run mqtt callback in a seperate thread."""
-            thread = threading.Thread(
-                target=self.mqtt_on_message, args=(client, userdata, message))
-            thread.start()
+        self.cec_configs = self.cec_adapter_configs()
+
+        self.stop_event = threading.Event()
+        self.state_cache = statecache.StateCache()
+
+        self.executor = executor.CommandExecutor(
+            workers=int(self.config['mqtt']['workers']),
+            queue_depth=int(self.config['mqtt']['queue_depth']),
+            policy=self.config['mqtt']['queue_policy'])
+        self.router = router.TopicRouter(self.config['mqtt']['prefix'])
+        metrics.REGISTRY.collector('executor', self.executor.stats)
+        metrics.REGISTRY.collector('router', self.router.stats)
+        metrics.REGISTRY.collector('state_cache', lambda: {
+            'suppressed': self.state_cache.suppressed})
+        # IR keys bound to commands, run without the MQTT round trip
+        self.bindings = bindings.Bindings(self.config['bindings'], self.run_binding)
+        metrics.REGISTRY.collector('bindings', self.bindings.stats)
+        self.metrics_server = None
+        # Traffic log of received CEC frames, IR lines and MQTT commands
+        self.recorder = None
+        if self.config['record']['file']:
+            self.recorder = recorder.Recorder(self.config['record']['file'])
 
         # Setup MQTT
         LOGGER.info("Initialising MQTT...")
         self.mqtt_client = mqtt.Client(self.config['mqtt']['name'])
         self.mqtt_client.on_connect = self.mqtt_on_connect
-        self.mqtt_client.on_message = mqtt_on_message
+        self.mqtt_client.on_message = self.mqtt_on_message
+        # Outbound queue, publishing never blocks on a slow or lost broker
+        self.publisher = self.create_publisher()
+        metrics.REGISTRY.collector('publisher', self.publisher.stats)
         if self.config['mqtt']['user']:
             self.mqtt_client.username_pw_set(
                 self.config['mqtt']['user'],
                 password=self.config['mqtt']['password'])
         if int(self.config['mqtt']['tls']) == 1:
             self.mqtt_client.tls_set()
+
+        # Bridges sharing a CEC bus elect one instance to poll it
+        self.lease = None
+        if self.config['mqtt']['instance']:
+            self.lease = lease.PollLease(self.config['mqtt']['instance'], self.on_lease_change,
+                                         self.mqtt_publish,
+                                         float(self.config['mqtt']['lease_grace']))
+            self.lease.register_routes(self.router)
+            metrics.REGISTRY.collector('lease', self.lease.stats)
+            self.mqtt_client.on_disconnect = self.mqtt_on_disconnect
         self.mqtt_client.will_set(
             self.config['mqtt']['prefix'] + '/bridge/status', 'offline', qos=1,
             retain=True)
 
-        tries = 30
-        while tries > 0:
-            tries -= 1
+        self.cec_adapters = {}  # topic namespace -> HdmiCec
+        self.ir_class = None
+        # Reads the configuration again on SIGHUP, see reload()
+        self.config_loader = None
+
+    def create_publisher(self) -> publisher.Publisher:
+        """Outbound queue in front of the MQTT client, flushed on its own thread"""
+        return publisher.Publisher(
+            self._client_publish, self.mqtt_client.is_connected,
+            events=int(self.config['mqtt']['offline_buffer']),
+            window=int(self.config['mqtt']['publish_window']))
+
+    @property
+    def cec_class(self) -> hdmicec.HdmiCec:
+        """The CEC adapter that opened first, None while none is open"""
+        return next(iter(self.cec_adapters.values()), None)
+
+    def start(self):
+        """Connect to MQTT and start CEC and IR"""
+        # Connect in the background, CEC and IR start at the same time
+        self.mqtt_client.connect_async(self.config['mqtt']['broker'],
+                                       int(self.config['mqtt']['port']), 60)
+        self.mqtt_client.reconnect_delay_set(
+            min_delay=int(self.config['mqtt']['retry_min']),
+            max_delay=int(self.config['mqtt']['retry_max']))
+        threading.Thread(target=self.mqtt_connect_thread, name='mqtt-connect',
+                         daemon=True).start()
+
+        republish = int(self.config['mqtt']['republish'])
+        if republish > 0:
+            threading.Thread(target=self.mqtt_republish_thread, args=(republish * 60,),
+                             daemon=True).start()
+
+        stats_interval = int(self.config['metrics']['interval'])
+        if stats_interval > 0:
+            threading.Thread(target=self.mqtt_stats_thread, args=(stats_interval,),
+                             name='stats', daemon=True).start()
+        self.start_metrics_server()
+
+        # Setup HDMI-CEC
+        if int(self.config['cec']['enabled']) == 1:
+            for namespace in self.cec_configs:
+                threading.Thread(target=self.cec_init_thread, args=(namespace,),
+                                 name='cec-init', daemon=True).start()
+
+        # Setup IR
+        if int(self.config['ir']['enabled']) == 1:
+            LOGGER.info("Initialising IR...")
+            self.ir_class = lirc_if.Lirc(self.mqtt_publish, self.config['ir'],
+                                         recorder=self.recorder, on_key=self.bindings.key)
+            self.ir_class.register_routes(self.router)
+            self.mqtt_subscribe()
+
+    def mqtt_connect_thread(self):
+        """Connect to the MQTT broker, retrying with jittered exponential backoff"""
+        delay = int(self.config['mqtt']['retry_min'])
+        while not self.stop_event.is_set():
             try:
-                self.mqtt_client.connect(self.config['mqtt']['broker'],
-                                         int(self.config['mqtt']['port']), 60)
+                self.mqtt_client.reconnect()
                 break
-            except ConnectionRefusedError:
-                LOGGER.error("Connection was refused by the server")
             except OSError as err:
-                LOGGER.error("OS error: %s", str(err))
-
-            if tries > 0:
-                LOGGER.debug("Retrying in 10 seconds... (%d tries left)", tries)
-                time.sleep(10)
+                LOGGER.error("Connecting to MQTT broker %s failed: %s",
+                             self.config['mqtt']['broker'], err)
+            wait = delay * random.uniform(0.5, 1.5)
+            LOGGER.debug("Retrying in %.1f seconds...", wait)
+            if self.stop_event.wait(wait):
+                return
+            delay = min(delay * 2, int(self.config['mqtt']['retry_max']))
         else:
-            LOGGER.error("Failed to connect to the MQTT broker after multiple attempts")
-            raise ConnectionError('MQTT connect retries exhausted. Can\'t continue.')
+            return
 
+        # paho reconnects by itself from now on
         self.mqtt_client.loop_start()
 
-        # Setup HDMI-CEC
-        if int(self.config['cec']['enabled']) == 1:
-            LOGGER.info("Initialising CEC...")
-            self.cec_class = hdmicec.HdmiCec(
-                port=self.config['cec']['port'],
-                name=self.config['cec']['name'],
-                devices=[
-                    int(x) for x in self.config['cec']['devices'].split(',')],
-                mqtt_send=self.mqtt_publish)
+    def cec_init_thread(self, namespace: str = hdmicec.NAMESPACE):
+        """Open a CEC adapter and register its commands
 
-        # Setup IR
-        if int(self.config['ir']['enabled']) == 1:
-            LOGGER.info("Initialising IR...")
-            self.ir_class = lirc_if.Lirc(self.mqtt_publish, self.config['ir'])
+        Args:
+            namespace (str, optional): topic namespace of the adapter.
+                Defaults to hdmicec.NAMESPACE.
+        """
+        LOGGER.info("Initialising CEC %s...", namespace)
+        try:
+            cec_class = self.create_cec(namespace)
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Initialising CEC %s failed", namespace)
+            self.stop_event.set()
+            return
+        self.cec_adapters[namespace] = cec_class
+        cec_class.register_routes(self.router)
+        self.mqtt_subscribe()
+        # The lease may have changed while the adapter opened
+        self.apply_polling(cec_class, self.cec_polling())
+
+    def cec_polling(self) -> bool:
+        """Whether this bridge polls the CEC bus"""
+        return self.lease is None or self.lease.owner
+
+    def apply_polling(self, cec_class: hdmicec.HdmiCec, polling: bool):
+        """Start or stop polling a CEC adapter, scans the bus when it was
+        never scanned
+
+        Args:
+            cec_class (HdmiCec): CEC interface
+            polling (bool): poll the bus
+        """
+        cec_class.set_polling(polling)
+        if polling and not cec_class.scanned:
+            self.executor.submit(cec_class.bus_target, cec_class.scan, merge_key='scan')
+
+    def on_lease_change(self, owner: bool):
+        """Poll lease taken or lost
+
+        Args:
+            owner (bool): this bridge owns the lease
+        """
+        for cec_class in list(self.cec_adapters.values()):
+            self.apply_polling(cec_class, owner)
+        if owner:
+            self.mqtt_publish('bridge/lease', self.lease.instance, qos=1, retain=True, state=True)
+
+    def cec_adapter_configs(self) -> dict:
+        """Configuration of every CEC adapter
+
+        [cec] adapters lists name:port pairs, a [cec.<name>] section overrides
+        the [cec] settings of one adapter. Without adapters a single adapter
+        on [cec] port publishes to cec/.
+
+        Raises:
+            ValueError: Invalid adapter name
+
+        Returns:
+            dict: topic namespace -> adapter configuration
+        """
+        adapters = {}
+        for adapter in self.config['cec']['adapters'].split(','):
+            name, _, port = adapter.strip().partition(':')
+            if not name:
+                continue
+            if not name.isidentifier() or name in hdmicec.TOPIC_LEVELS:
+                raise ValueError(f"Invalid CEC adapter name: {name}")
+            config = dict(self.config['cec'], port=port)
+            if config['cache_file']:
+                # Each adapter caches its own topology
+                base, ext = os.path.splitext(config['cache_file'])
+                config['cache_file'] = f'{base}-{name}{ext}'
+            config.update(self.config.get(f'cec.{name}', {}))
+            adapters[f'{hdmicec.NAMESPACE}/{name}'] = config
+        return adapters or {hdmicec.NAMESPACE: self.config['cec']}
+
+    def create_cec(self, namespace: str = hdmicec.NAMESPACE, **kwargs) -> hdmicec.HdmiCec:
+        """Open a CEC adapter with the bridge configuration
+
+        Args:
+            namespace (str, optional): topic namespace of the adapter.
+                Defaults to hdmicec.NAMESPACE.
+            **kwargs: additional HdmiCec arguments
+
+        Returns:
+            HdmiCec: CEC interface
+        """
+        config = self.cec_configs[namespace]
+        mqtt_send = hdmicec.namespaced(self.mqtt_publish, namespace)
+        return hdmicec.HdmiCec(
+            port=config['port'],
+            name=config['name'],
+            devices=[
+                int(x) for x in config['devices'].split(',')],
+            mqtt_send=mqtt_send,
+            refresh=self.refresh_delay(config),
+            refresh_fast=int(config['refresh_fast']),
+            refresh_max=int(config['refresh_max']),
+            refresh_absent=int(config['refresh_absent']),
+            log_mask=hdmicec.parse_log_levels(config['log_levels']),
+            tx_retries=int(config['tx_retries']),
+            tx_retry_budget=int(config['tx_retry_budget']),
+            cache_file=config['cache_file'],
+            backend=config['backend'],
+            recorder=self.recorder,
+            state_format=config['state_format'],
+            rx_stream=rxstream.RxStream(mqtt_send, **self.rx_stream_options(config)),
+            namespace=namespace,
+            polling=self.cec_polling(),
+            key_stream=keystream.KeyStream(mqtt_send, int(config['key_hold']) / 1000),
+            **kwargs)
+
+    def start_metrics_server(self):
+        """Serve the Prometheus endpoint if a metrics port is configured"""
+        port = int(self.config['metrics']['port'])
+        if port > 0:
+            try:
+                self.metrics_server = metrics.MetricsServer(
+                    self.config['metrics']['address'], port)
+            except OSError as err:
+                LOGGER.error("Can't serve metrics on port %d: %s", port, err)
+
+    @staticmethod
+    def rx_stream_options(config: dict) -> dict:
+        """RxStream arguments of an adapter configuration"""
+        return {
+            'retain': int(config['rx_retain']) == 1,
+            'opcodes': rxstream.parse_hex_list(config['rx_opcodes']),
+            'initiators': rxstream.parse_hex_list(config['rx_initiators']),
+            'rate': float(config['rx_rate']),
+            'burst': int(config['rx_burst']),
+            'batch': int(config['rx_batch']) / 1000,
+            'history': int(config['rx_history']),
+        }
+
+    def request_reload(self):
+        """Reload the configuration on a thread, called on SIGHUP"""
+        threading.Thread(target=self.reload, name='reload', daemon=True).start()
+
+    def reload(self, config: dict = None):
+        """Apply a changed configuration without reconnecting to MQTT or
+        reopening the CEC adapters
+
+        Only the changed settings in RELOADABLE and [bindings] are applied,
+        changes of other settings are logged and need a restart, they keep
+        their running values until then.
+
+        Args:
+            config (dict, optional): new configuration. Defaults to None (read
+                with config_loader).
+        """
+        try:
+            if config is None:
+                if self.config_loader is None:
+                    LOGGER.warning("No configuration to reload")
+                    return
+                config = self.config_loader()
+            changed = diff_config(self.config, config)
+            if not changed:
+                LOGGER.info("Configuration unchanged")
+                return
+            for section, key in sorted(changed):
+                if section != 'bindings' and \
+                        key not in RELOADABLE.get(section.split('.')[0], ()):
+                    LOGGER.warning("Changing [%s] %s needs a restart", section, key)
+
+            old_config, old_cec_configs = self.config, self.cec_configs
+            self.config = reloadable_config(old_config, config)
+            self.cec_configs = self.cec_adapter_configs()
+
+            self._reload_mqtt(old_config['mqtt'])
+            for namespace, cec_class in list(self.cec_adapters.items()):
+                self._reload_cec(cec_class, old_cec_configs[namespace],
+                                 self.cec_configs[namespace])
+            if any(section == 'bindings' for section, _ in changed):
+                self.bindings.configure(self.config['bindings'])
+            if self.ir_class and self.ir_class.reconfigure(self.config['ir']):
+                self.reconnect_ir()
+            LOGGER.info("Configuration reloaded")
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Reloading the configuration failed")
+
+    def _reload_mqtt(self, old: dict):
+        """Apply changed MQTT settings"""
+        new = self.config['mqtt']
+        if (old['retry_min'], old['retry_max']) != (new['retry_min'], new['retry_max']):
+            self.mqtt_client.reconnect_delay_set(min_delay=int(new['retry_min']),
+                                                 max_delay=int(new['retry_max']))
+        if int(old['offline_buffer']) != int(new['offline_buffer']):
+            self.publisher.configure(int(new['offline_buffer']))
+        if old['prefix'] != new['prefix']:
+            LOGGER.info("Moving topics from %s to %s, the LWT moves on the next restart",
+                        old['prefix'], new['prefix'])
+            subscriptions = self.router.subscriptions()
+            self.router.prefix = new['prefix']
+            if self.mqtt_client.is_connected():
+                if subscriptions:
+                    self.mqtt_client.unsubscribe([topic for topic, _ in subscriptions])
+                self.mqtt_subscribe()
+                self.mqtt_publish('bridge/status', 'online', qos=1, retain=True, force=True,
+                                  state=True)
+                if self.lease:
+                    self.mqtt_publish(self.lease.topic, 'online', qos=1, retain=True,
+                                      force=True, state=True)
+                self.mqtt_republish()
+
+    def _reload_cec(self, cec_class: hdmicec.HdmiCec, old: dict, new: dict):
+        """Apply changed settings of a CEC adapter"""
+        changed = {key for key in new if str(new[key]) != str(old.get(key))}
+        if 'devices' in changed:
+            added = cec_class.set_devices([int(x) for x in new['devices'].split(',')])
+            if added and cec_class.polling:
+                # Only the new devices, not a full scan
+                self.executor.submit(cec_class.bus_target, cec_class.scan, added)
+        if changed & {'refresh', 'refresh_fast', 'refresh_max', 'refresh_absent'}:
+            cec_class.set_refresh(self.refresh_delay(new), int(new['refresh_fast']),
+                                  int(new['refresh_max']), int(new['refresh_absent']))
+        if 'log_levels' in changed:
+            cec_class.set_log_mask(hdmicec.parse_log_levels(new['log_levels']))
+        if changed & {'tx_retries', 'tx_retry_budget'}:
+            cec_class.tx_queue.configure(int(new['tx_retries']), int(new['tx_retry_budget']))
+        if any(key.startswith('rx_') for key in changed):
+            cec_class.rx_stream.configure(**self.rx_stream_options(new))
+        if 'key_hold' in changed:
+            cec_class.key_stream.configure(int(new['key_hold']) / 1000)
+
+    def reconnect_ir(self):
+        """Reconnect to a changed lircd RX socket"""
+        self.ir_class.reconnect()
+
+    def refresh_delay(self, config: dict = None) -> int:
+        """CEC refresh delay in seconds, 0 disables refresh (min 10)
+
+        Args:
+            config (dict, optional): adapter configuration. Defaults to None ([cec]).
+        """
+        refresh_delay = int((config or self.config['cec'])['refresh'])
+        if 0 < refresh_delay < 10:
+            refresh_delay = 10
+        LOGGER.debug("refresh delay %d", refresh_delay)
+        return refresh_delay
 
     @staticmethod
     def load_config(filename='config.ini'):
@@ -112,14 +498,15 @@ class Bridge:
         Returns:
             dict: bridge configuration
         """
-        config = DEFAULT_CONFIGURATION
+        config = copy.deepcopy(DEFAULT_CONFIGURATION)
         LOGGER.info("Loading config %s", filename)
 
         # Load all sections and overwrite default configuration
         config_parser = ConfigParser.ConfigParser()
         if config_parser.read(filename):
             for section in config_parser.sections():
-                config[section].update(dict(config_parser.items(section)))
+                # [cec.<name>] sections are only known from [cec] adapters
+                config.setdefault(section, {}).update(dict(config_parser.items(section)))
 
         # Override with environment variables
         for section, key_values in config.items():
@@ -130,11 +517,11 @@ class Bridge:
 
         return config
 
-    def mqtt_on_connect(self, client: mqtt, _userdata, _flags, ret):
+    def mqtt_on_connect(self, _client: mqtt, _userdata, _flags, ret):
         """MQTT on connect callback
 
         Args:
-            client (mqtt): _description_
+            _client (mqtt): _description_
             _userdata (_type_): _description_
             _flags (_type_): _description_
             ret (_type_): _description_
@@ -144,132 +531,209 @@ class Bridge:
         else:
             LOGGER.error("Connection failed with code %d", ret)
 
-        # Subscribe to CEC commands
-        if int(self.config['cec']['enabled']) == 1:
-            client.subscribe([
-                (self.config['mqtt']['prefix'] + '/cec/device/+/power/set', 0),
-                (self.config['mqtt']['prefix'] + '/cec/audio/volume/set', 0),
-                (self.config['mqtt']['prefix'] + '/cec/audio/mute/set', 0),
-                (self.config['mqtt']['prefix'] + '/cec/tx', 0),
-                (self.config['mqtt']['prefix'] + '/cec/refresh', 0),
-                (self.config['mqtt']['prefix'] + '/cec/scan', 0)
-            ])
-
-        # Subscribe to IR commands
-        if int(self.config['ir']['enabled']) == 1:
-            client.subscribe([
-                (self.config['mqtt']['prefix'] + '/ir/+/tx', 0)
-            ])
+        # Subscribe to CEC and IR commands
+        self.mqtt_subscribe()
 
         # Publish birth message
-        self.mqtt_publish('bridge/status', 'online', qos=1, retain=True)
+        self.mqtt_publish('bridge/status', 'online', qos=1, retain=True, force=True,
+                          state=True)
+        if self.lease:
+            self.mqtt_publish(self.lease.topic, 'online', qos=1, retain=True, force=True,
+                              state=True)
+            self.lease.connected()
 
+        # Broker may have lost retained state while we were disconnected
+        self.mqtt_republish()
 
-    def mqtt_publish(self, topic, message=None, qos=0, retain=True):
+        # Events and state queued while we were disconnected
+        self.publisher.wake()
+
+    def mqtt_on_disconnect(self, _client: mqtt, _userdata, ret):
+        """MQTT on disconnect callback, gives up the poll lease
+
+        Args:
+            _client (mqtt): Not Used
+            _userdata (_type_): Not Used
+            ret (int): 0 if disconnect() was called
+        """
+        LOGGER.warning("Disconnected from MQTT broker (%d)", ret)
+        self.lease.disconnected()
+
+    def mqtt_publish(self, topic, message=None, qos=0, retain=True, force=False, state=False):
         """Publish a MQTT message prefixed with bridge prefix
 
+        State topics are only published when the payload changed and are
+        republished from the state cache, other messages are always
+        published. The message is queued, a newer payload of a retained
+        topic replaces it.
+
         Args:
             topic (str): The topic that the message should be published on
             message (_type_, optional): _description_. Defaults to None.
             qos (int, optional): _description_. Defaults to 0.
             retain (bool, optional): _description_. Defaults to True.
+            force (bool, optional): publish even if unchanged. Defaults to False.
+            state (bool, optional): retained state topic, e.g. a device power
+                status. Defaults to False (event, always published).
         """
+        if state and not self.state_cache.update(topic, message, qos) and not force:
+            return
+        self.publisher.put(self.config['mqtt']['prefix'] + '/' + topic, message, qos, retain,
+                           state)
+
+    def _client_publish(self, topic, message, qos, retain):
+        """Hand a queued message to paho, called by the publisher"""
         LOGGER.debug('Send to topic %s: %s', topic, message)
-        self.mqtt_client.publish(
-            self.config['mqtt']['prefix'] + '/' + topic, message, qos=qos,
-            retain=retain)
+        PUBLISHED.inc()
+        return self.mqtt_client.publish(topic, message, qos=qos, retain=retain)
+
+    def mqtt_republish(self):
+        """Publish all cached state topics again."""
+        items = self.state_cache.items()
+        LOGGER.debug('Republishing %d state topics', len(items))
+        for topic, message, qos in items:
+            self.publisher.put(self.config['mqtt']['prefix'] + '/' + topic, message, qos,
+                               state=True)
+
+    def mqtt_republish_thread(self, interval: float):
+        """Periodically republish all retained state
+
+        Args:
+            interval (float): seconds between republishing
+        """
+        while not self.stop_event.wait(interval):
+            self.mqtt_republish()
+
+    def mqtt_publish_stats(self):
+        """Publish all metrics as JSON on bridge/stats"""
+        self.mqtt_publish('bridge/stats', json.dumps(metrics.REGISTRY.snapshot()), retain=False)
+
+    def mqtt_stats_thread(self, interval: float):
+        """Periodically publish the metrics
+
+        Args:
+            interval (float): seconds between publishing
+        """
+        while not self.stop_event.wait(interval):
+            self.mqtt_publish_stats()
+
+    def mqtt_subscribe(self):
+        """Subscribe to all registered command topics, if connected"""
+        if not self.mqtt_client.is_connected():
+            return
+        subscriptions = self.router.subscriptions()
+        if subscriptions:
+            self.mqtt_client.subscribe(subscriptions)
 
     def mqtt_on_message(self, _client: mqtt, _userdata, message):
-        """Process message on subscibed MQTT topic
+        """Route message on subscibed MQTT topic to the command executor
+
+        Runs on the paho network thread, paho re-raises callback exceptions
+        and its thread would die, so none may escape.
 
         Args:
             _client (mqtt): Not Used
             _userdata (_type_): Not Used
             message (_type_): topic and payload
+        """
+        try:
+            if self.recorder:
+                self.recorder.record_mqtt(message.topic, message.payload)
+            try:
+                action = message.payload.decode()
+            except UnicodeDecodeError:
+                LOGGER.warning("Ignoring non UTF-8 payload on %s: %r",
+                               message.topic, message.payload[:32])
+                self.router.invalid += 1
+                return
+            if self.submit_command(message.topic, action, time.monotonic()):
+                COMMANDS.inc()
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception("Handling MQTT message on %s failed", message.topic)
+
+    def submit_command(self, topic: str, action: str, received: float) -> bool:
+        """Route a command to the command executor
 
-        Raises:
-            ValueError: _description_
-            ValueError: _description_
-            ValueError: _description_
+        Args:
+            topic (str): command topic including bridge prefix
+            action (str): payload
+            received (float): time.monotonic() when the command arrived
+
+        Returns:
+            bool: False if no route matches the topic
         """
-        # Decode topic and split off the prefix
-        topic = message.topic.replace(self.config['mqtt']['prefix'], '').split('/')[1:]
-        action = message.payload.decode()
-        LOGGER.debug("Command received: %s (%s)", topic, message.payload)
-
-        if topic[0] == 'cec':
-
-            if topic[1] == 'device':
-                device = int(topic[2])
-                if topic[3] == 'power':
-                    if action == 'on':
-                        self.cec_class.power_on(device)
-                    elif action == 'standby':
-                        self.cec_class.power_off(device)
-                    else:
-                        raise ValueError(f"Unknown power command: {topic} {action}")
-
-            elif topic[1] == 'audio':
-                if topic[2] == 'volume':
-                    if action == 'up':
-                        self.cec_class.volume_up()
-                    elif action == 'down':
-                        self.cec_class.volume_down()
-                    elif action.isdigit() and int(action) <= 100:
-                        self.cec_class.volume_set(int(action))
-                    else:
-                        raise ValueError(f"Unknown power command: {topic} {action}")
-
-                if topic[2] == 'mute':
-                    if action == 'on':
-                        self.cec_class.volume_mute()
-                    elif action == 'off':
-                        self.cec_class.volume_unmute()
-                    else:
-                        raise ValueError(f"Unknown power command: {topic} {action}")
-
-            elif topic[1] == 'tx':
-                commands = message.payload.decode().split(',')
-                for command in commands:
-                    self.cec_class.tx_command(command)
-
-            elif topic[1] == 'refresh':
-                self.cec_class.refresh()
-
-            elif topic[1] == 'scan':
-                self.cec_class.scan()
-
-        elif topic[0] == 'ir':
-            if topic[2] == 'tx':
-                self.ir_class.ir_send(topic[1], action)
+        route, args = self.router.match(topic)
+        if route is None:
+            LOGGER.debug("Unknown topic %s", topic)
+            return False
+
+        LOGGER.debug("Command received: %s %s (%s)", route.pattern, args, action)
+        self.executor.submit(route.executor_target(args, action), self.run_command,
+                             route.handler, received, *args, action,
+                             merge_key=topic if route.mergeable(action) else None)
+        return True
 
+    def run_binding(self, topic: str, action: str) -> bool:
+        """Submit the command of a key binding, see bindings.Bindings
+
+        Args:
+            topic (str): command topic without bridge prefix
+            action (str): payload
+
+        Returns:
+            bool: False if no route matches the topic
+        """
+        return self.submit_command(f'{self.router.prefix}/{topic}', action, time.monotonic())
+
+    @staticmethod
+    def run_command(handler: callable, received: float, *args):
+        """Execute a command handler on an executor worker
+
+        Args:
+            handler (callable): route handler
+            received (float): time.monotonic() when the command arrived
+            *args: handler arguments
+        """
+        metrics.command_received(received)
+        try:
+            handler(*args)
+        finally:
+            metrics.command_received(None)
 
     def cleanup(self):
         """Terminates the connection."""
-        if int(self.config['ir']['enabled']) == 1:
+        self.stop_event.set()
+        self.executor.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        for namespace, cec_class in self.cec_adapters.items():
+            LOGGER.info("Cleanup CEC %s...", namespace)
+            cec_class.stop()
+        if self.ir_class:
             LOGGER.info("Cleanup IR...")
-            self.ir_class.stop_event.set()
-            self.ir_class.lirc_thread.join()
+            self.ir_class.stop()
         self.mqtt_client.loop_stop()
-        self.mqtt_publish('bridge/status', 'offline', qos=1, retain=True)
+        if self.lease:
+            self.lease.stop()
+            self.mqtt_publish(self.lease.topic, 'offline', qos=1, retain=True, force=True,
+                              state=True)
+        if self.lease is None or not self.lease.others_online():
+            self.mqtt_publish('bridge/status', 'offline', qos=1, retain=True, force=True,
+                              state=True)
+        self.publisher.stop()
         self.mqtt_client.disconnect()
+        if self.recorder:
+            self.recorder.close()
 
-def main():
-    """main for cec_mqtt_bridge"""
-    parser = argparse.ArgumentParser(description='HDMI-CEC and IR to MQTT bridge')
-    parser.add_argument('-v', '--verbose', action='count', help="increase output verbosity")
-    parser.add_argument('-f', '--configfile')
-    parser.add_argument('-c', '--cec', action="store_true", help="enable CEC")
-    parser.add_argument('-i', '--ir', action="store_true", help="enable IR")
-    parser.add_argument('-t', '--refreshtime', type=int)
-
-    args = parser.parse_args()
-    log_level = logging.INFO
-    if args.verbose:
-        log_level = logging.DEBUG
+def read_config(args) -> dict:
+    """Bridge configuration from the config file and the command line
 
-    logging.basicConfig(level=log_level, format='%(asctime)s [%(name)s] %(funcName)s: %(message)s')
+    Args:
+        args (argparse.Namespace): command line arguments
 
+    Returns:
+        dict: bridge configuration
+    """
     if args.configfile:
         config_file = args.configfile
     elif os.path.isfile('/etc/cec-mqtt-bridge.ini'):
@@ -287,28 +751,101 @@ def main():
     if args.refreshtime is not None:
         config['cec']['refresh'] = str(args.refreshtime)
 
-    bridge = Bridge(config)
+    if args.record:
+        config['record']['file'] = args.record
 
-    refresh_delay = int(bridge.config['cec']['refresh'])
-    if 0 < refresh_delay < 10:
-        refresh_delay = 10
+    return config
 
-    LOGGER.debug("refresh delay %d", refresh_delay)
 
+def main():
+    """main for cec_mqtt_bridge"""
+    parser = argparse.ArgumentParser(description='HDMI-CEC and IR to MQTT bridge')
+    parser.add_argument('-v', '--verbose', action='count', help="increase output verbosity")
+    parser.add_argument('-f', '--configfile')
+    parser.add_argument('-c', '--cec', action="store_true", help="enable CEC")
+    parser.add_argument('-i', '--ir', action="store_true", help="enable IR")
+    parser.add_argument('-t', '--refreshtime', type=int)
+    parser.add_argument('-a', '--asyncio', action="store_true",
+                        help="run on an asyncio event loop instead of threads")
+    parser.add_argument('--record', metavar='FILE', help="record received traffic to FILE")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="replay a traffic log into the bridge and exit")
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help="replay speed factor, 0 replays as fast as possible")
+
+    args = parser.parse_args()
+    log_level = logging.INFO
+    if args.verbose:
+        log_level = logging.DEBUG
+
+    logging.basicConfig(level=log_level, format='%(asctime)s [%(name)s] %(funcName)s: %(message)s')
+
+    config = read_config(args)
+
+    if args.replay:
+        replay(config, args.replay, args.replay_speed)
+        return
+
+    if args.asyncio:
+        # Imported here, the threaded bridge doesn't need asyncio
+        from cec_mqtt_bridge import aio  # pylint: disable=import-outside-toplevel
+        aio.run(config, lambda: read_config(args))
+        return
+
+    bridge = Bridge(config)
+    bridge.config_loader = lambda: read_config(args)
+    bridge.start()
+
+    # CEC refresh runs on its own thread, keep the main thread free for signals
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: bridge.stop_event.set())
+    signal.signal(signal.SIGHUP, lambda _signum, _frame: bridge.request_reload())
     try:
-        while True:
-            # Refresh CEC state
-            if (int(bridge.config['cec']['enabled']) == 1) and bridge.cec_class and refresh_delay:
-                bridge.cec_class.refresh()
-                time.sleep(refresh_delay)
-            else:
-                time.sleep(3600)
+        while not bridge.stop_event.wait(3600):
+            pass
 
     except KeyboardInterrupt:
-        bridge.cleanup()
+        pass
 
     except RuntimeError:
-        bridge.cleanup()
+        pass
+
+    bridge.cleanup()
+
+
+def replay(config: dict, filename: str, speed: float):
+    """Start a bridge, feed it a traffic log and report the throughput
+
+    Args:
+        config (dict): bridge configuration
+        filename (str): traffic log
+        speed (float): replay speed factor, 0 replays as fast as possible
+    """
+    config['record']['file'] = ''  # don't record the replay
+    log = recorder.RecordLog(filename)
+    bridge = Bridge(config)
+    bridge.start()
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: bridge.stop_event.set())
+    # Wait for CEC, it opens in the background
+    while int(config['cec']['enabled']) == 1 and bridge.cec_class is None and \
+            not bridge.stop_event.wait(0.1):
+        pass
+
+    replayer = recorder.Replayer(bridge, log, speed)
+    try:
+        start = time.monotonic()
+        replayer.run(bridge.stop_event)
+        # Include the commands still queued on the executor
+        bridge.executor.join(30)
+        seconds = max(time.monotonic() - start, 1e-9)
+        replayed = sum(replayer.replayed.values())
+        LOGGER.info("Replayed %d records (%s) in %.3f s, %.0f records/s, %d skipped",
+                    replayed, ', '.join(f'{recorder.KIND_NAMES[kind]} {count}'
+                                        for kind, count in sorted(replayer.replayed.items())),
+                    seconds, replayed / seconds, replayer.skipped)
+    except KeyboardInterrupt:
+        pass
+    log.close()
+    bridge.cleanup()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Bounded command executor for the HDMI CEC MQTT bridge
+
+Commands are queued per target (CEC logical address, IR remote, ...) and
+executed by a small pool of worker threads. Commands for the same target are
+always executed one at a time in the order they were submitted.
+"""
+import collections
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Backpressure policies applied when the queue is full
+POLICY_DROP = 'drop'                # drop the new command
+POLICY_DROP_OLDEST = 'drop_oldest'  # drop the oldest pending command of the same target
+POLICY_MERGE = 'merge'              # replace a pending command with the same merge key
+POLICIES = (POLICY_DROP, POLICY_DROP_OLDEST, POLICY_MERGE)
+
+
+class _Task:
+    """Queued command"""
+    __slots__ = ('func', 'args', 'merge_key', 'enqueued')
+
+    def __init__(self, func: callable, args: tuple, merge_key):
+        self.func = func
+        self.args = args
+        self.merge_key = merge_key
+        self.enqueued = time.monotonic()
+
+
+class CommandExecutor:
+    """Bounded worker pool with FIFO ordering per target"""
+    def __init__(self, workers: int = 2, queue_depth: int = 64, policy: str = POLICY_MERGE):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        if workers < 1 or queue_depth < 1:
+            raise ValueError('Executor needs at least one worker and a queue depth of one')
+
+        self._queue_depth = queue_depth
+        self._policy = policy
+        self._cond = threading.Condition()
+        self._queues = {}                   # target -> deque of pending tasks
+        self._ready = collections.deque()   # targets with pending tasks and no running task
+        self._scheduled = set()             # targets in _ready or running on a worker
+        self._depth = 0
+        self._stopping = False
+
+        self._stats = {
+            'submitted': 0,
+            'executed': 0,
+            'failed': 0,
+            'dropped': 0,
+            'merged': 0,
+            'depth_max': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f'executor-{i}', daemon=True)
+            for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, target: str, func: callable, *args, merge_key=None) -> bool:
+        """Queue a command for execution.
+
+        Args:
+            target (str): commands with the same target are executed in order
+            func (callable): command to execute
+            *args: arguments for func
+            merge_key (optional): commands with the same merge key may replace
+                each other under backpressure. Defaults to None (never merged).
+
+        Returns:
+            bool: True if the command was queued or merged, False if dropped
+        """
+        with self._cond:
+            if self._stopping:
+                return False
+            self._stats['submitted'] += 1
+            queue = self._queues.get(target)
+
+            if self._depth >= self._queue_depth:
+                if self._policy == POLICY_MERGE and merge_key is not None and queue:
+                    for task in queue:
+                        if task.merge_key == merge_key:
+                            task.func = func
+                            task.args = args
+                            self._stats['merged'] += 1
+                            return True
+                if self._policy == POLICY_DROP_OLDEST and queue:
+                    queue.popleft()
+                    self._depth -= 1
+                else:
+                    self._stats['dropped'] += 1
+                    LOGGER.warning('Queue full, dropping command for %s', target)
+                    return False
+                self._stats['dropped'] += 1
+                LOGGER.warning('Queue full, dropping oldest command for %s', target)
+
+            if queue is None:
+                queue = self._queues[target] = collections.deque()
+            queue.append(_Task(func, args, merge_key))
+            self._depth += 1
+            self._stats['depth_max'] = max(self._stats['depth_max'], self._depth)
+
+            if target not in self._scheduled:
+                self._scheduled.add(target)
+                self._ready.append(target)
+                self._cond.notify()
+        return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                target = self._ready.popleft()
+                task = self._queues[target].popleft()
+                self._depth -= 1
+
+            wait = time.monotonic() - task.enqueued
+            try:
+                task.func(*task.args)
+                failed = False
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Command for %s failed', target)
+                failed = True
+
+            with self._cond:
+                self._stats['executed'] += 1
+                self._stats['failed'] += failed
+                self._stats['wait_total'] += wait
+                self._stats['wait_max'] = max(self._stats['wait_max'], wait)
+                if self._queues.get(target):
+                    self._ready.append(target)
+                    self._cond.notify()
+                else:
+                    self._queues.pop(target, None)
+                    self._scheduled.discard(target)
+                    if not self._scheduled:
+                        self._cond.notify_all()  # wake join()
+
+    def stats(self) -> dict:
+        """Return queue depth and wait time statistics
+
+        Returns:
+            dict: executor statistics, wait times in seconds
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['depth'] = self._depth
+        wait_total = stats.pop('wait_total')
+        stats['wait_avg'] = wait_total / stats['executed'] if stats['executed'] else 0.0
+        return stats
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until all queued commands have been executed
+
+        Args:
+            timeout (float, optional): seconds to wait. Defaults to None (forever).
+
+        Returns:
+            bool: True if the executor is idle
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._scheduled or self._stopping, timeout)
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the workers, pending commands are discarded."""
+        with self._cond:
+            self._stopping = True
+            self._queues.clear()
+            self._ready.clear()
+            self._depth = 0
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
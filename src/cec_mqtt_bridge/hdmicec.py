@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 """HDMI CEC interface to HDMI CEC MQTT bridge"""
 
+import json
 import logging
 import math
 import re
@@ -9,7 +10,21 @@ import threading
 import time
 import os
 from typing import List
-import cec
+
+from cec_mqtt_bridge import keystream
+from cec_mqtt_bridge import metrics
+from cec_mqtt_bridge import registry
+from cec_mqtt_bridge import rxstream
+from cec_mqtt_bridge import simcec
+from cec_mqtt_bridge import txqueue
+from cec_mqtt_bridge import volumectl
+
+try:
+    import cec
+except ImportError:
+    # Without the libcec bindings only the simulated backend is available,
+    # it defines the same constants
+    cec = simcec
 
 LOGGER = logging.getLogger(__name__)
 
@@ -18,33 +33,344 @@ DEFAULT_CONFIGURATION = {
     'port': '',
     'devices': '0,1,2,3,4,5,6,7,8,9,10,11,12,13,14',
     'name': 'CEC Bridge',
-    'refresh': '10'
+    'refresh': '10',
+    'refresh_fast': '2',
+    'refresh_max': '60',
+    'refresh_absent': '300',
+    'log_levels': 'error,warning,notice,debug',
+    'tx_retries': '2',
+    'tx_retry_budget': '6',
+    'cache_file': '/var/cache/cec-mqtt-bridge/devices.json',
+    'backend': 'libcec',
+    'adapters': '',
+    'state_format': 'fields',
+    'rx_retain': '0',
+    'rx_opcodes': '',
+    'rx_initiators': '',
+    'rx_rate': '0',
+    'rx_burst': '20',
+    'rx_batch': '0',
+    'rx_history': '100',
+    'key_hold': '500',
+}
+
+# Adapter backends: the libcec bindings or the simulated bus
+BACKEND_LIBCEC = 'libcec'
+BACKEND_SIM = 'sim'
+BACKENDS = (BACKEND_LIBCEC, BACKEND_SIM)
+
+# State topics: one topic per field, one JSON document per device or both
+STATE_FIELDS = 'fields'
+STATE_JSON = 'json'
+STATE_BOTH = 'both'
+STATE_FORMATS = (STATE_FIELDS, STATE_JSON, STATE_BOTH)
+# Fields published below cec/device/<id>/, cleared when a device leaves the bus
+DEVICE_FIELDS = ('type', 'address', 'vendor', 'osd', 'cecver', 'active', 'power', 'language')
+
+LOG_LEVELS = {
+    cec.CEC_LOG_ERROR: 'ERROR',
+    cec.CEC_LOG_WARNING: 'WARNING',
+    cec.CEC_LOG_NOTICE: 'NOTICE',
+    cec.CEC_LOG_TRAFFIC: 'TRAFFIC',
+    cec.CEC_LOG_DEBUG: 'DEBUG',
 }
 
+# TV (0): power status changed from 'unknown' to 'on'
+POWER_CHANGED = 'power status changed'
+POWER_CHANGED_RE = re.compile(
+    r'\(([0-9a-fA-F])\): power status changed from \'.*\' to \'(.*)\'')
+
+AUDIO = 'audio'  # poll schedule key of the audio status
+# Seconds after a poll a report of the polled state counts as its reply
+REPLY_WINDOW = 1.0
+
+NAMESPACE = 'cec'  # topic namespace of a single adapter
+# Topic levels below cec/, not usable as adapter names
+TOPIC_LEVELS = ('device', 'audio', 'mute', 'routing', 'tx', 'rx', 'key', 'refresh', 'scan')
+
+
+def namespaced(mqtt_send: callable, namespace: str) -> callable:
+    """Publish function moving the cec/ topics of an adapter to its namespace
+
+    Args:
+        mqtt_send (callable): bridge publish function
+        namespace (str): topic namespace, e.g. 'cec/hdmi1'
+
+    Returns:
+        callable: publish function
+    """
+    if namespace == NAMESPACE:
+        return mqtt_send
+
+    def send(topic, *args, **kwargs):
+        return mqtt_send(namespace + topic[len(NAMESPACE):], *args, **kwargs)
+    return send
+
+
+class PollSchedule:
+    """Adaptive poll schedule per logical address
+
+    Devices in transition are polled fast, devices with an unchanged state
+    back off up to a maximum interval and absent devices are polled rarely.
+    A state the bus reports unsolicited resets the timer of the device, the
+    reply to the bridge's own poll does not. An interval of 0 disables polling.
+    """
+    def __init__(self, keys: list, interval: float, fast: float, maximum: float,
+                 absent: float):
+        self._lock = threading.Lock()
+        self.configure(interval, fast, maximum, absent)
+        now = time.monotonic()
+        # key -> [due time, interval, last state, reports are replies until]
+        self._entries = {key: [now + interval, interval, None, 0] for key in keys}
+
+    def configure(self, interval: float, fast: float, maximum: float, absent: float):
+        """Change the poll intervals, running timers keep their due time
+
+        Args:
+            interval (float): base interval, 0 disables polling
+            fast (float): interval of devices in transition
+            maximum (float): longest interval of unchanged devices
+            absent (float): interval of absent devices
+        """
+        with self._lock:
+            self._base = interval
+            self._fast = fast
+            self._max = max(maximum, interval)
+            self._absent = absent
+
+    def set_keys(self, keys: list):
+        """Change the polled keys, new keys are due now
+
+        Args:
+            keys (list): logical addresses and AUDIO
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._entries = {key: self._entries.get(key, [now, self._base, None, 0])
+                             for key in keys}
+
+    def _interval(self, entry: list, state) -> float:
+        if state is None:
+            return self._absent
+        if isinstance(state, str) and 'transition' in state:
+            return self._fast
+        if state == entry[2]:
+            return min(entry[1] * 2, self._max)
+        return self._base
+
+    def polling(self, key):
+        """Mark a poll as outstanding, reports until polled() are its reply.
+
+        Args:
+            key (_type_): logical address or AUDIO
+        """
+        with self._lock:
+            entry = self._entries.setdefault(key, [0, self._base, None, 0])
+            entry[3] = math.inf
+
+    def polled(self, key, state):
+        """Schedule the next poll after a poll.
+
+        Args:
+            key (_type_): logical address or AUDIO
+            state (_type_): polled state, None if the device is absent
+        """
+        with self._lock:
+            entry = self._entries.setdefault(key, [0, self._base, None, 0])
+            entry[1] = self._interval(entry, state)
+            now = time.monotonic()
+            entry[0] = now + entry[1]
+            entry[2] = state
+            # The reply frame may be delivered after the libcec call returned
+            entry[3] = now + REPLY_WINDOW
+
+    def reported(self, key, state) -> bool:
+        """Reset the timer after the bus reported a state unsolicited.
+
+        Reports while a poll is outstanding and reports of the polled state
+        shortly after it are the reply to the poll and leave the timer alone.
+
+        Args:
+            key (_type_): logical address or AUDIO
+            state (_type_): reported state
+
+        Returns:
+            bool: True if the next poll moved forward
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            if math.isinf(entry[3]) or \
+                    (time.monotonic() <= entry[3] and state == entry[2]):
+                return False
+            interval = self._fast if isinstance(state, str) and 'transition' in state \
+                else max(entry[1], self._base)
+            due = entry[0]
+            entry[0] = time.monotonic() + interval
+            entry[1] = interval
+            entry[2] = state
+            return entry[0] < due
+
+    def due(self) -> list:
+        """Keys that need to be polled now"""
+        now = time.monotonic()
+        with self._lock:
+            if not self._base:
+                return []
+            return [key for key, entry in self._entries.items() if entry[0] <= now]
+
+    def next_due(self) -> float:
+        """Seconds until the next poll is due"""
+        with self._lock:
+            if not self._base:
+                return math.inf
+            due = min((entry[0] for entry in self._entries.values()), default=math.inf)
+        return max(due - time.monotonic(), 0)
+
+
+# libcec calls timed by the metrics, and the ones that transmit a command
+CEC_TIMED_CALLS = ('Transmit', 'PowerOnDevices', 'StandbyDevices', 'VolumeUp', 'VolumeDown',
+                   'AudioMute', 'AudioUnmute', 'AudioStatus', 'GetDevicePowerStatus',
+                   'GetDevicePhysicalAddress')
+CEC_SEND_CALLS = CEC_TIMED_CALLS[:7]
+
+RX_FRAMES = metrics.REGISTRY.counter('cec_rx_frames', 'CEC command callbacks')
+LOG_CALLBACKS = metrics.REGISTRY.counter('cec_log_messages', 'CEC log callbacks')
+
+
+def parse_log_levels(levels: str) -> int:
+    """Convert a comma separated list of libcec log levels to a log mask
+
+    Args:
+        levels (str): log level names, e.g. 'error,warning'
+
+    Returns:
+        int: libcec log mask
+    """
+    names = {name.lower(): level for level, name in LOG_LEVELS.items()}
+    mask = 0
+    for name in levels.split(','):
+        name = name.strip().lower()
+        if name:
+            try:
+                mask |= names[name]
+            except KeyError as err:
+                raise ValueError(f"Unknown libcec log level: {name}") from err
+    return mask
+
+
+class CecFrame:
+    """CEC frame received from libcec, e.g. '>> 0f:87:00:80:45'"""
+    __slots__ = ('initiator', 'destination', 'opcode', 'operands', 'raw')
+
+    def __init__(self, initiator: int, destination: int, opcode: int, operands: bytes,
+                 raw: str):
+        self.initiator = initiator
+        self.destination = destination
+        self.opcode = opcode
+        self.operands = operands
+        self.raw = raw
+
+    @classmethod
+    def parse(cls, cmd: str) -> 'CecFrame':
+        """Parse a libcec command string
+
+        Args:
+            cmd (str): libcec command string, '>> ' followed by the frame
+
+        Returns:
+            CecFrame: parsed frame, opcode is None for a polling message
+        """
+        raw = cmd[3:]
+        data = bytes.fromhex(raw.replace(':', ''))
+        return cls(data[0] >> 4, data[0] & 0xF, data[1] if len(data) > 1 else None,
+                   data[2:], raw)
+
+    def physical_address(self, offset: int = 0) -> str:
+        """Physical address operand formatted as 4 hex digits"""
+        return f'{self.operands[offset]:02x}{self.operands[offset + 1]:02x}'
+
 
 class HdmiCec:
     """HDMI CEC interface class"""
-    def __init__(self, port: str, name: str, devices: List[int], mqtt_send: callable):
+    def __init__(self, port: str, name: str, devices: List[int], mqtt_send: callable,
+                 refresh: int = 0, refresh_fast: int = 2, refresh_max: int = 60,
+                 refresh_absent: int = 300, log_mask: int = cec.CEC_LOG_ALL,
+                 tx_retries: int = 2, tx_retry_budget: int = 6, cache_file: str = '',
+                 threads: bool = True, poll_wakeup=None, backend: str = BACKEND_LIBCEC,
+                 recorder=None, state_format: str = STATE_FIELDS,
+                 rx_stream: rxstream.RxStream = None, namespace: str = NAMESPACE,
+                 polling: bool = True, key_stream: keystream.KeyStream = None):
+        # Topics are published as cec/..., namespaced() moves them
+        self.namespace = namespace
         self._mqtt_send = mqtt_send
+        self.recorder = recorder
+        self.rx_stream = rx_stream or rxstream.RxStream(mqtt_send)
+        self.key_stream = key_stream or keystream.KeyStream(mqtt_send)
         self.devices = devices
         self.volume_correction = 1  # 80/100 = max volume of avr / reported max volume
 
         self.setting_volume = False
-        self.refreshing = False
-        self.volume_update = threading.Event()
-        self.volume_update.clear()
 
-        self.cec_config = cec.libcec_configuration()
+        # Serializes libcec access between commands and the refresh thread
+        self._lock = threading.RLock()
+        # Time of the last state update received from the bus, per topic
+        self._updated = {}
+        if state_format not in STATE_FORMATS:
+            raise ValueError(f"Unknown state format: {state_format}")
+        self._state_fields = state_format in (STATE_FIELDS, STATE_BOTH)
+        self._state_json = state_format in (STATE_JSON, STATE_BOTH)
+        # JSON state document per device and audio, see _publish_state
+        self._state_lock = threading.Lock()
+        self._state = {}        # document topic -> {field: value}
+        self._state_dirty = set()
+        self.stop_event = threading.Event()
+        self.refresh_thread = None
+        # False while another bridge on the bus polls it, see set_polling()
+        self.polling = polling
+        self.scanned = False  # a scan was started
+        self.poll_schedule = PollSchedule(
+            devices + [AUDIO], refresh, refresh_fast, refresh_max, refresh_absent)
+        # Set when a poll moved earlier, see threads below
+        self._poll_wakeup = poll_wakeup or threading.Event()
+        self.log_mask = log_mask
+        self._active_source = None
+        self.volume_controller = volumectl.VolumeController(self)
+        self.log_counts = {}
+        self.registry = registry.DeviceRegistry(cache_file)
+
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown CEC backend: {backend}")
+        if backend == BACKEND_LIBCEC and cec is simcec:
+            raise ConnectionError("libcec python bindings are not installed")
+        adapter_module = simcec if backend == BACKEND_SIM else cec
+
+        self.cec_config = adapter_module.libcec_configuration()
         self.cec_config.strDeviceName = name
         self.cec_config.bActivateSource = 0
-        self.cec_config.deviceTypes.Add(cec.CEC_DEVICE_TYPE_RECORDING_DEVICE)
-        self.cec_config.clientVersion = cec.LIBCEC_VERSION_CURRENT
-        self.cec_config.SetLogCallback(self._on_log_callback)
+        self.cec_config.deviceTypes.Add(adapter_module.CEC_DEVICE_TYPE_RECORDING_DEVICE)
+        self.cec_config.clientVersion = adapter_module.LIBCEC_VERSION_CURRENT
+        if self.log_mask:
+            # libcec has no log level filter, without callback no log line
+            # is passed to Python at all
+            self.cec_config.SetLogCallback(self._on_log_callback)
         self.cec_config.SetKeyPressCallback(self._on_key_press_callback)
         self.cec_config.SetCommandCallback(self._on_command_callback)
 
         # Open connection
-        self.cec_client = cec.ICECAdapter.Create(self.cec_config)  # type: cec.ICECAdapter
+        self.cec_client = metrics.Instrumented(
+            adapter_module.ICECAdapter.Create(self.cec_config), 'cec_call_seconds',
+            CEC_TIMED_CALLS, CEC_SEND_CALLS)  # type: cec.ICECAdapter
+        self.tx_queue = txqueue.TransmitQueue(self.cec_client, tx_retries, tx_retry_budget)
+        collector = namespace.replace('/', '_')
+        metrics.REGISTRY.collector(f'{collector}_tx', lambda: {
+            'transmitted': self.tx_queue.transmitted, 'nacked': self.tx_queue.nacked,
+            'bus_time': self.tx_queue.bus_time})
+        metrics.REGISTRY.collector(f'{collector}_rx', self.rx_stream.stats)
+        metrics.REGISTRY.collector(f'{collector}_key', self.key_stream.stats)
+        metrics.REGISTRY.collector(f'{collector}_log', lambda: {
+            LOG_LEVELS.get(level, str(level)): count for level, count in self.log_counts.items()})
         if not port:
             if os.path.exists('/dev/cec0'):
                 port = '/dev/cec0'
@@ -57,32 +383,193 @@ class HdmiCec:
 
         self.device_id = self.cec_client.GetLogicalAddresses().primary
         LOGGER.info('Connected to HDMI-CEC with ID %d', self.device_id)
-        self.scan()
+
+        # Publish the cached topology now, the scan only publishes what changed
+        for device, info in self.registry.devices.items():
+            for field, value in info.items():
+                self._publish_state(f'cec/device/{device}/{field}', value, 0.0, flush=False)
+        self._flush_state()
+        # Without threads the owner calls scan() and poll_due() from its own
+        # scheduler, woken by poll_wakeup
+        self._threads = threads
+        self.scan_thread = None
+        if threads and polling:
+            self.scanned = True
+            self.scan_thread = threading.Thread(target=self.scan, name='cec-scan', daemon=True)
+            self.scan_thread.start()
+
+        if refresh and threads:
+            self._start_refresh_thread()
+
+    def _start_refresh_thread(self):
+        self.refresh_thread = threading.Thread(
+            target=self.cec_refresh_thread, name='cec-refresh', daemon=True)
+        self.refresh_thread.start()
+
+    def cec_refresh_thread(self):
+        """Poll devices when their poll schedule is due"""
+        LOGGER.info('Running CEC refresh thread')
+        while not self.stop_event.is_set():
+            timeout = self.poll_schedule.next_due() if self.polling else math.inf
+            self._poll_wakeup.wait(None if math.isinf(timeout) else timeout)
+            self._poll_wakeup.clear()
+            if self.stop_event.is_set():
+                break
+            try:
+                self.poll_due()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('CEC refresh failed')
+        LOGGER.info('Stopping CEC refresh thread')
+
+    def set_refresh(self, refresh: int, fast: int, maximum: int, absent: int):
+        """Change the poll intervals
+
+        Args:
+            refresh (int): base interval in seconds, 0 disables polling
+            fast (int): interval of devices in transition
+            maximum (int): longest interval of unchanged devices
+            absent (int): interval of absent devices
+        """
+        self.poll_schedule.configure(refresh, fast, maximum, absent)
+        if refresh and self._threads and self.refresh_thread is None:
+            self._start_refresh_thread()
+        self._poll_wakeup.set()
+
+    def set_devices(self, devices: List[int]) -> List[int]:
+        """Change the polled devices, new devices are polled right away
+
+        Args:
+            devices (List[int]): logical addresses
+
+        Returns:
+            List[int]: added devices, not scanned yet
+        """
+        added = [device for device in devices if device not in self.devices]
+        self.devices = list(devices)
+        self.poll_schedule.set_keys(self.devices + [AUDIO])
+        self._poll_wakeup.set()
+        return added
+
+    def set_log_mask(self, log_mask: int):
+        """Change the libcec log levels passed to the bridge
+
+        Args:
+            log_mask (int): CEC_LOG_* bits
+        """
+        if log_mask and not self.log_mask:
+            LOGGER.warning('libcec log callback is not registered, restart to enable it')
+        self.log_mask = log_mask
+
+    def set_polling(self, polling: bool):
+        """Start or stop polling the bus
+
+        Args:
+            polling (bool): poll the bus, False while another bridge polls it
+        """
+        if polling != self.polling:
+            LOGGER.info('%s polling', 'Start' if polling else 'Stop')
+        self.polling = polling
+        self._poll_wakeup.set()
+
+    def stop(self):
+        """Stop the refresh and volume threads and close the adapter."""
+        self.volume_controller.stop()
+        self.stop_event.set()
+        self._poll_wakeup.set()
+        if self.refresh_thread:
+            self.refresh_thread.join()
+        self.rx_stream.stop()
+        self.cec_client.Close()
+
+    def _reported(self, key, state):
+        """Reset the poll timer of a device that reported its state"""
+        if self.poll_schedule.reported(key, state):
+            self._poll_wakeup.set()
+
+    def _publish_state(self, topic: str, value, polled_at: float = None, flush: bool = True):
+        """Publish a state topic.
+
+        Updates received from the bus always win over polled values, a polled
+        value is discarded if the bus reported the state after the poll started.
+
+        Device and audio fields are also collected in a JSON document per
+        device, cec/device/<id>/state and cec/audio/state.
+
+        Args:
+            topic (str): state topic
+            value (_type_): state value
+            polled_at (float, optional): monotonic time the poll started.
+                Defaults to None (state reported by the bus).
+            flush (bool, optional): publish changed JSON documents now, pass
+                False to update several fields with one write and call
+                _flush_state() afterwards. Defaults to True.
+        """
+        if polled_at is None:
+            self._updated[topic] = time.monotonic()
+        elif self._updated.get(topic, 0) > polled_at:
+            LOGGER.debug('Discarding polled %s %s, bus reported newer state', topic, value)
+            if flush:
+                self._flush_state()
+            return
+        document, _, field = topic.rpartition('/')
+        if not self._state_json or not (
+                document == 'cec/audio' or document.startswith('cec/device/')):
+            self._mqtt_send(topic, value, state=True)
+            return
+        if self._state_fields:
+            self._mqtt_send(topic, value, state=True)
+        with self._state_lock:
+            state = self._state.setdefault(document, {})
+            if state.get(field) != value:
+                state[field] = value
+                self._state_dirty.add(document)
+        if flush:
+            self._flush_state()
+
+    def _flush_state(self):
+        """Publish the JSON state documents changed since the last flush."""
+        with self._state_lock:
+            if not self._state_dirty:
+                return
+            documents = [(document, json.dumps(self._state[document], sort_keys=True))
+                         for document in self._state_dirty]
+            self._state_dirty.clear()
+        for document, payload in documents:
+            self._mqtt_send(document + '/state', payload, state=True)
+
+    def _clear_device(self, device: int):
+        """Remove the retained state topics of a device that left the bus"""
+        document = f'cec/device/{device}'
+        with self._state_lock:
+            self._state.pop(document, None)
+            self._state_dirty.discard(document)
+        for topic in [f'{document}/{field}' for field in DEVICE_FIELDS] + [document + '/state']:
+            self._updated.pop(topic, None)
+            # An empty retained payload deletes the topic on the broker
+            self._mqtt_send(topic, None, state=True)
 
     def _on_log_callback(self, level, _time, message):
-        level_map = {
-            cec.CEC_LOG_ERROR: 'ERROR',
-            cec.CEC_LOG_WARNING: 'WARNING',
-            cec.CEC_LOG_NOTICE: 'NOTICE',
-            cec.CEC_LOG_TRAFFIC: 'TRAFFIC',
-            cec.CEC_LOG_DEBUG: 'DEBUG',
-        }
-        LOGGER.debug('LOG: [%s] %s', level_map.get(level), message)
-
-        if not self.refreshing:
-            # TV (0): power status changed from 'unknown' to 'on'
-            match = re.search(
-                r'\(([0-9a-fA-F])\): power status changed from \'.*\' to \'(.*)\'',
-                message)
-            if match:
-                device = int(match.group(1),16)
-                power = match.group(2)
-                self._mqtt_send(f'cec/device/{device}/power', power)
+        LOG_CALLBACKS.inc()
+        if not level & self.log_mask:
+            return
+        self.log_counts[level] = self.log_counts.get(level, 0) + 1
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('LOG: [%s] %s', LOG_LEVELS.get(level), message)
+
+        if POWER_CHANGED not in message:
+            return
+        match = POWER_CHANGED_RE.search(message)
+        if match:
+            device = int(match.group(1),16)
+            power = match.group(2)
+            self._publish_state(f'cec/device/{device}/power', power)
+            self._reported(device, power)
 
 
     # key press callback
     def _on_key_press_callback(self, key, duration):
         LOGGER.debug('_on_key_press_callback %s %s', key, duration)
+        self.key_stream.key(key, duration)
         return self.cec_client.KeyPressCallback(key, duration)
 
     # command callback
@@ -90,145 +577,250 @@ class HdmiCec:
     # https://www.hdmi.org/docs/Hdmi13aSpecs
 
     def _on_command_callback(self, cmd):
-        initiator = int(cmd[3:4], base=16)
-        destination = int(cmd[4:5], base=16)
-        opcode = int(cmd[6:8], base=16)
-        LOGGER.debug('_on_command_callback %02x %s %x -> %x %s',
-                     opcode, self.cec_client.OpcodeToString(opcode), initiator,
-                     destination, cmd)
+        RX_FRAMES.inc()
+        if self.recorder:
+            self.recorder.record_cec(cmd)
+        try:
+            frame = CecFrame.parse(cmd)
+        except (ValueError, IndexError):
+            LOGGER.warning('Ignoring malformed frame %s', cmd)
+            return self.cec_client.CommandCallback(cmd)
+        if LOGGER.isEnabledFor(logging.DEBUG) and frame.opcode is not None:
+            LOGGER.debug('_on_command_callback %02x %s %x -> %x %s',
+                         frame.opcode, self.cec_client.OpcodeToString(frame.opcode),
+                         frame.initiator, frame.destination, cmd)
         # Send raw command to mqtt
-        self._mqtt_send('cec/rx', cmd[3:])
-
-        if not self.refreshing:
-            if opcode == cec.CEC_OPCODE_REPORT_POWER_STATUS:
-                power = int(cmd[9:], base=16)
-                self._mqtt_send(f'cec/device/{initiator}/power',
-                                self.cec_client.PowerStatusToString(power))
-            elif opcode == cec.CEC_OPCODE_DEVICE_VENDOR_ID:
-                vendor_id = int((cmd[9:]).replace(':',''), base=16)
-                self._mqtt_send(f'cec/device/{initiator}/vendor',
-                                self.cec_client.VendorIdToString(vendor_id))
-            elif opcode == cec.CEC_OPCODE_REPORT_PHYSICAL_ADDRESS:
-                physical_address = int((cmd[9:14]).replace(':',''), base=16)
-                self._mqtt_send(f'cec/device/{initiator}/address',
-                                 f'{physical_address:04x}')
-            elif opcode == cec.CEC_OPCODE_REPORT_AUDIO_STATUS:
-                mute, volume = self.decode_volume(int(cmd[9:], base=16))
-                self._mqtt_send('cec/audio/volume', volume)
-                self._mqtt_send('cec/audio/mute', 'on' if mute else 'off')
-            elif opcode == cec.CEC_OPCODE_SET_SYSTEM_AUDIO_MODE:
-                if int(cmd[9:], base=16) == 1:
-                    self._mqtt_send('cec/device/5/power', 'on')
-                else:
-                    self._mqtt_send('cec/device/5/power', 'standby')
+        self.rx_stream.add(frame)
+
+        handler = self.OPCODE_HANDLERS.get(frame.opcode)
+        if handler is not None:
+            try:
+                handler(self, frame)
+            except IndexError:
+                LOGGER.warning('Ignoring short frame %s', frame.raw)
 
         return self.cec_client.CommandCallback(cmd)
 
+    def _on_report_power_status(self, frame: CecFrame):
+        power = self.cec_client.PowerStatusToString(frame.operands[0])
+        self._publish_state(f'cec/device/{frame.initiator}/power', power)
+        self._reported(frame.initiator, power)
+
+    def _on_device_vendor_id(self, frame: CecFrame):
+        vendor_id = int.from_bytes(frame.operands[0:3], 'big')
+        self._publish_state(f'cec/device/{frame.initiator}/vendor',
+                            self.cec_client.VendorIdToString(vendor_id))
+
+    def _on_report_physical_address(self, frame: CecFrame):
+        self._publish_state(f'cec/device/{frame.initiator}/address',
+                            frame.physical_address())
+
+    def _on_report_audio_status(self, frame: CecFrame):
+        mute, volume = self.decode_volume(frame.operands[0])
+        self._publish_state('cec/audio/volume', volume, flush=False)
+        self._publish_state('cec/audio/mute', 'on' if mute else 'off')
+        self._reported(AUDIO, (mute, volume))
+        self.volume_controller.reported(volume)
+
+    def _on_set_system_audio_mode(self, frame: CecFrame):
+        if frame.operands[0] == 1:
+            self._publish_state('cec/device/5/power', 'on')
+        else:
+            self._publish_state('cec/device/5/power', 'standby')
+
+    def _on_active_source(self, frame: CecFrame):
+        previous = self._active_source
+        self._active_source = frame.initiator
+        if previous is not None and previous != frame.initiator:
+            self._publish_state(f'cec/device/{previous}/active', str(False), flush=False)
+        self._publish_state(f'cec/device/{frame.initiator}/active', str(True))
+
+    def _on_routing_change(self, frame: CecFrame):
+        self._publish_state('cec/routing', frame.physical_address(2))
+
+    def _on_set_osd_name(self, frame: CecFrame):
+        self._publish_state(f'cec/device/{frame.initiator}/osd',
+                            frame.operands.decode('ascii', errors='replace'))
+
+    def _on_set_menu_language(self, frame: CecFrame):
+        self._publish_state(f'cec/device/{frame.initiator}/language',
+                            frame.operands[0:3].decode('ascii', errors='replace'))
+
+    # opcode -> handler of received frames
+    OPCODE_HANDLERS = {
+        cec.CEC_OPCODE_REPORT_POWER_STATUS: _on_report_power_status,
+        cec.CEC_OPCODE_DEVICE_VENDOR_ID: _on_device_vendor_id,
+        cec.CEC_OPCODE_REPORT_PHYSICAL_ADDRESS: _on_report_physical_address,
+        cec.CEC_OPCODE_REPORT_AUDIO_STATUS: _on_report_audio_status,
+        cec.CEC_OPCODE_SET_SYSTEM_AUDIO_MODE: _on_set_system_audio_mode,
+        cec.CEC_OPCODE_ACTIVE_SOURCE: _on_active_source,
+        cec.CEC_OPCODE_ROUTING_CHANGE: _on_routing_change,
+        cec.CEC_OPCODE_SET_OSD_NAME: _on_set_osd_name,
+        cec.CEC_OPCODE_SET_MENU_LANGUAGE: _on_set_menu_language,
+    }
+
+    def register_routes(self, router):
+        """Register the MQTT command topics of the CEC interface
+
+        Args:
+            router (TopicRouter): bridge command router
+        """
+        ns = self.namespace
+        router.add(f'{ns}/device/+/power/set', self.mqtt_power, target=f'{ns}/{{0}}',
+                   merge=True, types=(int,))
+        router.add(f'{ns}/audio/volume/set', self.mqtt_volume, target=f'{ns}/5',
+                   merge=str.isdigit)
+        router.add(f'{ns}/audio/mute/set', self.mqtt_mute, target=f'{ns}/5', merge=True)
+        router.add(f'{ns}/tx', self.mqtt_tx, target=self._tx_target)
+        router.add(f'{ns}/refresh', self.mqtt_refresh, target=self.bus_target, merge=True)
+        router.add(f'{ns}/scan', self.mqtt_scan, target=self.bus_target, merge=True)
+        router.add(f'{ns}/rx/history', self.mqtt_rx_history, target=f'{ns}/rx')
+
+    @property
+    def bus_target(self) -> str:
+        """Executor target of commands using the whole bus"""
+        return f'{self.namespace}/bus'
+
+    def _tx_target(self, _args: tuple, action: str) -> str:
+        # Destination is the second nibble of the first command
+        try:
+            return f'{self.namespace}/{int(action[1:2], 16)}'
+        except ValueError:
+            return self.bus_target
+
+    def mqtt_power(self, device: int, action: str):
+        """Handle cec/device/+/power/set"""
+        if action == 'on':
+            self.power_on(device)
+        elif action == 'standby':
+            self.power_off(device)
+        else:
+            raise ValueError(f"Unknown power command: {device} {action}")
+
+    def mqtt_volume(self, action: str):
+        """Handle cec/audio/volume/set"""
+        if action == 'up':
+            self.volume_up()
+        elif action == 'down':
+            self.volume_down()
+        elif action.isdigit() and int(action) <= 100:
+            self.volume_set(int(action))
+        else:
+            raise ValueError(f"Unknown volume command: {action}")
+
+    def mqtt_mute(self, action: str):
+        """Handle cec/audio/mute/set"""
+        if action == 'on':
+            self.volume_mute()
+        elif action == 'off':
+            self.volume_unmute()
+        else:
+            raise ValueError(f"Unknown mute command: {action}")
+
+    def mqtt_tx(self, action: str):
+        """Handle cec/tx, the result is published on cec/tx/result"""
+        frames = [command.strip() for command in action.split(',') if command.strip()]
+        LOGGER.debug('Sending %s', frames)
+        with self._lock:
+            results = self.tx_queue.transmit(frames)
+        self._mqtt_send('cec/tx/result', json.dumps({
+            'ok': all(result.ok for result in results),
+            'bus_ms': round(sum(result.bus_time for result in results) * 1000, 1),
+            'frames': [result.as_dict() for result in results],
+        }), retain=False)
+
+    def mqtt_refresh(self, _action: str):
+        """Handle cec/refresh, only on the bridge polling the bus"""
+        if self.polling:
+            self.refresh()
+
+    def mqtt_scan(self, _action: str):
+        """Handle cec/scan, only on the bridge polling the bus"""
+        if self.polling:
+            self.scan()
+
+    def mqtt_rx_history(self, action: str):
+        """Handle cec/rx/history, the last `action` received frames (all if
+        empty) are published on cec/rx/history/result"""
+        count = int(action) if action.strip() else None
+        self._mqtt_send('cec/rx/history/result', json.dumps(self.rx_stream.history(count)),
+                        retain=False)
+
     def power_on(self, device: int):
         """Power on the specified device."""
         LOGGER.debug('Power on device %d', device)
-        self._mqtt_send(f'cec/device/{device}/power', 'on')
-        self.cec_client.PowerOnDevices(device)
+        self._publish_state(f'cec/device/{device}/power', 'on')
+        with self._lock:
+            self.cec_client.PowerOnDevices(device)
 
     def power_off(self, device: int):
         """Power off the specified device."""
         LOGGER.debug('Power off device %d', device)
-        self._mqtt_send(f'cec/device/{device}/power', 'standby')
-        self.cec_client.StandbyDevices(device)
+        self._publish_state(f'cec/device/{device}/power', 'standby')
+        with self._lock:
+            self.cec_client.StandbyDevices(device)
 
     def volume_up(self, amount=1, update=True):
         """Increase the volume on the AVR."""
-        if amount >= 10:
-            LOGGER.debug('Volume up fast with %d', amount)
-            for i in range(amount):
-                self.cec_client.VolumeUp(i == amount - 1)
-                time.sleep(0.1)
-        else:
-            LOGGER.debug('Volume up with %d', amount)
-            for i in range(amount):
-                self.cec_client.VolumeUp()
-                time.sleep(0.1)
+        with self._lock:
+            if amount >= 10:
+                LOGGER.debug('Volume up fast with %d', amount)
+                for i in range(amount):
+                    self.cec_client.VolumeUp(i == amount - 1)
+                    time.sleep(0.1)
+            else:
+                LOGGER.debug('Volume up with %d', amount)
+                for i in range(amount):
+                    self.cec_client.VolumeUp()
+                    time.sleep(0.1)
 
-        if update:
-            # Ask AVR to send us an update
-            self.tx_command('71', 5)
+            if update:
+                # Ask AVR to send us an update
+                self.tx_command('71', 5)
 
     def volume_down(self, amount=1, update=True):
         """Decrease the volume on the AVR."""
-        if amount >= 10:
-            LOGGER.debug('Volume down fast with %d', amount)
-            for i in range(amount):
-                self.cec_client.VolumeDown(i == amount - 1)
-                time.sleep(0.1)
-        else:
-            LOGGER.debug('Volume down with %d', amount)
-            for i in range(amount):
-                self.cec_client.VolumeDown()
-                time.sleep(0.1)
+        with self._lock:
+            if amount >= 10:
+                LOGGER.debug('Volume down fast with %d', amount)
+                for i in range(amount):
+                    self.cec_client.VolumeDown(i == amount - 1)
+                    time.sleep(0.1)
+            else:
+                LOGGER.debug('Volume down with %d', amount)
+                for i in range(amount):
+                    self.cec_client.VolumeDown()
+                    time.sleep(0.1)
 
-        if update:
-            # Ask AVR to send us an update
-            self.tx_command('71', 5)
+            if update:
+                # Ask AVR to send us an update
+                self.tx_command('71', 5)
 
     def volume_mute(self):
         """Mute the volume on the AVR."""
         LOGGER.debug('Mute AVR')
-        self._mqtt_send('cec/audio/mute', 'on')
-        self.cec_client.AudioMute()
+        self._publish_state('cec/audio/mute', 'on')
+        with self._lock:
+            self.cec_client.AudioMute()
 
     def volume_unmute(self):
         """Unmute the volume on the AVR."""
         LOGGER.debug('Unmute AVR')
-        self._mqtt_send('cec/audio/mute', 'off')
-        self.cec_client.AudioUnmute()
+        self._publish_state('cec/audio/mute', 'off')
+        with self._lock:
+            self.cec_client.AudioUnmute()
 
     def volume_set(self, requested_volume: int):
-        """Set the volume to the AVR."""
+        """Set the volume to the AVR, replaces a request that is still pending."""
         LOGGER.debug('Set volume to %d', requested_volume)
-        self.setting_volume = True
-
-        attempts = 0
-        while attempts < 10:
-            LOGGER.debug('Attempt %d to set volume', attempts)
+        self.volume_controller.set(requested_volume)
 
-            # Ask AVR to send us an update about its volume
-            self.volume_update.clear()
-            self.tx_command('71', device=5)
-
-            # Wait for this update to arrive
-            LOGGER.debug('Waiting for response...')
-            if not self.volume_update.wait(0.2):
-                LOGGER.warning('No response received. Retrying...')
-                continue
-
-            # Read the update
-            _, current_volume = self.decode_volume(self.cec_client.AudioStatus())
-            if current_volume == requested_volume:
-                break
-
-            diff = abs(current_volume - requested_volume)
-            LOGGER.debug('Difference in volume is %s', diff)
-
-            if diff >= 10:
-                diff = math.ceil(diff / 2)
-                LOGGER.debug('Changing fast with %d', diff)
-                for i in range(diff):
-                    if current_volume < requested_volume:
-                        self.cec_client.VolumeUp(i == diff - 1)
-                    elif current_volume > requested_volume:
-                        self.cec_client.VolumeDown(i == diff - 1)
-            else:
-                LOGGER.debug('Changing slow with %d', diff)
-                for i in range(diff):
-                    if current_volume < requested_volume:
-                        self.cec_client.VolumeUp()
-                    elif current_volume > requested_volume:
-                        self.cec_client.VolumeDown()
-                    time.sleep(0.1)
-
-            attempts += 1
-
-        self.setting_volume = False
+    def volume_burst(self, presses: int, up: bool):
+        """Send volume key presses to the AVR without waiting in between."""
+        with self._lock:
+            press = self.cec_client.VolumeUp if up else self.cec_client.VolumeDown
+            for _ in range(presses):
+                press()
 
     def decode_volume(self, audio_status) -> tuple[bool, int]:
         """Decodes CEC audio status into mut and real volume
@@ -247,74 +839,119 @@ class HdmiCec:
                      audio_status, mute, volume, real_volume)
         return mute, real_volume
 
-    def tx_command(self, command: str, device: int = None):
-        """Send a raw CEC command to the specified device."""
+    def tx_command(self, command: str, device: int = None) -> bool:
+        """Send a raw CEC command to the specified device.
+
+        Returns:
+            bool: True if the command was acknowledged
+        """
         if device is None:
             full_command = command
         else:
             full_command = f'{self.device_id * 16 + device:x}:{command}'
 
         LOGGER.debug('Sending %s', full_command)
-        self.cec_client.Transmit(self.cec_client.CommandFromString(full_command))
+        with self._lock:
+            return self.tx_queue.transmit([full_command])[0].ok
+
+    def _poll_device(self, device: int):
+        """Poll the power status of a device"""
+        # Get power status values of discovered devices from ceclib
+        # This will setting unknown power state when device does not respond.
+        polled_at = time.monotonic()
+        self.poll_schedule.polling(device)
+        physical_address = self.cec_client.GetDevicePhysicalAddress(device)
+        if physical_address == 0xFFFF:
+            self.poll_schedule.polled(device, None)
+            return
+
+        power = self.cec_client.GetDevicePowerStatus(device)
+        power_str = self.cec_client.PowerStatusToString(power)
+        LOGGER.debug('device %d %04x %-12s power %d %s', device, physical_address,
+                    self.cec_client.LogicalAddressToString(device), power,
+                    power_str)
+        self._publish_state(f'cec/device/{device}/power', power_str, polled_at)
+        self.poll_schedule.polled(device, power_str)
+
+    def _poll_audio(self):
+        """Poll the audio status of the AVR"""
+        polled_at = time.monotonic()
+        self.poll_schedule.polling(AUDIO)
+        mute, volume = self.decode_volume(self.cec_client.AudioStatus())
+        self._publish_state('cec/audio/volume', volume, polled_at, flush=False)
+        self._publish_state('cec/audio/mute', 'on' if mute else 'off', polled_at)
+        self.poll_schedule.polled(AUDIO, (mute, volume))
+
+    def poll_due(self):
+        """Poll the devices whose poll schedule is due."""
+        if not self.polling:
+            return
+        with self._lock:
+            for key in self.poll_schedule.due():
+                if key == AUDIO:
+                    self._poll_audio()
+                else:
+                    self._poll_device(key)
 
     def refresh(self):
         """Refresh the audio status and power status."""
-        # :TODO: This operation takes ~2 sec should it be done in seperate thread?
         if self.setting_volume:
             return
 
-        LOGGER.debug('Refreshing HDMI-CEC...')
-        self.refreshing = True
-        for device in self.devices:
-            # Get power status values of discovered devices from ceclib
-            # This will setting unknown power state when device does not respond.
-            physical_address = self.cec_client.GetDevicePhysicalAddress(device)
-            if physical_address != 0xFFFF:
+        with self._lock:
+            LOGGER.debug('Refreshing HDMI-CEC...')
+            for device in self.devices:
+                self._poll_device(device)
+
+            # Ask AVR to send us an audio status update
+            self._poll_audio()
+
+    def scan(self, devices: List[int] = None):
+        """scan for devices on the HDMI CEC bus
+
+        Args:
+            devices (List[int], optional): devices to scan. Defaults to None (all).
+        """
+        with self._lock:
+            self.scanned = True
+            LOGGER.debug("requesting CEC bus information ...")
+            for device in self.devices if devices is None else devices:
+                # Get power status values of discovered devices from ceclib
+                # This will setting unknown power state when device does not respond.
+                polled_at = time.monotonic()
+                self.poll_schedule.polling(device)
+                physical_address = self.cec_client.GetDevicePhysicalAddress(device)
+                if physical_address == 0xFFFF:
+                    if self.registry.remove(device):
+                        LOGGER.info('Device %d left the bus', device)
+                        self._clear_device(device)
+                    self.poll_schedule.polled(device, None)
+                    continue
+
+                info = {
+                    'type': self.cec_client.LogicalAddressToString(device),
+                    'address': f'{physical_address:04x}',
+                    'vendor': self.cec_client.VendorIdToString(
+                        self.cec_client.GetDeviceVendorId(device)),
+                    'osd': self.cec_client.GetDeviceOSDName(device),
+                    'cecver': self.cec_client.CecVersionToString(
+                        self.cec_client.GetDeviceCecVersion(device)),
+                }
+                active = self.cec_client.IsActiveSource(device)
                 power = self.cec_client.GetDevicePowerStatus(device)
+
+                if self.registry.update(device, info):
+                    LOGGER.info('Device %d changed: %s', device, info)
+                    for field, value in info.items():
+                        self._publish_state(f'cec/device/{device}/{field}', value, polled_at,
+                                            flush=False)
+                self._publish_state(f'cec/device/{device}/active', str(active), polled_at,
+                                    flush=False)
                 power_str = self.cec_client.PowerStatusToString(power)
-                LOGGER.debug('device %d %04x %-12s power %d %s', device, physical_address,
-                            self.cec_client.LogicalAddressToString(device), power,
-                            power_str)
-                self._mqtt_send(f'cec/device/{device}/power', power_str)
+                self._publish_state(f'cec/device/{device}/power', power_str, polled_at)
+                self.poll_schedule.polled(device, power_str)
 
-        # Ask AVR to send us an audio status update
-        mute, volume = self.decode_volume(self.cec_client.AudioStatus())
-        self._mqtt_send('cec/audio/volume', volume)
-        self._mqtt_send('cec/audio/mute', 'on' if mute else 'off')
-        self.refreshing = False
-
-    def scan(self):
-        """scan for devices on the HDMI CEC bus"""
-        LOGGER.debug("requesting CEC bus information ...")
-        self.refreshing = True
-        for device in self.devices:
-            # Get power status values of discovered devices from ceclib
-            # This will setting unknown power state when device does not respond.
-            physical_address = self.cec_client.GetDevicePhysicalAddress(device)
-            if physical_address != 0xFFFF :
-                vendor_id        = self.cec_client.GetDeviceVendorId(device)
-                physical_address = self.cec_client.GetDevicePhysicalAddress(device)
-                active           = self.cec_client.IsActiveSource(device)
-                cec_version      = self.cec_client.GetDeviceCecVersion(device)
-                power            = self.cec_client.GetDevicePowerStatus(device)
-                osd_name         = self.cec_client.GetDeviceOSDName(device)
-
-                self._mqtt_send(f'cec/device/{device}/type',
-                                self.cec_client.LogicalAddressToString(device))
-                self._mqtt_send(f'cec/device/{device}/address',
-                                f'{physical_address:04x}')
-                self._mqtt_send(f'cec/device/{device}/active',
-                                str(active))
-                self._mqtt_send(f'cec/device/{device}/vendor',
-                                self.cec_client.VendorIdToString(vendor_id))
-                self._mqtt_send(f'cec/device/{device}/osd', osd_name)
-                self._mqtt_send(f'cec/device/{device}/cecver',
-                                self.cec_client.CecVersionToString(cec_version))
-                self._mqtt_send(f'cec/device/{device}/power',
-                                self.cec_client.PowerStatusToString(power))
-
-        # Ask AVR to send us an audio status update
-        mute, volume = self.decode_volume(self.cec_client.AudioStatus())
-        self._mqtt_send('cec/audio/volume', volume)
-        self._mqtt_send('cec/audio/mute', 'on' if mute else 'off')
-        self.refreshing = False
+            self.registry.save()
+
+            # Ask AVR to send us an audio status update
+            self._poll_audio()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Remote key presses forwarded over CEC for the HDMI CEC MQTT bridge
+
+libcec calls the key press callback with a duration of 0 when a key is
+pressed and again for every auto-repeat, and with the held duration when it
+is released. Each key is published as JSON on cec/key: a press, a hold
+update at most every hold interval while the key is repeated and a release.
+"""
+import json
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# CEC user control codes, CEC 1.4 table 27
+KEY_NAMES = {
+    0x00: 'select', 0x01: 'up', 0x02: 'down', 0x03: 'left', 0x04: 'right',
+    0x05: 'right_up', 0x06: 'right_down', 0x07: 'left_up', 0x08: 'left_down',
+    0x09: 'root_menu', 0x0A: 'setup_menu', 0x0B: 'contents_menu', 0x0C: 'favorite_menu',
+    0x0D: 'exit', 0x10: 'top_menu', 0x11: 'dvd_menu', 0x1D: 'number_entry_mode',
+    0x1E: 'number11', 0x1F: 'number12',
+    0x20: 'number0', 0x21: 'number1', 0x22: 'number2', 0x23: 'number3', 0x24: 'number4',
+    0x25: 'number5', 0x26: 'number6', 0x27: 'number7', 0x28: 'number8', 0x29: 'number9',
+    0x2A: 'dot', 0x2B: 'enter', 0x2C: 'clear', 0x2F: 'next_favorite',
+    0x30: 'channel_up', 0x31: 'channel_down', 0x32: 'previous_channel',
+    0x33: 'sound_select', 0x34: 'input_select', 0x35: 'display_information', 0x36: 'help',
+    0x37: 'page_up', 0x38: 'page_down',
+    0x40: 'power', 0x41: 'volume_up', 0x42: 'volume_down', 0x43: 'mute', 0x44: 'play',
+    0x45: 'stop', 0x46: 'pause', 0x47: 'record', 0x48: 'rewind', 0x49: 'fast_forward',
+    0x4A: 'eject', 0x4B: 'forward', 0x4C: 'backward', 0x4D: 'stop_record',
+    0x4E: 'pause_record', 0x50: 'angle', 0x51: 'sub_picture', 0x52: 'video_on_demand',
+    0x53: 'electronic_program_guide', 0x54: 'timer_programming', 0x55: 'initial_configuration',
+    0x56: 'select_broadcast_type', 0x57: 'select_sound_presentation',
+    0x60: 'play_function', 0x61: 'pause_play_function', 0x62: 'record_function',
+    0x63: 'pause_record_function', 0x64: 'stop_function', 0x65: 'mute_function',
+    0x66: 'restore_volume_function', 0x67: 'tune_function', 0x68: 'select_media_function',
+    0x69: 'select_av_input_function', 0x6A: 'select_audio_input_function',
+    0x6B: 'power_toggle_function', 0x6C: 'power_off_function', 0x6D: 'power_on_function',
+    0x71: 'f1_blue', 0x72: 'f2_red', 0x73: 'f3_green', 0x74: 'f4_yellow', 0x75: 'f5',
+    0x76: 'data', 0x91: 'an_return', 0x96: 'an_channels_list',
+}
+
+
+def key_name(code: int) -> str:
+    """Name of a CEC user control code, e.g. 'volume_up', hex if unknown"""
+    return KEY_NAMES.get(code, f'{code:02x}')
+
+
+class KeyStream:
+    """Publish key presses, coalescing auto-repeats into hold updates"""
+    def __init__(self, mqtt_send: callable, hold: float = 0.5):
+        """
+        Args:
+            mqtt_send (callable): bridge publish function
+            hold (float, optional): seconds between hold updates while a key
+                is repeated, 0 publishes no hold updates. Defaults to 0.5.
+        """
+        self._mqtt_send = mqtt_send
+        self._hold = hold
+        self._lock = threading.Lock()
+        self._held = None  # [code, time pressed, time of the last hold update]
+
+        self.pressed = 0
+        self.holds = 0
+        self.repeats = 0  # auto-repeats not published
+
+    def configure(self, hold: float = 0.5):
+        """Change the hold interval, see __init__"""
+        with self._lock:
+            self._hold = hold
+
+    def key(self, code: int, duration: int):
+        """Handle a libcec key press callback
+
+        Args:
+            code (int): CEC user control code
+            duration (int): 0 when pressed or repeated, the held milliseconds
+                when released
+        """
+        now = time.monotonic()
+        events = []
+        with self._lock:
+            held = self._held
+            if duration:
+                # A release without a press was missed, publish it anyway
+                self._held = None
+                events.append((code, 'release', duration))
+            elif held is None or held[0] != code:
+                if held is not None:
+                    # libcec releases a key before the next one is pressed
+                    events.append((held[0], 'release', int((now - held[1]) * 1000)))
+                self._held = [code, now, now]
+                self.pressed += 1
+                events.append((code, 'press', 0))
+            elif self._hold and now - held[2] >= self._hold:
+                held[2] = now
+                self.holds += 1
+                events.append((code, 'hold', int((now - held[1]) * 1000)))
+            else:
+                self.repeats += 1
+        for key, event, held_ms in events:
+            self._mqtt_send('cec/key', json.dumps(
+                {'key': key_name(key), 'code': key, 'event': event, 'duration': held_ms}),
+                retain=False)
+
+    def stats(self) -> dict:
+        """Press, hold update and coalesced repeat counters"""
+        with self._lock:
+            return {'pressed': self.pressed, 'holds': self.holds, 'repeats': self.repeats}
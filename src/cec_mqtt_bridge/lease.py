@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""CEC poll lease of bridges sharing one CEC bus
+
+Bridges attached to the same bus and MQTT prefix publish their availability
+retained on bridge/instance/<id>. The online instance with the lowest id owns
+the lease and polls the bus, the others only forward received frames and
+execute commands.
+
+The LWT of every bridge sets bridge/status to offline. A bridge stopping
+cleanly publishes its instance offline itself, a crashed one leaves it online.
+bridge/status offline and bridge/rollcall, published by a bridge after
+connecting, start a roll call: the bridges still online publish bridge/status
+and their instance online again and elect after the grace period. Instances
+known before the roll call that did not answer are cleared by the owner, the
+next instance takes over from a crashed owner.
+"""
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PollLease:
+    """Elects the bridge instance that polls the CEC bus"""
+    def __init__(self, instance: str, on_change: callable, publish: callable,
+                 grace: float = 2.0):
+        """
+        Args:
+            instance (str): id of this bridge, unique among the bridges on the bus
+            on_change (callable): called with True when this bridge took the
+                lease and with False when it lost it
+            publish (callable): bridge publish function
+            grace (float, optional): seconds after connecting or a roll call
+                before electing, to receive the instance topics. Defaults to 2.0.
+        """
+        self.instance = instance
+        self._on_change = on_change
+        self._publish = publish
+        self._grace = grace
+        self._lock = threading.Lock()
+        self._online = set()    # other instances that are online
+        self._stale = set()     # instances that did not answer a roll call yet
+        self._timer = None
+        self._connected = False
+        self._elected = False   # grace period over, elect on every change
+        self.owner = False
+        self.takeovers = 0
+        self.roll_calls = 0
+
+    @property
+    def topic(self) -> str:
+        """Availability topic of this instance"""
+        return f'bridge/instance/{self.instance}'
+
+    def register_routes(self, router):
+        """Register the availability and roll call topics
+
+        Args:
+            router (TopicRouter): bridge command router
+        """
+        router.add('bridge/instance/+', self.mqtt_instance, target='bridge/lease')
+        router.add('bridge/status', self.mqtt_status, target='bridge/lease')
+        router.add('bridge/rollcall', self.mqtt_roll_call, target='bridge/lease')
+
+    def mqtt_instance(self, instance: str, action: str):
+        """Handle bridge/instance/+"""
+        if instance == self.instance:
+            return
+        with self._lock:
+            if action == 'online':
+                self._online.add(instance)
+            else:
+                self._online.discard(instance)
+            self._stale.discard(instance)
+        self._elect()
+
+    def mqtt_status(self, action: str):
+        """Handle bridge/status, offline is the LWT of a bridge: roll call"""
+        if action == 'offline':
+            self.mqtt_roll_call(action)
+
+    def mqtt_roll_call(self, _action: str):
+        """Handle bridge/rollcall, the retained instance topics were received
+        before it, the instances online answer after it"""
+        with self._lock:
+            if not self._connected:
+                return
+            self._stale |= self._online
+            self._online.clear()
+            self._elected = False
+            self.roll_calls += 1
+            self._start_timer()
+        LOGGER.info('Roll call')
+        self.announce()
+
+    def announce(self):
+        """Publish bridge/status and this instance online."""
+        self._publish('bridge/status', 'online', qos=1, retain=True, force=True, state=True)
+        self._publish(self.topic, 'online', qos=1, retain=True, force=True, state=True)
+
+    def others_online(self) -> bool:
+        """Whether another instance is online"""
+        with self._lock:
+            return bool(self._online)
+
+    def connected(self):
+        """Call the roll and elect after the grace period, called after
+        connecting to MQTT and subscribing."""
+        with self._lock:
+            self._connected = True
+            self._start_timer()
+        self._publish('bridge/rollcall', self.instance, qos=1, retain=False)
+
+    def _start_timer(self):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(self._grace, self._grace_over)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _grace_over(self):
+        with self._lock:
+            self._timer = None
+            self._elected = True
+        self._elect()
+        with self._lock:
+            stale = sorted(self._stale) if self.owner else []
+            self._stale.clear()
+        for instance in stale:
+            LOGGER.info('Instance %s did not answer the roll call, clearing it', instance)
+            self._publish(f'bridge/instance/{instance}', None, qos=1, retain=True)
+
+    def disconnected(self):
+        """Give up the lease, the other instances see our LWT."""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._connected = False
+            self._elected = False
+            self._online.clear()
+            self._stale.clear()
+            owner, self.owner = self.owner, False
+        if owner:
+            LOGGER.info('Disconnected, giving up the poll lease')
+            self._on_change(False)
+
+    def _elect(self):
+        with self._lock:
+            if not self._elected:
+                return
+            owner = min(self._online | {self.instance}) == self.instance
+            if owner == self.owner:
+                return
+            self.owner = owner
+            self.takeovers += owner
+        LOGGER.info('%s the poll lease', 'Took' if owner else 'Released')
+        self._on_change(owner)
+
+    def stats(self) -> dict:
+        """Lease owner and number of online instances"""
+        with self._lock:
+            return {'instance': self.instance, 'owner': int(self.owner),
+                    'online': len(self._online) + 1, 'takeovers': self.takeovers,
+                    'roll_calls': self.roll_calls}
+
+    def stop(self):
+        """Cancel the election timer."""
+        with self._lock:
+            self._connected = False
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
@@ -2,62 +2,267 @@
 # -*- coding: utf-8 -*-
 """lirc interface to HDMI CEC MQTT bridge"""
 import logging
+import os
+import selectors
+import socket
 import threading
-import lirc
+import time
+
+from cec_mqtt_bridge import lircd
+from cec_mqtt_bridge import metrics
 
 LOGGER = logging.getLogger(__name__)
 
+IR_RECEIVE = metrics.REGISTRY.histogram(
+    'ir_receive_seconds', 'lircd line received until published')
+IR_SEND = metrics.REGISTRY.histogram('ir_send_seconds', 'lircd command until its reply')
+
 DEFAULT_CONFIGURATION = {
     'enabled': 0,
     'rx_sock_path': None,
-    'tx_sock_path': None
+    'tx_sock_path': None,
+    'hold_repeat': '3',
+    'release_timeout': '200',
 }
 
 
 class Lirc:
     """lirc IR interface class"""
 
-    def __init__(self, mqtt_send, config: dict):
+    def __init__(self, mqtt_send, config: dict, listen: bool = True, recorder=None,
+                 on_key: callable = None):
         self._config = config
         self._mqtt_send = mqtt_send
+        self.recorder = recorder
+        # Called with remote, key and 'press', 'hold' or 'release', see bindings
+        self._on_key = on_key or (lambda remote, key, event: None)
         self.stop_event = threading.Event()
         self.conn = None
+        self.cmd_conn = lircd.CommandConnection(self._config['tx_sock_path'])
+        metrics.REGISTRY.collector('ir_tx', lambda: dict(self.cmd_conn.stats))
+        self._hold_repeat = max(int(self._config['hold_repeat']), 1)
+        self._release_timeout = int(self._config['release_timeout']) / 1000
+        self._held = None  # [remote, key, time of last repeat]
+        # Self-pipe to wake the listen thread on shutdown
+        self._wakeup_r, self._wakeup_w = os.pipe()
 
         LOGGER.info("Initialising IR...")
-        self.lirc_thread = threading.Thread(target=self.ir_listen_thread,daemon=True)
-        self.lirc_thread.start()
+        # Without the listen thread the owner feeds lircd lines to ir_receive()
+        self.lirc_thread = None
+        if listen:
+            self.lirc_thread = threading.Thread(target=self.ir_listen_thread,daemon=True)
+            self.lirc_thread.start()
+
+    def register_routes(self, router):
+        """Register the MQTT command topics of the IR interface
+
+        Args:
+            router (TopicRouter): bridge command router
+        """
+        router.add('ir/+/tx', self.ir_send, target='ir/{0}')
+        router.add('ir/+/tx/start', self.ir_send_start, target='ir/{0}')
+        router.add('ir/+/tx/stop', self.ir_send_stop, target='ir/{0}')
+
+    def reconfigure(self, config: dict) -> bool:
+        """Apply a changed IR configuration
+
+        A changed command socket is used from the next command on.
+
+        Args:
+            config (dict): IR configuration
+
+        Returns:
+            bool: True if the RX socket changed, see reconnect()
+        """
+        old, self._config = self._config, config
+        self._hold_repeat = max(int(config['hold_repeat']), 1)
+        self._release_timeout = int(config['release_timeout']) / 1000
+        if config['tx_sock_path'] != old['tx_sock_path']:
+            LOGGER.info("Using lircd command socket %s", config['tx_sock_path'])
+            cmd_conn, self.cmd_conn = self.cmd_conn, lircd.CommandConnection(
+                config['tx_sock_path'])
+            cmd_conn.close()
+        return config['rx_sock_path'] != old['rx_sock_path']
+
+    def reconnect(self):
+        """Make the listen thread reconnect to the RX socket."""
+        os.write(self._wakeup_w, b'\0')
+
+    def stop(self):
+        """Stop the listen thread and close the command connection."""
+        self.stop_event.set()
+        os.write(self._wakeup_w, b'\0')
+        if self.lirc_thread:
+            self.lirc_thread.join()
+        self.cmd_conn.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _connect(self, selector) -> socket.socket:
+        """Connect to the lircd RX socket, retrying until stopped
+
+        Returns:
+            socket.socket: connected socket, None if stopped
+        """
+        path = self._config['rx_sock_path'] or lircd.DEFAULT_SOCKET
+        delay = 1
+        while not self.stop_event.is_set():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                sock.setblocking(False)
+                LOGGER.info("Connected to lircd %s", path)
+                return sock
+            except OSError as err:
+                sock.close()
+                LOGGER.warning("Can't connect to lircd %s: %s, retrying in %d seconds",
+                               path, err, delay)
+            # Only the wakeup pipe is registered, this waits for stop or timeout
+            if selector.select(delay):
+                os.read(self._wakeup_r, 64)
+                path = self._config['rx_sock_path'] or lircd.DEFAULT_SOCKET
+                delay = 1
+                continue
+            delay = min(delay * 2, 60)
+        return None
 
     def ir_listen_thread(self):
         """Receive IR remote key press on lirc RX socket and send to MQTT
+
+        Blocks until lircd sends a line or the thread is stopped, only wakes
+        on a timer while a key is held to detect its release.
         """
         LOGGER.info("Running IR listen thread %s rx_sock_path %s",
                     threading.current_thread().name, self._config['rx_sock_path'])
-        self.conn = lirc.RawConnection()
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_r, selectors.EVENT_READ)
         while not self.stop_event.is_set():
-            try:
-                ir_rx_line = self.conn.readline(timeout=0.2)
-                LOGGER.debug("ir_rx_line %s", ir_rx_line)
-                (scan, repeat, key, remote) = ir_rx_line.split()
-                LOGGER.debug("scan %s repeat %s key %s remote %s", scan, repeat, key, remote)
-                if int (repeat) == 0:
-                    self._mqtt_send('ir/' + remote + '/rx', key)
-            except lirc.TimeoutException:
-                pass
+            self.conn = self._connect(selector)
+            if self.conn is None:
+                break
+            selector.register(self.conn, selectors.EVENT_READ)
+            buffer = b''
+            connected = True
+            while connected and not self.stop_event.is_set():
+                events = selector.select(self.ir_release_timeout())
+                if not events:
+                    self.ir_check_release()
+                for key, _ in events:
+                    if key.fileobj is not self.conn:
+                        # Woken by reconnect() or stop()
+                        os.read(self._wakeup_r, 64)
+                        connected = False
+                        break
+                    try:
+                        data = self.conn.recv(4096)
+                    except OSError as err:
+                        LOGGER.warning("lircd RX connection failed: %s", err)
+                        data = b''
+                    if not data:
+                        LOGGER.warning("lircd closed the RX connection")
+                        connected = False
+                        break
+                    buffer += data
+                    *lines, buffer = buffer.split(b'\n')
+                    for line in lines:
+                        self.ir_receive(line.decode(errors='replace'))
+            selector.unregister(self.conn)
+            self.conn.close()
+            self.conn = None
+            self.ir_check_release(force=True)
 
+        selector.close()
         LOGGER.info("Stopping IR listen thread %s", threading.current_thread().name)
-        self.conn.close()
+
+    def ir_receive(self, ir_rx_line: str):
+        """Process a line from lircd: '<code> <repeat> <key> <remote>'
+
+        Publishes the key on ir/<remote>/rx when pressed, on ir/<remote>/hold
+        every hold_repeat repeats and on ir/<remote>/release when released.
+        A bound command is submitted before the event is published.
+
+        Args:
+            ir_rx_line (str): line received from lircd
+        """
+        LOGGER.debug("ir_rx_line %s", ir_rx_line)
+        start = time.perf_counter()
+        if self.recorder:
+            self.recorder.record_ir(ir_rx_line)
+        try:
+            (_code, repeat, key, remote) = ir_rx_line.split()
+            repeat = int(repeat, 16)
+        except ValueError:
+            LOGGER.warning("Ignoring malformed lircd line %r", ir_rx_line)
+            return
+
+        now = time.monotonic()
+        held = self._held
+        if repeat == 0 or held is None or held[0] != remote or held[1] != key:
+            self.ir_check_release(force=True)
+            self._held = [remote, key, now]
+            self._on_key(remote, key, 'press')
+            self._mqtt_send('ir/' + remote + '/rx', key)
+            IR_RECEIVE.observe(time.perf_counter() - start)
+            return
+
+        held[2] = now
+        if repeat % self._hold_repeat == 0:
+            self._on_key(remote, key, 'hold')
+            self._mqtt_send('ir/' + remote + '/hold', key, retain=False)
+            IR_RECEIVE.observe(time.perf_counter() - start)
+
+    def ir_release_timeout(self):
+        """Seconds until a held key is released, None if no key is held"""
+        if self._held is None:
+            return None
+        return max(self._held[2] + self._release_timeout - time.monotonic(), 0)
+
+    def ir_check_release(self, force: bool = False):
+        """Publish the release of the held key once no repeat arrived in time
+
+        Args:
+            force (bool, optional): release the held key now. Defaults to False.
+        """
+        if self._held is None:
+            return
+        if force or time.monotonic() >= self._held[2] + self._release_timeout:
+            remote, key, _ = self._held
+            self._held = None
+            self._on_key(remote, key, 'release')
+            self._mqtt_send('ir/' + remote + '/release', key, retain=False)
 
     def ir_send(self, remote:str, key:str):
-        """Transmit IR keypress
+        """Transmit IR keypresses
+
+        Args:
+            remote (str): remote name
+            key (str): key name, several keys separated by ',' are sent pipelined
+        """
+        keys = [k.strip() for k in key.split(',') if k.strip()]
+        LOGGER.debug("ir_send(%s,%s) to tx_sock_path %s", remote, keys, self.cmd_conn.path)
+        for reply in self.cmd_conn.send_once(remote, keys):
+            IR_SEND.observe(reply.latency)
+            LOGGER.debug("%s success = %s latency %.1f ms", reply.command, reply.success,
+                         reply.latency * 1000)
+
+    def ir_send_start(self, remote:str, key:str):
+        """Start repeating an IR keypress until ir_send_stop
 
         Args:
-            remote (str): _description_
-            key (str): _description_
-        """
-        LOGGER.debug("ir_send(%s,%s) to tx_sock_path %s", remote, key, self._config['tx_sock_path'])
-        cmd_conn = lirc.CommandConnection(self._config['tx_sock_path'])
-        reply = lirc.SendCommand(cmd_conn, remote, [key]).run()
-        LOGGER.debug("success = %s", str(reply.success))
-        for line in reply.data:
-            LOGGER.debug("%s", line)
-        cmd_conn.close()
+            remote (str): remote name
+            key (str): key name
+        """
+        reply = self.cmd_conn.send_start(remote, key)
+        IR_SEND.observe(reply.latency)
+        LOGGER.debug("%s success = %s", reply.command, reply.success)
+
+    def ir_send_stop(self, remote:str, key:str):
+        """Stop repeating an IR keypress
+
+        Args:
+            remote (str): remote name
+            key (str): key name
+        """
+        reply = self.cmd_conn.send_stop(remote, key)
+        IR_SEND.observe(reply.latency)
+        LOGGER.debug("%s success = %s", reply.command, reply.success)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Persistent lircd command connection for the HDMI CEC MQTT bridge
+
+Speaks the lircd socket protocol directly so one connection can be kept
+open, commands can be pipelined and the connection is re-established when
+lircd restarts.
+"""
+import logging
+import socket
+import threading
+import time
+
+from cec_mqtt_bridge import metrics
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = '/var/run/lirc/lircd'
+
+
+class LircdError(Exception):
+    """lircd connection failed or returned an invalid reply"""
+
+
+class Reply:
+    """lircd reply to a command"""
+    __slots__ = ('command', 'success', 'data', 'latency')
+
+    def __init__(self, command: str, success: bool, data: list, latency: float):
+        self.command = command
+        self.success = success
+        self.data = data
+        self.latency = latency
+
+
+class CommandConnection:
+    """Long lived connection to the lircd command socket"""
+    def __init__(self, path: str = None, timeout: float = 2.0):
+        self.path = path or DEFAULT_SOCKET
+        self._timeout = timeout
+        self._sock = None
+        self._buffer = b''
+        self._lock = threading.Lock()
+        self.stats = {
+            'sent': 0,
+            'failed': 0,
+            'reconnects': 0,
+            'latency_last': 0.0,
+            'latency_max': 0.0,
+            'latency_total': 0.0,
+        }
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        LOGGER.debug('Connected to lircd %s', self.path)
+        self._sock = sock
+        self._buffer = b''
+
+    def close(self):
+        """Close the connection."""
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _readline(self) -> str:
+        while b'\n' not in self._buffer:
+            data = self._sock.recv(4096)
+            if not data:
+                raise LircdError('lircd closed the connection')
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode(errors='replace').strip()
+
+    def _read_reply(self) -> tuple:
+        """Read one reply packet, lircd broadcasts (SIGHUP) are skipped
+
+        Returns:
+            tuple[str, bool, list]: command, success, data lines
+        """
+        while True:
+            if self._readline() != 'BEGIN':
+                raise LircdError('Reply does not start with BEGIN')
+            command = self._readline()
+            success = True
+            data = []
+            line = self._readline()
+            if line in ('SUCCESS', 'ERROR'):
+                success = line == 'SUCCESS'
+                line = self._readline()
+            if line == 'DATA':
+                data = [self._readline() for _ in range(int(self._readline()))]
+                line = self._readline()
+            if line != 'END':
+                raise LircdError(f'Unexpected line in reply: {line}')
+            if command != 'SIGHUP':
+                return command, success, data
+
+    def send(self, commands: list) -> list:
+        """Send commands pipelined and wait for all replies.
+
+        Reconnects once if the connection was lost before any command was
+        written. Commands that were written but not answered are not sent
+        again, lircd may have executed them already.
+
+        Args:
+            commands (list[str]): lircd commands, e.g. 'SEND_ONCE remote key'
+
+        Returns:
+            list[Reply]: reply per command
+
+        Raises:
+            LircdError: not every command was answered
+        """
+        replies = []
+        with self._lock:
+            for attempt in range(2):
+                written = 0
+                try:
+                    if self._sock is None:
+                        self._connect()
+                        if attempt:
+                            self.stats['reconnects'] += 1
+                    metrics.command_sending()
+                    sent = time.monotonic()
+                    # One write per command, a failed write leaves at most an
+                    # incomplete line that lircd discards
+                    for command in commands:
+                        self._sock.sendall(f'{command}\n'.encode())
+                        written += 1
+                    for command in commands:
+                        reply_command, success, data = self._read_reply()
+                        latency = time.monotonic() - sent
+                        replies.append(Reply(reply_command, success, data, latency))
+                        self._account(success, latency)
+                        if not success:
+                            LOGGER.warning('lircd %s failed: %s', command, ' '.join(data))
+                    return replies
+                except (OSError, LircdError, ValueError) as err:
+                    LOGGER.warning('lircd connection %s lost: %s', self.path, err)
+                    self._close()
+                if written:
+                    break
+            self.stats['failed'] += len(commands) - len(replies)
+        raise LircdError(f'{len(commands) - len(replies)} of {len(commands)} commands '
+                         f'not answered by lircd')
+
+    def _account(self, success: bool, latency: float):
+        self.stats['sent'] += 1
+        self.stats['failed'] += not success
+        self.stats['latency_last'] = latency
+        self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+        self.stats['latency_total'] += latency
+
+    def send_once(self, remote: str, keys: list) -> list:
+        """Send key presses, pipelined
+
+        Args:
+            remote (str): remote name
+            keys (list[str]): key names
+
+        Returns:
+            list[Reply]: reply per key
+        """
+        return self.send([f'SEND_ONCE {remote} {key}' for key in keys])
+
+    def send_start(self, remote: str, key: str) -> Reply:
+        """Start repeating a key until send_stop"""
+        return self.send([f'SEND_START {remote} {key}'])[0]
+
+    def send_stop(self, remote: str, key: str) -> Reply:
+        """Stop repeating a key"""
+        return self.send([f'SEND_STOP {remote} {key}'])[0]
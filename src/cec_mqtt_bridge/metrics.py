@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Metrics for the HDMI CEC MQTT bridge
+
+Counters and fixed bucket histograms cheap enough to stay enabled in
+production. The registry is exported as JSON on <prefix>/bridge/stats and
+optionally in the Prometheus text format on a local HTTP port.
+"""
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONFIGURATION = {
+    'interval': '60',
+    'port': '0',
+    'address': '127.0.0.1',
+}
+
+# Histogram bucket upper bounds in seconds, 100 µs doubling up to ~13 s
+LATENCY_BUCKETS = tuple(0.0001 * 2 ** i for i in range(18))
+
+
+class Counter:
+    """Monotonic counter"""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        """Increment the counter."""
+        self.value += amount
+
+
+class Histogram:
+    """Distribution of observed values in fixed buckets"""
+    __slots__ = ('_bounds', '_lock', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self._bounds = bounds
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(bounds) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """Record a value."""
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, quantile: float) -> float:
+        """Estimate a quantile as the upper bound of its bucket
+
+        Args:
+            quantile (float): 0..1
+
+        Returns:
+            float: estimated value, 0 if nothing was observed
+        """
+        rank = quantile * self.count
+        total = 0
+        for bound, count in zip(self._bounds, self.counts):
+            total += count
+            if total >= rank and total:
+                return min(bound, self.max)
+        return self.max
+
+    def buckets(self) -> list:
+        """Cumulative counts per upper bound, the last bound is +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(self._bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def summary(self) -> dict:
+        """Count, average and estimated percentiles"""
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'avg': self.sum / self.count,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+
+class Registry:
+    """Named metrics with optional labels"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}     # name -> (help, {label values: metric})
+        self._labels = {}      # name -> label names
+        self._collectors = {}  # name -> callable returning {key: number}
+        self._last = {}        # counter key -> value at the last snapshot
+        self._last_time = time.monotonic()
+        self.started = time.time()
+
+    def _get(self, factory, name: str, help_text: str, labels: dict):
+        key = tuple(labels.values())
+        with self._lock:
+            _, metrics = self._metrics.setdefault(name, (help_text, {}))
+            self._labels.setdefault(name, tuple(labels))
+            metric = metrics.get(key)
+            if metric is None:
+                metric = metrics[key] = factory()
+            return metric
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        """Get or create a counter
+
+        Args:
+            name (str): metric name
+            help_text (str): description
+            **labels: label values
+
+        Returns:
+            Counter: counter
+        """
+        return self._get(Counter, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str, **labels) -> Histogram:
+        """Get or create a latency histogram
+
+        Args:
+            name (str): metric name, in seconds
+            help_text (str): description
+            **labels: label values
+
+        Returns:
+            Histogram: histogram
+        """
+        return self._get(Histogram, name, help_text, labels)
+
+    def collector(self, name: str, func: callable):
+        """Register a callable returning a dict of values, e.g. queue stats
+
+        Args:
+            name (str): metric name prefix
+            func (callable): returns {key: number}
+        """
+        with self._lock:
+            self._collectors[name] = func
+
+    def _collect(self) -> dict:
+        with self._lock:
+            collectors = list(self._collectors.items())
+        result = {}
+        for name, func in collectors:
+            try:
+                result[name] = func()
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Metrics collector %s failed', name)
+        return result
+
+    def _items(self):
+        with self._lock:
+            return [(name, help_text, self._labels[name], dict(metrics))
+                    for name, (help_text, metrics) in self._metrics.items()]
+
+    def snapshot(self) -> dict:
+        """All metrics as JSON serializable dict, counters with their rate per second"""
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        self._last_time = now
+        result = {'uptime': round(time.time() - self.started)}
+        for name, _, label_names, metrics in self._items():
+            values = {}
+            for key, metric in metrics.items():
+                if isinstance(metric, Counter):
+                    last = self._last.get((name, key), 0)
+                    self._last[(name, key)] = metric.value
+                    value = {'total': metric.value, 'rate': (metric.value - last) / elapsed}
+                else:
+                    value = metric.summary()
+                values[','.join(key)] = value
+            result[name] = values[''] if not label_names else values
+        result.update(self._collect())
+        return result
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for name, help_text, label_names, metrics in self._items():
+            kind = 'counter' if any(isinstance(m, Counter) for m in metrics.values()) \
+                else 'histogram'
+            metric_name = name + '_total' if kind == 'counter' else name
+            lines.append(f'# HELP {metric_name} {help_text}')
+            lines.append(f'# TYPE {metric_name} {kind}')
+            for key, metric in metrics.items():
+                labels = [f'{label}="{value}"' for label, value in zip(label_names, key)]
+                if kind == 'counter':
+                    lines.append(f'{metric_name}{_labels(labels)} {metric.value}')
+                    continue
+                for bound, count in metric.buckets():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    bucket_labels = labels + [f'le="{le}"']
+                    lines.append(f'{name}_bucket{_labels(bucket_labels)} {count}')
+                lines.append(f'{name}_sum{_labels(labels)} {metric.sum}')
+                lines.append(f'{name}_count{_labels(labels)} {metric.count}')
+        for name, values in self._collect().items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'# TYPE {name}_{key} gauge')
+                    lines.append(f'{name}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: list) -> str:
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+REGISTRY = Registry()
+
+COMMAND_LATENCY = REGISTRY.histogram(
+    'command_to_transmit_seconds', 'MQTT command received until it is sent to the device')
+
+# MQTT arrival time of the command the current thread is executing
+_command = threading.local()
+
+
+def command_received(received: float):
+    """Set the arrival time of the command the current thread executes
+
+    Args:
+        received (float): time.monotonic() when the MQTT message arrived,
+            None when the command is done
+    """
+    _command.received = received
+
+
+def command_sending():
+    """Record the command latency when its first frame is sent to the device"""
+    received = getattr(_command, 'received', None)
+    if received is not None:
+        _command.received = None
+        COMMAND_LATENCY.observe(time.monotonic() - received)
+
+
+class Instrumented:
+    """Proxy timing selected methods of an object, other attributes pass through"""
+    def __init__(self, target, name: str, calls: tuple, sends: tuple = ()):
+        """
+        Args:
+            target: object to wrap, e.g. the libcec adapter
+            name (str): histogram name, labeled with the method name
+            calls (tuple[str]): methods to time
+            sends (tuple[str]): methods that send a command to the device
+        """
+        self._target = target
+        for call in calls:
+            setattr(self, call, self._timed(getattr(target, call),
+                                            REGISTRY.histogram(name, 'Call duration', call=call),
+                                            call in sends))
+
+    @staticmethod
+    def _timed(func: callable, histogram: Histogram, sends: bool) -> callable:
+        def timed(*args):
+            if sends:
+                command_sending()
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return timed
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if callable(value):
+            # Cache the bound method, the next lookup is a plain attribute
+            setattr(self, name, value)
+        return value
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve /metrics"""
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        LOGGER.debug(format, *args)
+
+
+class MetricsServer:
+    """Prometheus endpoint on http://<address>:<port>/metrics"""
+    def __init__(self, address: str, port: int, registry: Registry = REGISTRY):
+        self._server = http.server.ThreadingHTTPServer((address, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='metrics-http', daemon=True)
+        self._thread.start()
+        LOGGER.info('Serving metrics on http://%s:%d/metrics', address, port)
+
+    def stop(self):
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Outbound MQTT queue of the HDMI CEC MQTT bridge
+
+Messages are queued by the publishing thread (libcec callbacks, the IR
+receiver, command workers) and written to paho by one flusher, only while
+connected and with at most `window` messages waiting in paho. State topics
+(device power, audio status, ...) are coalesced per topic, only the newest
+payload is kept. Every other message is an event (e.g. cec/rx, cec/key and
+ir/<remote>/rx, retained or not) and is kept in order in a bounded queue, the
+oldest are dropped and counted when it is full. On reconnect the queue is
+flushed at once.
+"""
+import collections
+import logging
+import math
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Publisher:
+    """Latest value wins publish queue in front of the paho client"""
+    def __init__(self, publish: callable, connected: callable, events: int = 100,
+                 window: int = 100, thread: bool = True, wakeup=None):
+        """
+        Args:
+            publish (callable): publish(topic, payload, qos, retain), returns
+                the paho MQTTMessageInfo
+            connected (callable): whether the client is connected
+            events (int, optional): maximum number of queued events. Defaults to 100.
+            window (int, optional): maximum number of messages waiting in paho
+                to be written to the socket. Defaults to 100.
+            thread (bool, optional): flush on an own thread, otherwise the owner
+                calls flush() when wakeup is set. Defaults to True.
+            wakeup (threading.Event, optional): set when there is something to
+                flush. Defaults to None (own event).
+        """
+        self._publish = publish
+        self._connected = connected
+        self._window = max(window, 1)
+        self._lock = threading.Lock()
+        self._state = {}  # topic -> (payload, qos), in first queued order
+        self._events = collections.deque(maxlen=max(events, 1))  # (topic, payload, qos, retain)
+        self._in_flight = collections.deque()  # MQTTMessageInfo not yet written
+        self._wakeup = wakeup or threading.Event()
+        self._stopped = False
+
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+        self._thread = None
+        if thread:
+            self._thread = threading.Thread(target=self._flush_thread, name='mqtt-publish',
+                                            daemon=True)
+            self._thread.start()
+
+    def configure(self, events: int = 100):
+        """Change the event queue size, queued events are kept."""
+        with self._lock:
+            if self._events.maxlen != events:
+                dropped = max(len(self._events) - events, 0)
+                self._events = collections.deque(self._events, maxlen=max(events, 1))
+                self.dropped += dropped
+
+    def put(self, topic: str, payload=None, qos: int = 0, retain: bool = True,
+            state: bool = False):
+        """Queue a message
+
+        Args:
+            topic (str): full topic
+            payload (_type_, optional): payload. Defaults to None.
+            qos (int, optional): qos. Defaults to 0.
+            retain (bool, optional): retain flag of an event. Defaults to True.
+            state (bool, optional): retained state, replaces a queued payload
+                of the same topic. Defaults to False (event).
+        """
+        with self._lock:
+            if state:
+                if topic in self._state:
+                    self.coalesced += 1
+                self._state[topic] = (payload, qos)
+            else:
+                if len(self._events) == self._events.maxlen:
+                    self.dropped += 1
+                self._events.append((topic, payload, qos, retain))
+        self._wakeup.set()
+
+    def wake(self):
+        """Flush now, e.g. after reconnecting."""
+        self._wakeup.set()
+
+    def _room(self) -> int:
+        """Messages that may be handed to paho now"""
+        while self._in_flight and self._in_flight[0].is_published():
+            self._in_flight.popleft()
+        return self._window - len(self._in_flight)
+
+    def flush(self, everything: bool = False) -> bool:
+        """Hand queued messages to paho as far as the window allows
+
+        Args:
+            everything (bool, optional): ignore the window. Defaults to False.
+
+        Returns:
+            bool: messages are left in the queue while connected, call again
+                once paho wrote some
+        """
+        if not self._connected():
+            return False
+        room = math.inf if everything else self._room()
+        batch = []
+        with self._lock:
+            # State first, it is the newest, events keep their order
+            while self._state and len(batch) < room:
+                topic = next(iter(self._state))
+                payload, qos = self._state.pop(topic)
+                batch.append((topic, payload, qos, True))
+            while self._events and len(batch) < room:
+                batch.append(self._events.popleft())
+            pending = bool(self._state or self._events)
+        for topic, payload, qos, retain in batch:
+            info = self._publish(topic, payload, qos, retain)
+            if info is not None and not info.is_published():
+                self._in_flight.append(info)
+        self.published += len(batch)
+        return pending
+
+    def _flush_thread(self):
+        while not self._stopped:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Give paho time to write, new state coalesces meanwhile
+            while self.flush() and not self._stopped:
+                self._wakeup.wait(0.01)
+                self._wakeup.clear()
+
+    def stats(self) -> dict:
+        """Queue lengths and counters"""
+        with self._lock:
+            return {'state': len(self._state), 'events': len(self._events),
+                    'in_flight': len(self._in_flight), 'published': self.published,
+                    'coalesced': self.coalesced, 'dropped': self.dropped}
+
+    def stop(self):
+        """Stop the flush thread and hand the queued messages to paho."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.flush(everything=True)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""CEC, IR and MQTT traffic recorder and replayer for the HDMI CEC MQTT bridge
+
+The log is an append-only file of fixed size records, so it can be memory
+mapped and scanned without parsing:
+
+    header  RECORD_SIZE bytes: magic, version, record size
+    record  RECORD_SIZE bytes: monotonic time (ns), kind, flags, length, payload
+
+Every bridge start appends a session record with the wall clock time,
+monotonic timestamps are only comparable within a session.
+
+    python3 -m cec_mqtt_bridge.recorder traffic.rec
+"""
+import argparse
+import mmap
+import struct
+import threading
+import time
+
+DEFAULT_CONFIGURATION = {
+    'file': '',
+}
+
+MAGIC = b'CECREC\x00\x01'
+RECORD_SIZE = 256
+HEADER = struct.Struct('<8sHH')
+RECORD = struct.Struct('<QBBH')
+MAX_PAYLOAD = RECORD_SIZE - RECORD.size
+
+KIND_SESSION = 0  # payload: wall clock time as text
+KIND_CEC = 1      # payload: libcec command string, '>> 0f:87:00:00:f0'
+KIND_IR = 2       # payload: lircd line
+KIND_MQTT = 3     # payload: topic, NUL, message payload
+KIND_NAMES = {KIND_SESSION: 'session', KIND_CEC: 'cec', KIND_IR: 'ir', KIND_MQTT: 'mqtt'}
+
+FLAG_TRUNCATED = 1
+
+# Seconds between flushes of the write buffer
+FLUSH_INTERVAL = 1.0
+
+
+class Recorder:
+    """Appends records to a traffic log"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')  # pylint: disable=consider-using-with
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, 1, RECORD_SIZE).ljust(RECORD_SIZE, b'\0'))
+        elif self._file.tell() % RECORD_SIZE:
+            # Torn last record after a crash, pad it so the records stay aligned
+            self._file.write(b'\0' * (RECORD_SIZE - self._file.tell() % RECORD_SIZE))
+        self._flushed = time.monotonic()
+        self.records = 0
+        self.truncated = 0
+        self.record(KIND_SESSION, time.strftime('%Y-%m-%dT%H:%M:%S%z').encode())
+
+    def record(self, kind: int, payload: bytes):
+        """Append a record, payloads longer than MAX_PAYLOAD are truncated
+
+        Args:
+            kind (int): KIND_*
+            payload (bytes): record payload
+        """
+        flags = 0
+        if len(payload) > MAX_PAYLOAD:
+            payload = payload[:MAX_PAYLOAD]
+            flags = FLAG_TRUNCATED
+        now = time.monotonic_ns()
+        data = RECORD.pack(now, kind, flags, len(payload)) + payload
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(data.ljust(RECORD_SIZE, b'\0'))
+            self.records += 1
+            self.truncated += flags
+            if now / 1e9 - self._flushed > FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed = now / 1e9
+
+    def record_cec(self, cmd: str):
+        """Record a frame passed to the libcec command callback"""
+        self.record(KIND_CEC, cmd.encode())
+
+    def record_ir(self, line: str):
+        """Record a line received from lircd"""
+        self.record(KIND_IR, line.encode())
+
+    def record_mqtt(self, topic: str, payload: bytes):
+        """Record an incoming MQTT command"""
+        self.record(KIND_MQTT, topic.encode() + b'\0' + payload)
+
+    def close(self):
+        """Flush and close the log."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class Record:
+    """Record read from a traffic log"""
+    __slots__ = ('timestamp', 'kind', 'flags', 'payload')
+
+    def __init__(self, timestamp: int, kind: int, flags: int, payload: bytes):
+        self.timestamp = timestamp
+        self.kind = kind
+        self.flags = flags
+        self.payload = payload
+
+    def __str__(self):
+        if self.kind == KIND_MQTT:
+            topic, _, payload = self.payload.partition(b'\0')
+            text = f'{topic.decode(errors="replace")} {payload.decode(errors="replace")}'
+        else:
+            text = self.payload.decode(errors='replace')
+        truncated = ' (truncated)' if self.flags & FLAG_TRUNCATED else ''
+        return f'{self.timestamp / 1e9:14.6f} {KIND_NAMES.get(self.kind, self.kind):7} ' \
+               f'{text}{truncated}'
+
+
+class RecordLog:
+    """Memory mapped, read only view of a traffic log"""
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            magic, _version, record_size = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD_SIZE:
+                raise ValueError(f'{path} is not a traffic log')
+            file.seek(0, 2)
+            self._count = file.tell() // RECORD_SIZE - 1
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if self._count > 0 else b''
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index: int) -> Record:
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        offset = (index + 1) * RECORD_SIZE
+        timestamp, kind, flags, length = RECORD.unpack_from(self._map, offset)
+        start = offset + RECORD.size
+        return Record(timestamp, kind, flags, bytes(self._map[start:start + length]))
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def counts(self) -> dict:
+        """Number of records per kind, reads only the record headers"""
+        counts = {}
+        for index in range(self._count):
+            kind = self._map[(index + 1) * RECORD_SIZE + 8]
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def close(self):
+        """Unmap the log."""
+        if self._map:
+            self._map.close()
+
+
+class _Message:  # pylint: disable=too-few-public-methods
+    """Stands in for paho's MQTTMessage"""
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+class Replayer:
+    """Feeds a traffic log back into a running bridge"""
+    def __init__(self, bridge, log: RecordLog, speed: float = 1.0):
+        """
+        Args:
+            bridge (Bridge): started bridge
+            log (RecordLog): traffic log
+            speed (float, optional): 1 replays at the original speed, 2 twice
+                as fast, 0 as fast as possible. Defaults to 1.0.
+        """
+        self._bridge = bridge
+        self._log = log
+        self._speed = speed
+        self.replayed = {}
+        self.skipped = 0
+
+    def _feed(self, record: Record) -> bool:
+        bridge = self._bridge
+        if record.kind == KIND_CEC and bridge.cec_class:
+            bridge.cec_class._on_command_callback(  # pylint: disable=protected-access
+                record.payload.decode(errors='replace'))
+        elif record.kind == KIND_IR and bridge.ir_class:
+            bridge.ir_class.ir_receive(record.payload.decode(errors='replace'))
+        elif record.kind == KIND_MQTT and not record.flags & FLAG_TRUNCATED:
+            topic, _, payload = record.payload.partition(b'\0')
+            bridge.mqtt_on_message(None, None, _Message(topic.decode(), payload))
+        else:
+            return False
+        return True
+
+    def run(self, stop_event: threading.Event = None) -> float:
+        """Replay all records
+
+        Args:
+            stop_event (threading.Event, optional): stops the replay when set
+
+        Returns:
+            float: seconds the replay took
+        """
+        start = time.monotonic()
+        offset = None  # replay time - recorded time, per session
+        for record in self._log:
+            if stop_event is not None and stop_event.is_set():
+                break
+            if record.kind == KIND_SESSION:
+                offset = None
+                continue
+            if self._speed > 0:
+                now = time.monotonic()
+                if offset is None:
+                    offset = now - record.timestamp / 1e9 / self._speed
+                delay = offset + record.timestamp / 1e9 / self._speed - now
+                if delay > 0:
+                    time.sleep(delay)
+            if self._feed(record):
+                self.replayed[record.kind] = self.replayed.get(record.kind, 0) + 1
+            else:
+                self.skipped += 1
+        return time.monotonic() - start
+
+
+def main():
+    """Print a traffic log"""
+    parser = argparse.ArgumentParser(description='Print a CEC MQTT bridge traffic log')
+    parser.add_argument('file')
+    parser.add_argument('-s', '--summary', action='store_true', help='only count records')
+    args = parser.parse_args()
+
+    log = RecordLog(args.file)
+    if args.summary:
+        for kind, count in sorted(log.counts().items()):
+            print(f'{KIND_NAMES.get(kind, kind):7} {count}')
+    else:
+        for record in log:
+            print(record)
+    log.close()
+
+
+if __name__ == '__main__':
+    main()
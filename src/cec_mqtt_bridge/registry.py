@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Persistent CEC device registry for the HDMI CEC MQTT bridge
+
+Keeps the discovered topology in a small JSON file so it can be published
+right after startup, before the bus has been scanned again.
+"""
+import json
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+# Device fields that describe the topology and don't change at runtime
+FIELDS = ('type', 'address', 'vendor', 'osd', 'cecver')
+
+
+class DeviceRegistry:
+    """Discovered CEC devices, persisted to disk"""
+    def __init__(self, path: str):
+        self.path = path
+        self.devices = {}  # logical address -> {field: value}
+        self._dirty = False
+        if path:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                devices = json.load(file)
+            self.devices = {int(device): {field: str(info[field]) for field in FIELDS}
+                            for device, info in devices.items()}
+            LOGGER.info('Loaded %d cached devices from %s', len(self.devices), self.path)
+        except FileNotFoundError:
+            LOGGER.info('No device cache %s yet', self.path)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            LOGGER.warning('Ignoring invalid device cache %s: %s', self.path, err)
+
+    def update(self, device: int, info: dict) -> bool:
+        """Store the topology of a device
+
+        Args:
+            device (int): logical address
+            info (dict): value per field in FIELDS
+
+        Returns:
+            bool: True if the device is new or changed
+        """
+        info = {field: info[field] for field in FIELDS}
+        if self.devices.get(device) == info:
+            return False
+        self.devices[device] = info
+        self._dirty = True
+        return True
+
+    def remove(self, device: int) -> bool:
+        """Forget a device that is no longer on the bus
+
+        Returns:
+            bool: True if the device was known
+        """
+        if self.devices.pop(device, None) is None:
+            return False
+        self._dirty = True
+        return True
+
+    def save(self):
+        """Write the registry to disk if it changed."""
+        if not self.path or not self._dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump({str(device): info for device, info in self.devices.items()},
+                          file, indent=1)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            LOGGER.debug('Saved %d devices to %s', len(self.devices), self.path)
+        except OSError as err:
+            LOGGER.warning('Could not save device cache %s: %s', self.path, err)
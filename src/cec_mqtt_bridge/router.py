@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""MQTT command topic router for the HDMI CEC MQTT bridge
+
+Subsystems register the command topics they handle. Topic patterns may
+contain '+' wildcards, the matching topic levels are passed to the handler.
+"""
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Route:
+    """Registered command topic"""
+    __slots__ = ('pattern', 'handler', 'target', 'merge', 'types')
+
+    def __init__(self, pattern: str, handler: callable, target, merge, types: tuple):
+        self.pattern = pattern
+        self.handler = handler
+        self.target = target
+        self.merge = merge
+        self.types = types
+
+    def executor_target(self, args: tuple, payload: str) -> str:
+        """Executor target of a command on this route
+
+        Args:
+            args (tuple): parsed wildcard topic levels
+            payload (str): command payload
+
+        Returns:
+            str: executor target
+        """
+        if callable(self.target):
+            return self.target(args, payload)
+        return self.target.format(*args)
+
+    def mergeable(self, payload: str) -> bool:
+        """Whether a command on this route may replace a pending one"""
+        if callable(self.merge):
+            return self.merge(payload)
+        return self.merge
+
+
+class TopicRouter:
+    """Maps command topics to handlers"""
+    def __init__(self, prefix: str):
+        self._prefix = prefix + '/'
+        self._exact = {}     # topic -> route
+        self._wildcard = {}  # (number of levels, first level) -> [(levels, route)]
+        self._lock = threading.Lock()
+        self.routed = 0
+        self.unknown = 0
+        self.invalid = 0
+
+    def add(self, pattern: str, handler: callable, target=None, merge=False, types: tuple = ()):
+        """Register a command topic.
+
+        Args:
+            pattern (str): topic without bridge prefix, may contain '+' wildcards
+            handler (callable): called with the parsed wildcard levels and the payload
+            target (str or callable, optional): executor target, a format string
+                for the wildcard levels or a callable(args, payload).
+                Defaults to the pattern.
+            merge (bool or callable, optional): commands may replace a pending
+                command on the same topic, or a callable(payload). Defaults to False.
+            types (tuple, optional): converters for the wildcard levels.
+                Defaults to () (passed as str).
+        """
+        route = Route(pattern, handler, pattern if target is None else target, merge, types)
+        levels = tuple(pattern.split('/'))
+        if '+' in levels and levels[0] == '+':
+            raise ValueError(f"Pattern can't start with a wildcard: {pattern}")
+        with self._lock:
+            if '+' in levels:
+                key = (len(levels), levels[0])
+                # Replace the list, match() iterates it without the lock
+                self._wildcard[key] = self._wildcard.get(key, []) + [(levels, route)]
+            else:
+                self._exact[pattern] = route
+
+    @property
+    def prefix(self) -> str:
+        """Bridge prefix of the command topics"""
+        return self._prefix[:-1]
+
+    @prefix.setter
+    def prefix(self, prefix: str):
+        self._prefix = prefix + '/'
+
+    def subscriptions(self, qos: int = 0) -> list:
+        """Subscriptions for all registered topics
+
+        Args:
+            qos (int, optional): subscription qos. Defaults to 0.
+
+        Returns:
+            list[tuple[str, int]]: topics including bridge prefix, qos
+        """
+        with self._lock:
+            patterns = list(self._exact)
+            for routes in self._wildcard.values():
+                patterns.extend(route.pattern for _, route in routes)
+        return [(self._prefix + pattern, qos) for pattern in patterns]
+
+    def match(self, topic: str) -> tuple:
+        """Find the route of a topic
+
+        Args:
+            topic (str): topic including bridge prefix
+
+        Returns:
+            tuple[Route, tuple]: route and parsed wildcard levels, (None, None)
+                if there is no route
+        """
+        if not topic.startswith(self._prefix):
+            self.unknown += 1
+            return None, None
+        topic = topic[len(self._prefix):]
+
+        route = self._exact.get(topic)
+        if route is not None:
+            self.routed += 1
+            return route, ()
+
+        levels = topic.split('/')
+        for pattern, route in self._wildcard.get((len(levels), levels[0]), ()):
+            args = []
+            for pattern_level, level in zip(pattern, levels):
+                if pattern_level == '+':
+                    args.append(level)
+                elif pattern_level != level:
+                    break
+            else:
+                try:
+                    args = tuple(convert(arg) for convert, arg in zip(route.types, args)) \
+                        + tuple(args[len(route.types):])
+                except ValueError:
+                    LOGGER.warning('Invalid topic %s for %s', topic, route.pattern)
+                    self.invalid += 1
+                    return None, None
+                self.routed += 1
+                return route, args
+
+        self.unknown += 1
+        return None, None
+
+    def stats(self) -> dict:
+        """Return routing statistics"""
+        return {'routed': self.routed, 'unknown': self.unknown, 'invalid': self.invalid}
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Received CEC frame stream for the HDMI CEC MQTT bridge
+
+Forwards received frames to cec/rx, not retained by default. Frames can be
+filtered by opcode and initiator, are rate limited by a token bucket and can
+be published in batches. The last frames are kept in a ring buffer that can
+be queried with cec/rx/history.
+"""
+import collections
+import json
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_hex_list(values: str) -> frozenset:
+    """Parse a comma separated list of hex numbers
+
+    Args:
+        values (str): e.g. '82,84,87', empty for none
+
+    Returns:
+        frozenset: parsed numbers
+    """
+    return frozenset(int(value, 16) for value in values.split(',') if value.strip())
+
+
+class RxStream:
+    """Filter, rate limit, batch and remember received CEC frames"""
+    def __init__(self, mqtt_send: callable, retain: bool = False, opcodes: frozenset = None,
+                 initiators: frozenset = None, rate: float = 0, burst: int = 20,
+                 batch: float = 0, history: int = 100):
+        """
+        Args:
+            mqtt_send (callable): bridge publish function
+            retain (bool, optional): publish cec/rx retained. Defaults to False.
+            opcodes (frozenset, optional): forward only these opcodes.
+                Defaults to None (all).
+            initiators (frozenset, optional): forward only frames from these
+                logical addresses. Defaults to None (all).
+            rate (float, optional): forwarded frames per second, 0 is
+                unlimited. Defaults to 0.
+            burst (int, optional): token bucket size. Defaults to 20.
+            batch (float, optional): publish the frames as JSON array on
+                cec/rx/batch every batch seconds, 0 publishes every frame on
+                cec/rx. Defaults to 0.
+            history (int, optional): frames kept in the ring buffer. Defaults to 100.
+        """
+        self._mqtt_send = mqtt_send
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+        # (time.time(), frame) of the last received frames, filtered or not
+        self._history = collections.deque()
+        self.configure(retain, opcodes, initiators, rate, burst, batch, history)
+
+        self.forwarded = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def configure(self, retain: bool = False, opcodes: frozenset = None,
+                  initiators: frozenset = None, rate: float = 0, burst: int = 20,
+                  batch: float = 0, history: int = 100):
+        """Change the settings, see __init__. The history and the pending batch are kept."""
+        with self._lock:
+            self._retain = retain
+            self._opcodes = opcodes or None
+            self._initiators = initiators or None
+            self._rate = rate
+            self._burst = max(burst, 1)
+            self._tokens = float(self._burst)
+            self._refilled = time.monotonic()
+            self._batch = batch
+            if self._history.maxlen != history:
+                self._history = collections.deque(self._history, maxlen=history)
+
+    def _allowed(self) -> bool:
+        """Take a token from the bucket, called with the lock held"""
+        if not self._rate:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled) * self._rate)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def add(self, frame):
+        """Handle a received frame
+
+        Args:
+            frame (CecFrame): received frame
+        """
+        with self._lock:
+            self._history.append((time.time(), frame.raw))
+            if (self._opcodes is not None and frame.opcode not in self._opcodes) or \
+                    (self._initiators is not None and frame.initiator not in self._initiators):
+                self.filtered += 1
+                return
+            if not self._allowed():
+                self.dropped += 1
+                return
+            self.forwarded += 1
+            if self._batch:
+                self._pending.append(frame.raw)
+                if self._timer is None:
+                    self._timer = threading.Timer(self._batch, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self._mqtt_send('cec/rx', frame.raw, retain=self._retain)
+
+    def flush(self):
+        """Publish the pending batch."""
+        with self._lock:
+            frames, self._pending = self._pending, []
+            self._timer = None
+            if frames:
+                self.batches += 1
+        if frames:
+            self._mqtt_send('cec/rx/batch', json.dumps(frames), retain=False)
+
+    def history(self, count: int = None) -> list:
+        """Last received frames, oldest first
+
+        Args:
+            count (int, optional): number of frames. Defaults to None (all).
+
+        Returns:
+            list[dict]: 'time' (unix time) and 'frame' of each frame
+        """
+        with self._lock:
+            frames = list(self._history)
+        if count is not None:
+            frames = frames[-count:] if count > 0 else []
+        return [{'time': round(at, 3), 'frame': raw} for at, raw in frames]
+
+    def stats(self) -> dict:
+        """Forward, filter and drop counters"""
+        with self._lock:
+            return {'forwarded': self.forwarded, 'filtered': self.filtered,
+                    'dropped': self.dropped, 'batches': self.batches,
+                    'history': len(self._history)}
+
+    def stop(self):
+        """Cancel the batch timer and publish the pending batch."""
+        with self._lock:
+            timer = self._timer
+        if timer:
+            timer.cancel()
+        self.flush()
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Simulated CEC adapter for the HDMI CEC MQTT bridge
+
+Implements the part of the libcec python bindings (the ``cec`` module) the
+bridge uses on an in-process bus, so it can be benchmarked and tested
+without HDMI hardware. Devices, per call latency, NACK rate and spontaneous
+events are configurable.
+
+    simcec.BUS = simcec.SimBus(latency=0.01, nack_rate=0.05, event_interval=2)
+"""
+import collections
+import logging
+import queue
+import random
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# libcec constants used by the bridge
+CEC_LOG_ERROR = 1
+CEC_LOG_WARNING = 2
+CEC_LOG_NOTICE = 4
+CEC_LOG_TRAFFIC = 8
+CEC_LOG_DEBUG = 16
+CEC_LOG_ALL = 31
+
+CEC_DEVICE_TYPE_RECORDING_DEVICE = 1
+LIBCEC_VERSION_CURRENT = 0x060000
+
+CEC_POWER_STATUS_ON = 0x00
+CEC_POWER_STATUS_STANDBY = 0x01
+CEC_POWER_STATUS_IN_TRANSITION_STANDBY_TO_ON = 0x02
+CEC_POWER_STATUS_IN_TRANSITION_ON_TO_STANDBY = 0x03
+CEC_POWER_STATUS_UNKNOWN = 0x99
+
+CEC_AUDIO_VOLUME_STATUS_UNKNOWN = 0x7F
+
+CEC_OPCODE_ACTIVE_SOURCE = 0x82
+CEC_OPCODE_IMAGE_VIEW_ON = 0x04
+CEC_OPCODE_TEXT_VIEW_ON = 0x0D
+CEC_OPCODE_STANDBY = 0x36
+CEC_OPCODE_SET_MENU_LANGUAGE = 0x32
+CEC_OPCODE_SET_OSD_NAME = 0x47
+CEC_OPCODE_GIVE_OSD_NAME = 0x46
+CEC_OPCODE_USER_CONTROL_PRESSED = 0x44
+CEC_OPCODE_USER_CONTROL_RELEASE = 0x45
+CEC_OPCODE_GIVE_AUDIO_STATUS = 0x71
+CEC_OPCODE_SET_SYSTEM_AUDIO_MODE = 0x72
+CEC_OPCODE_REPORT_AUDIO_STATUS = 0x7A
+CEC_OPCODE_ROUTING_CHANGE = 0x80
+CEC_OPCODE_GIVE_PHYSICAL_ADDRESS = 0x83
+CEC_OPCODE_REPORT_PHYSICAL_ADDRESS = 0x84
+CEC_OPCODE_DEVICE_VENDOR_ID = 0x87
+CEC_OPCODE_VENDOR_COMMAND = 0x89
+CEC_OPCODE_GIVE_DEVICE_VENDOR_ID = 0x8C
+CEC_OPCODE_GIVE_DEVICE_POWER_STATUS = 0x8F
+CEC_OPCODE_REPORT_POWER_STATUS = 0x90
+
+CEC_USER_CONTROL_CODE_VOLUME_UP = 0x41
+CEC_USER_CONTROL_CODE_VOLUME_DOWN = 0x42
+CEC_USER_CONTROL_CODE_MUTE = 0x43
+
+BROADCAST = 0xF
+
+POWER_STATUS_NAMES = {
+    CEC_POWER_STATUS_ON: 'on',
+    CEC_POWER_STATUS_STANDBY: 'standby',
+    CEC_POWER_STATUS_IN_TRANSITION_STANDBY_TO_ON: 'in transition from standby to on',
+    CEC_POWER_STATUS_IN_TRANSITION_ON_TO_STANDBY: 'in transition from on to standby',
+}
+LOGICAL_ADDRESS_NAMES = (
+    'TV', 'Recorder 1', 'Recorder 2', 'Tuner 1', 'Playback 1', 'Audio', 'Tuner 2',
+    'Tuner 3', 'Playback 2', 'Recorder 3', 'Tuner 4', 'Playback 3', 'Reserved 1',
+    'Reserved 2', 'Free use', 'Broadcast')
+VENDOR_NAMES = {0x0000F0: 'Samsung', 0x0005CD: 'Denon', 0x00E091: 'LG', 0x08001F: 'Sony'}
+CEC_VERSION_NAMES = {4: '1.3a', 5: '1.4', 6: '2.0'}
+OPCODE_NAMES = {value: name[len('CEC_OPCODE_'):].lower().replace('_', ' ')
+                for name, value in globals().items() if name.startswith('CEC_OPCODE_')}
+
+
+class SimDevice:
+    """Device on the simulated bus"""
+    def __init__(self, address: int, physical: int, name: str, vendor: int = 0,
+                 power: int = CEC_POWER_STATUS_STANDBY, cec_version: int = 5):
+        self.address = address
+        self.physical = physical
+        self.name = name
+        self.vendor = vendor
+        self.power = power
+        self.cec_version = cec_version
+
+
+def default_devices() -> list:
+    """TV, AVR and a player"""
+    return [
+        SimDevice(0, 0x0000, 'TV', 0x0000F0, CEC_POWER_STATUS_ON),
+        SimDevice(4, 0x1100, 'Player', 0x08001F),
+        SimDevice(5, 0x1000, 'AVR', 0x0005CD, CEC_POWER_STATUS_ON),
+    ]
+
+
+class SimCommand:
+    """Parsed CEC frame, stands in for cec_command"""
+    __slots__ = ('initiator', 'destination', 'opcode', 'parameters', 'frame')
+
+    def __init__(self, frame: str):
+        data = bytes.fromhex(frame.replace(':', ''))
+        self.initiator = data[0] >> 4
+        self.destination = data[0] & 0xF
+        self.opcode = data[1] if len(data) > 1 else None
+        self.parameters = data[2:]
+        self.frame = frame.lower()
+
+
+class SimBus:
+    """Simulated CEC bus shared by the adapters opened on it"""
+    def __init__(self, devices: list = None, latency: float = 0.0, nack_rate: float = 0.0,
+                 event_interval: float = 0.0, seed: int = None):
+        """
+        Args:
+            devices (list[SimDevice], optional): devices on the bus.
+                Defaults to default_devices().
+            latency (float, optional): seconds each adapter call blocks. Defaults to 0.
+            nack_rate (float, optional): probability a frame is not acknowledged.
+                Defaults to 0.
+            event_interval (float, optional): average seconds between spontaneous
+                events (power, active source, volume changes), 0 disables. Defaults to 0.
+            seed (int, optional): random seed. Defaults to None.
+        """
+        self.devices = {device.address: device for device in devices or default_devices()}
+        self.latency = latency
+        self.nack_rate = nack_rate
+        self.event_interval = event_interval
+        self.random = random.Random(seed)
+        self.volume = 30
+        self.mute = False
+        self.active_source = None
+        self.lock = threading.RLock()
+        # (time.monotonic(), frame) of every transmitted frame, for benchmarks
+        self.sent = collections.deque(maxlen=100000)
+        self._adapters = []
+        self._rx = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def attach(self, adapter: 'ICECAdapter'):
+        """Connect an adapter, starts the bus threads with the first one"""
+        with self.lock:
+            self._adapters.append(adapter)
+            if self._threads:
+                return
+            self._stop.clear()
+            self._threads = [threading.Thread(target=self._rx_thread, name='simcec-rx',
+                                              daemon=True)]
+            if self.event_interval > 0:
+                self._threads.append(threading.Thread(target=self._event_thread,
+                                                      name='simcec-events', daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def detach(self, adapter: 'ICECAdapter'):
+        """Disconnect an adapter, stops the bus threads with the last one"""
+        with self.lock:
+            if adapter in self._adapters:
+                self._adapters.remove(adapter)
+            if self._adapters or not self._threads:
+                return
+            threads, self._threads = self._threads, []
+        self._stop.set()
+        self._rx.put(None)
+        for thread in threads:
+            thread.join()
+
+    def wait(self):
+        """Block for the configured call latency"""
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def acked(self, destination: int) -> bool:
+        """Whether a frame to destination is acknowledged"""
+        if destination != BROADCAST and destination not in self.devices:
+            return False
+        return self.random.random() >= self.nack_rate
+
+    def audio_status(self) -> int:
+        """Audio status byte of the AVR"""
+        if 5 not in self.devices:
+            return CEC_AUDIO_VOLUME_STATUS_UNKNOWN
+        return self.volume | (0x80 if self.mute else 0)
+
+    def receive(self, frame: str):
+        """Deliver a frame to the adapters as if a device sent it
+
+        Args:
+            frame (str): hex bytes separated by ':', e.g. '05:7a:1e'
+        """
+        self.log(CEC_LOG_TRAFFIC, '>> ' + frame)
+        self._rx.put(('cmd', '>> ' + frame))
+
+    def log(self, level: int, message: str):
+        """Deliver a libcec log message to the adapters"""
+        self._rx.put(('log', (level, message)))
+
+    def key_press(self, key: int, duration: int = 0):
+        """Deliver a remote key press to the adapters like libcec does
+
+        Args:
+            key (int): user control code
+            duration (int, optional): 0 when pressed or repeated, the held
+                milliseconds when released. Defaults to 0.
+        """
+        self._rx.put(('key', (key, duration)))
+
+    def set_power(self, address: int, power: int):
+        """Change the power status of a device, libcec logs the change"""
+        device = self.devices[address]
+        if device.power == power:
+            return
+        old = POWER_STATUS_NAMES.get(device.power, 'unknown')
+        device.power = power
+        self.log(CEC_LOG_DEBUG,
+                 f"{device.name} ({address:x}): power status changed from '{old}' "
+                 f"to '{POWER_STATUS_NAMES[power]}'")
+
+    def handle(self, command: SimCommand, own_address: int):
+        """React to an acknowledged frame like the addressed device would"""
+        device = self.devices.get(command.destination)
+        reply = f'{command.destination:x}{own_address:x}'
+        opcode = command.opcode
+        if opcode == CEC_OPCODE_GIVE_DEVICE_POWER_STATUS and device:
+            self.receive(f'{reply}:90:{device.power:02x}')
+        elif opcode == CEC_OPCODE_GIVE_AUDIO_STATUS and device:
+            self.receive(f'{reply}:7a:{self.audio_status():02x}')
+        elif opcode == CEC_OPCODE_GIVE_PHYSICAL_ADDRESS and device:
+            self.receive(f'{command.destination:x}f:84:{device.physical >> 8:02x}:'
+                         f'{device.physical & 0xFF:02x}:{command.destination:02x}')
+        elif opcode == CEC_OPCODE_GIVE_OSD_NAME and device:
+            self.receive(f'{reply}:47:' + ':'.join(f'{c:02x}' for c in device.name.encode()))
+        elif opcode == CEC_OPCODE_GIVE_DEVICE_VENDOR_ID and device:
+            vendor = device.vendor.to_bytes(3, 'big')
+            self.receive(f'{command.destination:x}f:87:' + ':'.join(f'{c:02x}' for c in vendor))
+        elif opcode in (CEC_OPCODE_IMAGE_VIEW_ON, CEC_OPCODE_TEXT_VIEW_ON) and device:
+            self.set_power(command.destination, CEC_POWER_STATUS_ON)
+        elif opcode == CEC_OPCODE_STANDBY:
+            targets = self.devices if command.destination == BROADCAST else [command.destination]
+            for address in targets:
+                self.set_power(address, CEC_POWER_STATUS_STANDBY)
+        elif opcode == CEC_OPCODE_USER_CONTROL_PRESSED and device and command.parameters:
+            self.user_control(command.parameters[0])
+            if command.destination == 5:
+                self.receive(f'{reply}:7a:{self.audio_status():02x}')
+
+    def user_control(self, key: int):
+        """Apply a volume key to the AVR"""
+        if key == CEC_USER_CONTROL_CODE_VOLUME_UP:
+            self.volume = min(self.volume + 1, 100)
+        elif key == CEC_USER_CONTROL_CODE_VOLUME_DOWN:
+            self.volume = max(self.volume - 1, 0)
+        elif key == CEC_USER_CONTROL_CODE_MUTE:
+            self.mute = not self.mute
+
+    def _rx_thread(self):
+        while True:
+            item = self._rx.get()
+            if item is None:
+                return
+            kind, payload = item
+            with self.lock:
+                adapters = list(self._adapters)
+            for adapter in adapters:
+                try:
+                    if kind == 'cmd':
+                        adapter.deliver_command(payload)
+                    elif kind == 'key':
+                        adapter.deliver_key(*payload)
+                    else:
+                        adapter.deliver_log(*payload)
+                except Exception:  # pylint: disable=broad-except
+                    LOGGER.exception('Simulated %s callback failed', kind)
+
+    def _event_thread(self):
+        while not self._stop.wait(self.random.expovariate(1 / self.event_interval)):
+            with self.lock:
+                event = self.random.choice(('power', 'source', 'volume'))
+                device = self.random.choice(list(self.devices.values()))
+                if event == 'power':
+                    self.set_power(device.address, CEC_POWER_STATUS_STANDBY
+                                   if device.power == CEC_POWER_STATUS_ON
+                                   else CEC_POWER_STATUS_ON)
+                elif event == 'source':
+                    self.active_source = device.physical
+                    self.receive(f'{device.address:x}f:82:{device.physical >> 8:02x}:'
+                                 f'{device.physical & 0xFF:02x}')
+                elif 5 in self.devices:
+                    self.volume = self.random.randint(0, 100)
+                    self.receive(f'5f:7a:{self.audio_status():02x}')
+
+
+BUS = SimBus()
+
+
+class _DeviceTypes(list):
+    """cec_device_type_list"""
+    def Add(self, device_type):  # pylint: disable=invalid-name
+        """Add a device type"""
+        self.append(device_type)
+
+
+class libcec_configuration:  # pylint: disable=invalid-name,too-few-public-methods
+    """libcec client configuration"""
+    def __init__(self):
+        self.strDeviceName = ''  # pylint: disable=invalid-name
+        self.bActivateSource = 0  # pylint: disable=invalid-name
+        self.deviceTypes = _DeviceTypes()  # pylint: disable=invalid-name
+        self.clientVersion = 0  # pylint: disable=invalid-name
+        self.log_callback = None
+        self.key_press_callback = None
+        self.command_callback = None
+
+    def SetLogCallback(self, callback):  # pylint: disable=invalid-name
+        """Set the log callback(level, time, message)"""
+        self.log_callback = callback
+
+    def SetKeyPressCallback(self, callback):  # pylint: disable=invalid-name
+        """Set the key press callback(key, duration)"""
+        self.key_press_callback = callback
+
+    def SetCommandCallback(self, callback):  # pylint: disable=invalid-name
+        """Set the command callback(command)"""
+        self.command_callback = callback
+
+
+class _LogicalAddresses:  # pylint: disable=too-few-public-methods
+    def __init__(self, primary: int):
+        self.primary = primary
+
+
+class ICECAdapter:  # pylint: disable=invalid-name,too-many-public-methods
+    """Simulated libcec adapter, method names follow the libcec bindings"""
+    def __init__(self, config: libcec_configuration, bus: SimBus):
+        self._config = config
+        self._bus = bus
+        self._address = 1  # recording device 1
+        self._opened = time.monotonic()
+
+    @staticmethod
+    def Create(config: libcec_configuration, bus: SimBus = None) -> 'ICECAdapter':
+        """Create an adapter on the simulated bus, defaults to BUS"""
+        return ICECAdapter(config, bus or BUS)
+
+    def deliver_command(self, cmd: str):
+        """Pass a received frame to the command callback"""
+        if self._config.command_callback:
+            self._config.command_callback(cmd)
+
+    def deliver_key(self, key: int, duration: int):
+        """Pass a remote key press to the key press callback"""
+        if self._config.key_press_callback:
+            self._config.key_press_callback(key, duration)
+
+    def deliver_log(self, level: int, message: str):
+        """Pass a log message to the log callback"""
+        if self._config.log_callback:
+            self._config.log_callback(level, int((time.monotonic() - self._opened) * 1000),
+                                      message)
+
+    def Open(self, _port: str, _timeout: int = 10000) -> bool:
+        """Connect to the simulated bus"""
+        self._bus.attach(self)
+        return True
+
+    def Close(self):
+        """Disconnect from the simulated bus"""
+        self._bus.detach(self)
+
+    def GetLogicalAddresses(self) -> _LogicalAddresses:
+        """Logical addresses of the adapter"""
+        return _LogicalAddresses(self._address)
+
+    def CommandFromString(self, frame: str) -> SimCommand:
+        """Parse a frame, e.g. '10:04'"""
+        return SimCommand(frame)
+
+    def Transmit(self, command: SimCommand) -> bool:
+        """Transmit a frame, True if it was acknowledged"""
+        bus = self._bus
+        bus.wait()
+        bus.sent.append((time.monotonic(), command.frame))
+        bus.log(CEC_LOG_TRAFFIC, '<< ' + command.frame)
+        with bus.lock:
+            if not bus.acked(command.destination):
+                return False
+            bus.handle(command, self._address)
+        return True
+
+    def _send(self, destination: int, *data) -> bool:
+        frame = ':'.join(f'{byte:02x}' for byte in (self._address << 4 | destination,) + data)
+        return self.Transmit(SimCommand(frame))
+
+    def PowerOnDevices(self, device: int = 0) -> bool:
+        """Power on a device"""
+        return self._send(device, CEC_OPCODE_IMAGE_VIEW_ON)
+
+    def StandbyDevices(self, device: int = BROADCAST) -> bool:
+        """Put a device in standby"""
+        return self._send(device, CEC_OPCODE_STANDBY)
+
+    def _audio_key(self, key: int, send_release: bool) -> int:
+        self._send(5, CEC_OPCODE_USER_CONTROL_PRESSED, key)
+        if send_release:
+            self._send(5, CEC_OPCODE_USER_CONTROL_RELEASE)
+        return self._bus.audio_status()
+
+    def VolumeUp(self, send_release: bool = True) -> int:
+        """Press volume up on the AVR"""
+        return self._audio_key(CEC_USER_CONTROL_CODE_VOLUME_UP, send_release)
+
+    def VolumeDown(self, send_release: bool = True) -> int:
+        """Press volume down on the AVR"""
+        return self._audio_key(CEC_USER_CONTROL_CODE_VOLUME_DOWN, send_release)
+
+    def AudioMute(self) -> int:
+        """Mute the AVR"""
+        if not self._bus.mute:
+            return self._audio_key(CEC_USER_CONTROL_CODE_MUTE, True)
+        return self._bus.audio_status()
+
+    def AudioUnmute(self) -> int:
+        """Unmute the AVR"""
+        if self._bus.mute:
+            return self._audio_key(CEC_USER_CONTROL_CODE_MUTE, True)
+        return self._bus.audio_status()
+
+    def _query(self, device: int, func: callable, default):
+        bus = self._bus
+        bus.wait()
+        with bus.lock:
+            target = bus.devices.get(device)
+            if target is None or not bus.acked(device):
+                return default
+            return func(target)
+
+    def _reply(self, device: int, opcode: int, operand: int):
+        """Pass the reply to a query to the command callback, like libcec"""
+        self._bus.receive(f'{device:x}{self._address:x}:{opcode:02x}:{operand:02x}')
+        return operand
+
+    def AudioStatus(self) -> int:
+        """Audio status byte of the AVR"""
+        return self._query(5, lambda _device: self._reply(
+            5, CEC_OPCODE_REPORT_AUDIO_STATUS, self._bus.audio_status()),
+                           CEC_AUDIO_VOLUME_STATUS_UNKNOWN)
+
+    def GetDevicePowerStatus(self, device: int) -> int:
+        """Power status of a device"""
+        return self._query(device, lambda target: self._reply(
+            device, CEC_OPCODE_REPORT_POWER_STATUS, target.power), CEC_POWER_STATUS_UNKNOWN)
+
+    def GetDevicePhysicalAddress(self, device: int) -> int:
+        """Physical address of a device, 0xFFFF if absent"""
+        return self._query(device, lambda target: target.physical, 0xFFFF)
+
+    def GetDeviceVendorId(self, device: int) -> int:
+        """Vendor id of a device"""
+        return self._query(device, lambda target: target.vendor, 0)
+
+    def GetDeviceOSDName(self, device: int) -> str:
+        """OSD name of a device"""
+        return self._query(device, lambda target: target.name, '')
+
+    def GetDeviceCecVersion(self, device: int) -> int:
+        """CEC version of a device"""
+        return self._query(device, lambda target: target.cec_version, 0)
+
+    def IsActiveSource(self, device: int) -> bool:
+        """Whether a device is the active source"""
+        target = self._bus.devices.get(device)
+        return target is not None and target.physical == self._bus.active_source
+
+    @staticmethod
+    def CommandCallback(_cmd) -> int:
+        """Default libcec command handling"""
+        return 1
+
+    @staticmethod
+    def KeyPressCallback(_key, _duration) -> int:
+        """Default libcec key press handling"""
+        return 1
+
+    @staticmethod
+    def PowerStatusToString(power: int) -> str:
+        """Name of a power status"""
+        return POWER_STATUS_NAMES.get(power, 'unknown')
+
+    @staticmethod
+    def LogicalAddressToString(device: int) -> str:
+        """Name of a logical address"""
+        return LOGICAL_ADDRESS_NAMES[device & 0xF]
+
+    @staticmethod
+    def VendorIdToString(vendor: int) -> str:
+        """Name of a vendor id"""
+        return VENDOR_NAMES.get(vendor, 'Unknown')
+
+    @staticmethod
+    def CecVersionToString(version: int) -> str:
+        """Name of a CEC version"""
+        return CEC_VERSION_NAMES.get(version, 'unknown')
+
+    @staticmethod
+    def OpcodeToString(opcode: int) -> str:
+        """Name of an opcode"""
+        return OPCODE_NAMES.get(opcode, 'unknown')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Retained state cache for the HDMI CEC MQTT bridge
+
+Remembers the last payload published on every state topic (device power,
+audio status, bridge status, ...) so unchanged state is not written to the
+broker again and can be republished. Events are not cached.
+"""
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StateCache:
+    """Last published payload per state topic"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # topic -> (payload, qos)
+        self.suppressed = 0
+
+    @staticmethod
+    def _normalize(message):
+        if message is None or isinstance(message, (bytes, bytearray)):
+            return message
+        return str(message)
+
+    def update(self, topic: str, message=None, qos: int = 0) -> bool:
+        """Store the payload of a topic.
+
+        A None payload clears the topic, it is forgotten so the next payload
+        is published again.
+
+        Args:
+            topic (str): topic without bridge prefix
+            message (_type_, optional): payload. Defaults to None.
+            qos (int, optional): qos to use when republishing. Defaults to 0.
+
+        Returns:
+            bool: True if the payload changed and should be published
+        """
+        payload = self._normalize(message)
+        with self._lock:
+            if payload is None:
+                return self._values.pop(topic, None) is not None
+            if self._values.get(topic, (object(), 0))[0] == payload:
+                self.suppressed += 1
+                return False
+            self._values[topic] = (payload, qos)
+        return True
+
+    def items(self) -> list:
+        """Snapshot of all cached topics
+
+        Returns:
+            list[tuple[str, _type_, int]]: topic, payload, qos
+        """
+        with self._lock:
+            return [(topic, payload, qos) for topic, (payload, qos) in self._values.items()]
+
+    def clear(self):
+        """Forget all cached payloads."""
+        with self._lock:
+            self._values.clear()
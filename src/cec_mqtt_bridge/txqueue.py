@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Paced CEC transmit queue for the HDMI CEC MQTT bridge
+
+Frames are transmitted in order with the CEC signal free time between them,
+NACKed frames are retried within a bounded budget and the bus time used is
+accounted per frame.
+"""
+import collections
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# CEC timing (HDMI 1.4 CEC 5.2 and 9.1), in seconds
+BIT_PERIOD = 0.0024
+START_BIT = 0.0045
+BLOCK_BITS = 10                       # 8 data bits, EOM and ACK
+SIGNAL_FREE_RETRANSMIT = 3 * BIT_PERIOD
+SIGNAL_FREE_NEXT_FRAME = 7 * BIT_PERIOD
+
+
+def frame_bus_time(frame: str) -> float:
+    """Time a frame occupies the bus
+
+    Args:
+        frame (str): frame as hex bytes separated by ':', e.g. '15:44:41'
+
+    Returns:
+        float: bus time in seconds
+    """
+    return START_BIT + (frame.count(':') + 1) * BLOCK_BITS * BIT_PERIOD
+
+
+class TxResult:
+    """Transmit result of one frame"""
+    __slots__ = ('frame', 'ok', 'attempts', 'bus_time')
+
+    def __init__(self, frame: str):
+        self.frame = frame
+        self.ok = False
+        self.attempts = 0
+        self.bus_time = 0.0
+
+    def as_dict(self) -> dict:
+        """Result as JSON serializable dict, bus time in ms"""
+        return {'frame': self.frame, 'ok': self.ok, 'attempts': self.attempts,
+                'bus_ms': round(self.bus_time * 1000, 1)}
+
+
+class TransmitQueue:
+    """Transmits frames on the CEC bus with pacing and retries"""
+    def __init__(self, cec_client, retries: int = 2, retry_budget: int = 6,
+                 cache_size: int = 128):
+        self._cec_client = cec_client
+        self._retries = retries
+        self._retry_budget = retry_budget
+        self._cache_size = cache_size
+        self._commands = collections.OrderedDict()  # frame -> cec_command
+        self._last_end = 0.0
+        self.bus_time = 0.0
+        self.transmitted = 0
+        self.nacked = 0
+
+    def configure(self, retries: int, retry_budget: int):
+        """Change the retry limits
+
+        Args:
+            retries (int): retransmits per frame
+            retry_budget (int): retransmits per message
+        """
+        self._retries = retries
+        self._retry_budget = retry_budget
+
+    def command(self, frame: str):
+        """Parse a frame string, parsed commands are cached
+
+        Args:
+            frame (str): frame as hex bytes separated by ':'
+
+        Returns:
+            cec_command: libcec command
+        """
+        command = self._commands.get(frame)
+        if command is None:
+            command = self._cec_client.CommandFromString(frame)
+            self._commands[frame] = command
+            if len(self._commands) > self._cache_size:
+                self._commands.popitem(last=False)
+        else:
+            self._commands.move_to_end(frame)
+        return command
+
+    def _wait_signal_free(self, gap: float):
+        remaining = self._last_end + gap - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def transmit(self, frames: list) -> list:
+        """Transmit frames in order.
+
+        Callers must serialize access to the adapter.
+
+        Args:
+            frames (list[str]): frames as hex bytes separated by ':'
+
+        Returns:
+            list[TxResult]: result per frame
+        """
+        budget = self._retry_budget
+        results = []
+        for frame in frames:
+            result = TxResult(frame)
+            results.append(result)
+            command = self.command(frame)
+            frame_time = frame_bus_time(frame)
+            gap = SIGNAL_FREE_NEXT_FRAME
+            while True:
+                self._wait_signal_free(gap)
+                result.attempts += 1
+                result.ok = bool(self._cec_client.Transmit(command))
+                self._last_end = time.monotonic()
+                result.bus_time += frame_time
+                if result.ok:
+                    break
+                self.nacked += 1
+                if result.attempts > self._retries or budget <= 0:
+                    break
+                budget -= 1
+                gap = SIGNAL_FREE_RETRANSMIT
+                LOGGER.debug('Retransmitting %s (attempt %d)', frame, result.attempts + 1)
+
+            self.transmitted += 1
+            self.bus_time += result.bus_time
+            if not result.ok:
+                LOGGER.warning('Failed to transmit %s after %d attempts', frame, result.attempts)
+        return results
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""AVR volume controller for the HDMI CEC MQTT bridge
+
+The AVR can only be stepped with volume up/down key presses. The controller
+learns how much one key press changes the volume and how long the AVR takes
+to report its audio status, sends the predicted number of key presses in one
+burst and then corrects. Only the most recently requested volume is chased.
+"""
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Weight of a new observation in the learned step size and latency
+LEARN_RATE = 0.5
+
+
+class VolumeController:
+    """Drives the AVR volume to the most recently requested level"""
+    def __init__(self, cec, step: float = 1.0, latency: float = 0.3, max_rounds: int = 4):
+        self._cec = cec
+        self.step = step          # volume change per key press
+        self.latency = latency    # seconds from status request to report
+        self._max_rounds = max_rounds
+        self._cond = threading.Condition()
+        self._target = None
+        self._volume = None       # last reported volume
+        self._reports = 0         # number of reports received
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='cec-volume', daemon=True)
+        self._thread.start()
+
+    def set(self, volume: int):
+        """Request a volume, replaces a request that is still pending.
+
+        Args:
+            volume (int): requested volume
+        """
+        with self._cond:
+            if self._target is not None:
+                LOGGER.debug('Volume %d superseded by %d', self._target, volume)
+            self._target = volume
+            self._cond.notify_all()
+
+    def reported(self, volume: int):
+        """Audio status reported by the AVR
+
+        Args:
+            volume (int): reported volume
+        """
+        with self._cond:
+            self._volume = volume
+            self._reports += 1
+            self._cond.notify_all()
+
+    def stop(self):
+        """Stop the controller thread."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _next_target(self):
+        """Take the pending target, None if there is none"""
+        with self._cond:
+            target, self._target = self._target, None
+            return target
+
+    def _request_status(self):
+        """Ask the AVR for its audio status and wait for the report
+
+        Returns:
+            int: reported volume, None if the AVR did not respond
+        """
+        with self._cond:
+            reports = self._reports
+        sent = time.monotonic()
+        self._cec.tx_command('71', 5)
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._reports != reports or self._stopping,
+                                       max(self.latency * 3, 0.2)):
+                LOGGER.warning('No audio status received')
+                return None
+            volume = self._volume
+        latency = time.monotonic() - sent
+        self.latency += LEARN_RATE * (latency - self.latency)
+        return volume
+
+    def _converge(self, target: int):
+        with self._cond:
+            current = self._volume
+        if current is None:
+            current = self._request_status()
+
+        for attempt in range(self._max_rounds):
+            newer = self._next_target()
+            if newer is not None:
+                target = newer
+            if current is None or current == target:
+                break
+
+            diff = target - current
+            presses = max(1, round(abs(diff) / self.step))
+            LOGGER.debug('Attempt %d: volume %d -> %d, step %.2f', attempt, current, target,
+                         self.step)
+            self._cec.volume_burst(presses, diff > 0)
+
+            volume = self._request_status()
+            if volume is None:
+                break
+            if volume != current:
+                observed = abs(volume - current) / presses
+                self.step += LEARN_RATE * (observed - self.step)
+                self.step = min(max(self.step, 0.1), 10.0)
+            current = volume
+
+        LOGGER.debug('Volume at %s, target %d, step %.2f, latency %.3f', current, target,
+                     self.step, self.latency)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._target is not None or self._stopping)
+                if self._stopping:
+                    return
+            target = self._next_target()
+            self._cec.setting_volume = True
+            try:
+                self._converge(target)
+            except Exception:  # pylint: disable=broad-except
+                LOGGER.exception('Setting volume failed')
+            finally:
+                self._cec.setting_volume = False